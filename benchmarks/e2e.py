@@ -0,0 +1,357 @@
+""" End-to-end benchmarks of djdd's own overhead.
+
+    schroot, debootstrap, sudo, apt, dpkg and virtualenv are replaced by the
+    stand-ins in benchmarks/standins.py, and software is cloned from local
+    bare git repositories, so this runs as a normal user without network
+    access. What is left is the time djdd itself takes: sessions, subprocess
+    calls, the variant database, hashing, packaging and so on.
+
+        python benchmarks/e2e.py --output report.json
+        python benchmarks/e2e.py --repos 1,8 --variants 1,50 --callers 1,8 \\
+                                 --compare report.json
+
+    Each benchmark is run across the scaling axes (number of repositories,
+    variants and concurrent callers) and the results are written as JSON.
+    With --compare, each result is printed next to the same result in an
+    earlier report (eg. from the previous release).
+"""
+from __future__ import print_function
+
+import os
+import sys
+import grp
+import pwd
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import djdd
+from djdd import constants
+from djdd.base import BuildEnvironment
+from standins import install_standins
+
+SUITE = "jessie"
+ARCH = "amd64"
+DATABASE = "sqlite://"
+REQUIREMENTS = "Django==1.8.5\npsycopg2==2.6.1\nrequests==2.8.1\n"
+MANAGE_PY = "import sys\nsys.exit(0)\n"
+# More variants than a redis server has databases
+RANGES = {'redis_number': (0, 2 ** 20), 'gunicorn_port': (1024, 65535)}
+
+
+################################################################################
+# Setup
+################################################################################
+
+
+def configure_djdd(paths, work_dir):
+    """ Points djdd at the stand-ins and keeps everything in the work directory. """
+    constants.SCHROOT = paths['schroot']
+    constants.DEBOOTSTRAP = paths['debootstrap']
+    constants.IMAGE_CACHE_DIR = os.path.join(work_dir, "images")
+    constants.DEB_POOL_DIR = os.path.join(work_dir, "debs")
+    BuildEnvironment.SCHROOT_CONFIG_DIR = paths['schroot_config_dir']
+    BuildEnvironment.schroot_profile_dir = paths['schroot_profile_dir']
+    # A group the current user is already in
+    BuildEnvironment.unix_group_name = grp.getgrgid(os.getgid()).gr_name
+    os.environ['PATH'] = os.pathsep.join([paths['host_bin'], os.environ.get('PATH', '/usr/bin:/bin')])
+    os.environ.setdefault('USER', pwd.getpwuid(os.getuid()).pw_name)
+    os.environ.setdefault('LOGNAME', os.environ['USER'])
+
+
+def git(args, cwd=None):
+    env = dict(os.environ, GIT_AUTHOR_NAME="djdd", GIT_AUTHOR_EMAIL="djdd@localhost",
+               GIT_COMMITTER_NAME="djdd", GIT_COMMITTER_EMAIL="djdd@localhost")
+    return subprocess.check_output(["git"] + args, cwd=cwd, env=env)
+
+
+def make_repositories(work_dir, count):
+    """ Creates bare repositories with a small django project, returns their URLs. """
+    urls = []
+    for i in range(count):
+        bare_dir = os.path.join(work_dir, "repositories", "project{}.git".format(i))
+        if not os.path.exists(bare_dir):
+            source_dir = bare_dir[:-len(".git")]
+            os.makedirs(source_dir)
+            for filename, content in (("requirements.txt", REQUIREMENTS), ("manage.py", MANAGE_PY),
+                                      ("README", "Project {}\n".format(i))):
+                with open(os.path.join(source_dir, filename), "w") as f:
+                    f.write(content)
+            git(["init", "-q"], cwd=source_dir)
+            git(["add", "."], cwd=source_dir)
+            git(["commit", "-q", "-m", "Initial commit"], cwd=source_dir)
+            git(["clone", "-q", "--bare", source_dir, bare_dir])
+        urls.append("file://" + bare_dir)
+    return urls
+
+
+@contextlib.contextmanager
+def quiet(log_filename):
+    """ Sends everything written to stdout and stderr (also by subprocesses) to a log. """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(log_filename, "a") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+
+################################################################################
+# Measuring
+################################################################################
+
+
+class Report(object):
+    def __init__(self, options):
+        self.results = []
+        self.info = {
+            'djdd_version': djdd.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'options': options,
+        }
+
+    def add(self, name, params, times, **extra):
+        ordered = sorted(times)
+        result = {
+            'name': name,
+            'params': params,
+            'times': times,
+            'min': ordered[0],
+            'median': ordered[len(ordered) // 2],
+            'max': ordered[-1],
+        }
+        result.update(extra)
+        self.results.append(result)
+        return result
+
+    def as_dict(self):
+        return dict(self.info, results=self.results)
+
+
+def timed(func, *args, **kwargs):
+    started = time.time()
+    func(*args, **kwargs)
+    return time.time() - started
+
+
+def concurrently(callers, func, args_list):
+    """ Calls func with each of the args in args_list, from `callers` threads.
+        Returns the wall time and the time of each call.
+    """
+    pool = ThreadPool(callers)
+    try:
+        started = time.time()
+        times = pool.map(lambda args: timed(func, *args), args_list)
+        return time.time() - started, times
+    finally:
+        pool.close()
+
+
+class StageTimes(object):
+    """ Collects stage durations, as a build_site() report function. """
+    def __init__(self):
+        self.stages = {}
+
+    def __call__(self, name, status, duration):
+        if duration is not None:
+            self.stages[name] = {'status': status, 'duration': duration}
+
+
+################################################################################
+# Benchmarks
+################################################################################
+
+
+def bench_init(report, work_dir, repeat):
+    """ A new build environment, without and then with a cached image. """
+    for image_cache, name in ((False, 'init'), (True, 'init-image-cache')):
+        times = []
+        for i in range(repeat):
+            dir = os.path.join(work_dir, "envs", "{}-{}".format(name, i))
+            times.append(timed(djdd.install_build_environment, dir, SUITE, ARCH, variant_database=DATABASE,
+                               image_cache=image_cache, prefetch=False))
+        report.add(name, {}, times)
+
+
+def bench_add_software(report, dir, work_dir, repo_counts, identity):
+    for count in repo_counts:
+        urls = make_repositories(work_dir, count)
+        software = "software{}".format(count)
+        report.add('add_software', {'repos': count}, [timed(djdd.add_software, dir, software, urls, identity)])
+        # Again, now fetching instead of cloning (the mirrors are fresh, so nothing is fetched)
+        report.add('add_software-again', {'repos': count}, [timed(djdd.add_software, dir, software, urls, identity)])
+
+
+def bench_variants(report, dir, variant_counts, caller_counts):
+    # Variant keys are used as subdomains, which are unique across software
+    for count in variant_counts:
+        software = "variants{}".format(count)
+        times = [timed(djdd.add_variant, dir, software, "{}-{}".format(software, i), RANGES) for i in range(count)]
+        report.add('add_variant', {'variants': count}, times)
+        software = "batch{}".format(count)
+        variants = [("{}-{}".format(software, i), None) for i in range(count)]
+        report.add('add_variants', {'variants': count}, [timed(djdd.add_variants, dir, software, variants, RANGES)])
+
+    for callers in caller_counts:
+        software = "concurrent{}".format(callers)
+        args_list = [(dir, software, "{}-{}".format(software, i), RANGES) for i in range(callers * 4)]
+        wall, times = concurrently(callers, djdd.add_variant, args_list)
+        report.add('add_variant-concurrent', {'callers': callers, 'calls': len(args_list)}, times, wall=wall)
+
+
+def bench_status(report, dir, caller_counts, repeat):
+    report.add('get_status', {}, [timed(djdd.get_status, dir) for i in range(repeat)])
+    for callers in caller_counts:
+        wall, times = concurrently(callers, djdd.get_status, [(dir,)] * (callers * repeat))
+        report.add('get_status-concurrent', {'callers': callers, 'calls': callers * repeat}, times, wall=wall)
+
+
+def bench_build(report, dir, work_dir, software, variant_counts, caller_counts, identity):
+    urls = make_repositories(work_dir, 1)
+    djdd.add_software(dir, software, urls, identity)
+    commit = git(["rev-parse", "HEAD"], cwd=urls[0][len("file://"):]).strip()
+
+    def build(variant=None, version=None):
+        stages = StageTimes()
+        duration = timed(djdd.build_site, dir, software, variant, version, report=stages)
+        return duration, stages.stages
+
+    duration, stages = build()
+    report.add('build', {'state': 'cold'}, [duration], stages=stages)
+    duration, stages = build()
+    report.add('build', {'state': 'built'}, [duration], stages=stages)
+    duration, stages = build(version=commit)
+    report.add('build', {'state': 'cached-commit'}, [duration], stages=stages)
+
+    # Site packages of variants, the env and src packages are shared
+    for count in variant_counts:
+        keys = ["b{}-{}".format(count, i) for i in range(count)]
+        djdd.add_variants(dir, software, [(key, None) for key in keys], RANGES)
+        times = [build(key)[0] for key in keys]
+        report.add('build-variant', {'variants': count}, times)
+
+    # As many variants, built in one run
+    for count in variant_counts:
+        keys = ["m{}-{}".format(count, i) for i in range(count)]
+        djdd.add_variants(dir, software, [(key, None) for key in keys], RANGES)
+        stages = StageTimes()
+        duration = timed(djdd.build_sites, dir, software, keys, report=stages)
+        report.add('build-variants', {'variants': count}, [duration], stages=stages.stages)
+
+    for callers in caller_counts:
+        keys = ["c{}-{}".format(callers, i) for i in range(callers)]
+        djdd.add_variants(dir, software, [(key, None) for key in keys], RANGES)
+        wall, times = concurrently(callers, lambda key: build(key), [(key,) for key in keys])
+        report.add('build-variant-concurrent', {'callers': callers}, times, wall=wall)
+
+
+################################################################################
+# Output
+################################################################################
+
+
+def result_key(result):
+    return result['name'], tuple(sorted(result['params'].items()))
+
+
+def format_params(params):
+    return " ".join("{}={}".format(k, v) for k, v in sorted(params.items()))
+
+
+def print_report(report, baseline=None):
+    earlier = {}
+    if baseline is not None:
+        earlier = dict((result_key(result), result) for result in baseline['results'])
+        print("Compared with djdd {} ({})".format(baseline.get('djdd_version'), baseline.get('started')))
+    for result in report.results:
+        line = "{:<26} {:<22} median {:8.3f}s".format(result['name'], format_params(result['params']),
+                                                      result['median'])
+        if 'wall' in result:
+            line += "  wall {:8.3f}s".format(result['wall'])
+        previous = earlier.get(result_key(result))
+        if previous is not None and previous['median']:
+            line += "  ({:+.0%})".format(result['median'] / previous['median'] - 1)
+        print(line)
+
+
+def int_list(value):
+    return [int(part) for part in value.split(",") if part.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark djdd with local stand-ins for "
+                                                 "schroot, debootstrap and git servers")
+    parser.add_argument('--repos', type=int_list, default=[1, 4, 16], help="numbers of repositories")
+    parser.add_argument('--variants', type=int_list, default=[1, 10, 50], help="numbers of variants")
+    parser.add_argument('--callers', type=int_list, default=[1, 4, 8], help="numbers of concurrent callers")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of the quicker benchmarks")
+    parser.add_argument('--session-delay', type=float, default=0.0,
+                        help="seconds the schroot stand-in takes to begin or end a session")
+    parser.add_argument('--debootstrap-delay', type=float, default=0.0,
+                        help="seconds the debootstrap stand-in takes")
+    parser.add_argument('--output', help="write the JSON report to this file (default: stdout)")
+    parser.add_argument('--compare', help="an earlier JSON report to compare with")
+    parser.add_argument('--keep', action='store_true', help="keep the work directory")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="djdd-bench-")
+    paths = install_standins(work_dir, args.session_delay, args.debootstrap_delay)
+    configure_djdd(paths, work_dir)
+    identity = os.path.join(work_dir, "id_rsa")
+    with open(identity, "w") as f:
+        f.write("not a key\n")
+
+    options = dict((k, v) for k, v in vars(args).items() if k not in ('output', 'compare', 'keep'))
+    report = Report(options)
+    log_filename = os.path.join(work_dir, "benchmark.log")
+    try:
+        with quiet(log_filename):
+            bench_init(report, work_dir, min(args.repeat, 3))
+            dir = os.path.join(work_dir, "envs", "init-0")
+            bench_add_software(report, dir, work_dir, args.repos, identity)
+            bench_variants(report, dir, args.variants, args.callers)
+            bench_status(report, dir, args.callers, args.repeat)
+            bench_build(report, dir, work_dir, "site", args.variants, args.callers, identity)
+            BuildEnvironment(dir).sessions.end_all()
+    except:
+        print("Benchmark failed, see {}".format(log_filename), file=sys.stderr)
+        raise
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report.as_dict(), f, indent=2, sort_keys=True)
+        print_report(report, baseline)
+    else:
+        json.dump(report.as_dict(), sys.stdout, indent=2, sort_keys=True)
+        print()
+    if not args.keep:
+        subprocess.call(["rm", "-rf", work_dir])
+    else:
+        print("Work directory: {}".format(work_dir), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
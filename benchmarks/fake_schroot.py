@@ -0,0 +1,122 @@
+""" A stand-in for schroot, for benchmarking djdd without root privileges.
+
+    Chroots are read from the djdd configuration in the fake /etc/schroot and
+    sessions are recorded in the state directory (see standins.json, which
+    benchmarks/standins.py writes next to this script). Commands run on the
+    host, with absolute paths moved into the chroot's directory and the
+    stand-in tools for apt, dpkg, virtualenv etc. first in the PATH.
+    Overlay sessions share the chroot's directory, there is no isolation.
+"""
+import os
+import re
+import sys
+import glob
+import json
+import time
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "standins.json")) as f:
+    CONFIG = json.load(f)
+
+# Absolute paths in arguments and shell scripts, but not in URLs, options or /dev
+RE_PATH = re.compile(r'''(?<![\w.:/~$-])/(?!dev/|proc/)[^\s'"|;&()<>#]*''')
+
+
+def chroot_directories():
+    directories = {}
+    for filename in glob.glob(os.path.join(CONFIG['schroot_config_dir'], "*.conf")):
+        name = None
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("[") and line.endswith("]"):
+                    name = line[1:-1]
+                elif line.startswith("directory=") and name:
+                    directories[name] = line.split("=", 1)[1]
+    return directories
+
+
+def session_filename(name):
+    return os.path.join(CONFIG['session_dir'], name.split(":", 1)[-1])
+
+
+def translate(root, text):
+    def replace(match):
+        path = match.group(0)
+        if path.startswith(CONFIG['work_dir']):
+            return path
+        return root + path
+    return RE_PATH.sub(replace, text)
+
+
+def run(root, directory, cmd, preserve_env):
+    env = dict(os.environ) if preserve_env else {}
+    env.update({
+        'PATH': CONFIG['chroot_path'],
+        'HOME': env.get('HOME') or os.environ.get('HOME', '/root'),
+    })
+    args = [translate(root, arg) for arg in cmd]
+    # Executables in the chroot (eg. a virtualenv's pip) or those of the host
+    if cmd[0].startswith("/") and not os.path.exists(args[0]):
+        args[0] = cmd[0]
+    os.chdir(translate(root, directory))
+    os.execve(args[0] if "/" in args[0] else find_executable(args[0], env['PATH']), args, env)
+
+
+def find_executable(name, path):
+    for directory in path.split(os.pathsep):
+        filename = os.path.join(directory, name)
+        if os.path.exists(filename):
+            return filename
+    sys.stderr.write("schroot: {}: command not found\n".format(name))
+    sys.exit(127)
+
+
+def main(argv):
+    options = {'directory': '/'}
+    flags = set()
+    cmd = []
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == "--":
+            cmd = args
+            break
+        elif arg in ("--chroot", "-c", "--session-name", "--directory", "--user", "-u"):
+            options[arg.lstrip("-")] = args.pop(0)
+        else:
+            flags.add(arg)
+
+    if "--list" in flags:
+        for filename in sorted(os.listdir(CONFIG['session_dir'])):
+            sys.stdout.write("session:{}\n".format(filename))
+        return 0
+
+    chroot = options.get('chroot') or options.get('c')
+    if "--begin-session" in flags:
+        directory = chroot_directories().get(chroot)
+        if directory is None:
+            sys.stderr.write("E: {}: Chroot not found\n".format(chroot))
+            return 1
+        time.sleep(CONFIG['session_delay'])
+        with open(session_filename(options['session-name']), 'w') as f:
+            f.write(directory)
+        sys.stdout.write(options['session-name'] + "\n")
+        return 0
+
+    try:
+        with open(session_filename(chroot)) as f:
+            root = f.read()
+    except IOError:
+        sys.stderr.write("E: {}: Session not found\n".format(chroot))
+        return 1
+
+    if "--end-session" in flags:
+        time.sleep(CONFIG['session_delay'])
+        os.unlink(session_filename(chroot))
+        return 0
+
+    run(root, options['directory'], cmd or ["/bin/sh"], "-p" in flags or "--preserve-environment" in flags)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
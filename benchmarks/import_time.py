@@ -0,0 +1,79 @@
+""" Measures how long the command line tool takes to start.
+
+    django-deb-deploy is called hundreds of times per deploy, so commands
+    that don't need a module (or a database driver) shouldn't import it.
+    Run this from the repository root:
+
+        python benchmarks/import_time.py [--runs 20] [--budget 100]
+
+    The time taken by python itself is measured too and subtracted.
+    Exits with status 1 if the median startup time is over the budget (in
+    milliseconds), or if importing the tool loads any of HEAVY_MODULES.
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed by some commands, these must be imported when they are used
+HEAVY_MODULES = ['psycopg2', 'sqlite3', 'uuid', 'djdd.base', 'djdd.build', 'djdd.initialize_build']
+
+CASES = [
+    ('python', "pass"),
+    ('import', "import djdd.ui"),
+    ('--help', "import sys; sys.argv[1:] = ['--help']; from djdd.ui import cli; cli()"),
+    ('uninstall --help', "import sys; sys.argv[1:] = ['uninstall', '--help']; from djdd.ui import cli; cli()"),
+]
+
+
+def run(code):
+    """ Returns the time in seconds taken to run code in a new interpreter. """
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], stdout=devnull, env=env)
+        return time.time() - start
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def loaded_heavy_modules():
+    code = "import sys, djdd.ui; print(' '.join(m for m in sys.modules if sys.modules[m] is not None))"
+    output = subprocess.check_output([sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=ROOT_DIR))
+    loaded = set(output.split())
+    return [name for name in HEAVY_MODULES if name in loaded]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of django-deb-deploy")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--budget', type=float, default=100, help="milliseconds, after python's own startup")
+    args = parser.parse_args()
+
+    results = {}
+    for name, code in CASES:
+        results[name] = median([run(code) for i in range(args.runs)]) * 1000
+    baseline = results['python']
+    for name, code in CASES:
+        print("{:>20}: {:6.1f}ms".format(name, results[name] - (baseline if name != 'python' else 0)))
+
+    failed = False
+    slowest = max(results[name] for name, code in CASES) - baseline
+    if slowest > args.budget:
+        print("Startup takes {:.1f}ms, the budget is {:.1f}ms".format(slowest, args.budget))
+        failed = True
+    heavy = loaded_heavy_modules()
+    if heavy:
+        print("Imported by djdd.ui: {}".format(", ".join(heavy)))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
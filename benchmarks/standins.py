@@ -0,0 +1,139 @@
+""" Local stand-ins for the programs djdd runs, so that it can be benchmarked
+    (by a normal user, without network access) and its own overhead measured.
+
+    install_standins() writes them into a work directory:
+        bin/host/     sudo, schroot and debootstrap, used by djdd on the host
+        bin/chroot/   apt-get, dpkg, virtualenv etc. used "in the chroot"
+    The stand-ins do as little as possible, with optional delays to mimic
+    the real programs. git, tar, cp and friends are the real ones.
+"""
+import os
+import sys
+import json
+import stat
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SUDO = """#!/bin/sh
+while :; do
+    case "$1" in
+        -u|-g) shift 2 ;;
+        *) break ;;
+    esac
+done
+case "$1" in
+    addgroup|createdb|chown) exit 0 ;;
+esac
+exec "$@"
+"""
+
+DEBOOTSTRAP = """#!/bin/sh
+# debootstrap [OPTION...] SUITE TARGET [MIRROR]
+while [ "${{1#-}}" != "$1" ]; do
+    case "$1" in
+        --arch|--unpack-tarball|--include|--exclude) shift ;;
+    esac
+    shift
+done
+target="$2"
+sleep {delay}
+for dir in bin sbin etc/apt root tmp usr/lib usr/share var/lib/dpkg var/lib/apt/lists var/cache/apt/archives; do
+    mkdir -p "$target/$dir"
+done
+cat > "$target/var/lib/dpkg/status" <<EOF
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Version: 2.19-18
+
+Package: git
+Status: install ok installed
+Architecture: amd64
+Version: 1:2.1.4-2.1
+Depends: libc6 (>= 2.16)
+
+Package: python
+Status: install ok installed
+Architecture: amd64
+Version: 2.7.9-1
+EOF
+"""
+
+# Run "in the chroot", with their arguments already moved into it
+CHROOT_TOOLS = {
+    'apt-get': "exit 0\n",
+    'addgroup': "exit 0\n",
+    'adduser': "exit 0\n",
+    'chown': "exit 0\n",
+    'pip': "exit 0\n",
+    'ssh-add': "exit 0\n",
+    'ssh-keygen': "exit 0\n",
+    'dpkg': """
+        [ "$1" = --print-architecture ] && echo amd64
+        exit 0
+        """,
+    'dpkg-deb': """
+        case "$1" in
+            --build) exec tar -cf "$3" -C "$2" . ;;
+        esac
+        exit 0
+        """,
+    'virtualenv': """
+        for dir; do :; done
+        mkdir -p "$dir/bin"
+        for tool in pip python; do
+            printf '#!/bin/sh\\nexit 0\\n' > "$dir/bin/$tool"
+            chmod +x "$dir/bin/$tool"
+        done
+        """,
+    # djdd kills the agent from the host, so there must be a process
+    'ssh-agent': """
+        sleep 600 >/dev/null 2>&1 </dev/null &
+        echo "SSH_AUTH_SOCK=/tmp/djdd-bench-agent.$$; export SSH_AUTH_SOCK;"
+        echo "SSH_AGENT_PID=$!; export SSH_AGENT_PID;"
+        """,
+}
+
+
+def write_script(filename, content):
+    with open(filename, "w") as f:
+        f.write(content)
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def install_standins(work_dir, session_delay=0.0, debootstrap_delay=0.0):
+    """ Writes the stand-ins and their configuration into work_dir.
+        Returns a dict of the directories and programs, to configure djdd with.
+    """
+    paths = {
+        'work_dir': work_dir,
+        'host_bin': os.path.join(work_dir, "bin", "host"),
+        'chroot_bin': os.path.join(work_dir, "bin", "chroot"),
+        'schroot_config_dir': os.path.join(work_dir, "etc", "schroot", "chroot.d"),
+        'schroot_profile_dir': os.path.join(work_dir, "etc", "schroot", "djdd"),
+        'session_dir': os.path.join(work_dir, "schroot-sessions"),
+    }
+    for name in ('host_bin', 'chroot_bin', 'schroot_config_dir', 'session_dir'):
+        os.makedirs(paths[name])
+    paths['schroot'] = os.path.join(paths['host_bin'], "schroot")
+    paths['debootstrap'] = os.path.join(paths['host_bin'], "debootstrap")
+
+    write_script(os.path.join(paths['host_bin'], "sudo"), SUDO)
+    write_script(paths['debootstrap'], DEBOOTSTRAP.format(delay=debootstrap_delay))
+    # The schroot stand-in is run with a minimal environment, so it can't rely on the PATH
+    with open(os.path.join(BENCHMARKS_DIR, "fake_schroot.py")) as f:
+        source = f.read()
+    write_script(paths['schroot'], "#!{}\n".format(sys.executable) + source)
+    for name, body in CHROOT_TOOLS.items():
+        lines = [line.strip() for line in body.strip().splitlines()]
+        write_script(os.path.join(paths['chroot_bin'], name), "#!/bin/sh\n" + "\n".join(lines) + "\n")
+
+    with open(os.path.join(paths['host_bin'], "standins.json"), "w") as f:
+        json.dump({
+            'work_dir': work_dir,
+            'schroot_config_dir': paths['schroot_config_dir'],
+            'session_dir': paths['session_dir'],
+            'chroot_path': os.pathsep.join([paths['chroot_bin'], os.environ.get('PATH', '/usr/bin:/bin')]),
+            'session_delay': session_delay,
+        }, f)
+    return paths
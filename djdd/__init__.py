@@ -1,10 +1,39 @@
 import os
+import importlib
 
 version_file = os.path.join(os.path.dirname(__file__), "VERSION")
 with open(version_file, 'rb') as f:
     __version__ = f.read().decode('utf-8').strip()
 
-from djdd.initialize_build import install_build_environment, uninstall_build_environment
+
+def _lazy(module_name, name):
+    """ Returns a function that imports the module with the real function on
+        its first call, so importing djdd stays cheap.
+    """
+    def func(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), name)(*args, **kwargs)
+    func.__name__ = name
+    func.__module__ = module_name
+    return func
+
+
+# These are named like their modules, importing the module here means a later
+# "import djdd.add_software" can't replace the function with the module.
+# The modules import what they need when they are called.
 from djdd.add_software import add_software
-from djdd.add_variant import add_variant
-from djdd.status import get_status
+from djdd.add_variant import add_variant, add_variants, read_variants_file
+
+install_build_environment = _lazy('djdd.initialize_build', 'install_build_environment')
+uninstall_build_environment = _lazy('djdd.initialize_build', 'uninstall_build_environment')
+get_status = _lazy('djdd.status', 'get_status')
+get_profiles = _lazy('djdd.status', 'get_profiles')
+build_site = _lazy('djdd.build', 'build_site')
+build_sites = _lazy('djdd.build', 'build_sites')
+plan_build = _lazy('djdd.build', 'plan_build')
+list_wheels = _lazy('djdd.wheels', 'list_wheels')
+prewarm_wheels = _lazy('djdd.wheels', 'prewarm_wheels')
+prune_wheels = _lazy('djdd.wheels', 'prune_wheels')
+normalize_requirements = _lazy('djdd.requirements', 'normalize_requirements')
+requirements_hash = _lazy('djdd.requirements', 'requirements_hash')
+apt_cache_status = _lazy('djdd.aptcache', 'apt_cache_status')
+prune_apt_cache = _lazy('djdd.aptcache', 'prune_apt_cache')
@@ -1,20 +1,25 @@
 import grp
 import os
+import time
 import urlparse
 import sys
 import shutil
-from .base import BuildEnvironment, logger, NAMESPACE
+import subprocess
 
 
-def add_software(dir, name, repositories, identity):
+def add_software(dir, name, repositories, identity, jobs=None):
     """ Once schroot has been configured, a regular user can initialise the directory."""
+    # djdd imports this module, so what it needs is imported when it is called
+    from djdd.base import BuildEnvironment, logger, NAMESPACE
+    from djdd import trace
+    from djdd import streams
     build_env = BuildEnvironment(dir)
 
     # Check that user is a member of djdd group, if not, ask to add
     # XXX should we allow root?
     gid_djdd = grp.getgrnam(build_env.unix_group_name).gr_gid
-    if gid_djdd not in os.getgroups():
-        logger.error("Your user is not a member of the {group} group.".format(user=build_env.unix_group_name))
+    if gid_djdd not in os.getgroups() and gid_djdd != os.getgid():
+        logger.error("Your user is not a member of the {group} group.".format(group=build_env.unix_group_name))
         sys.exit(6)
 
     identity_dir = '/var/lib/{namespace}/{name}/ssh/'.format(namespace=NAMESPACE, name=name)
@@ -25,33 +30,95 @@ def add_software(dir, name, repositories, identity):
 
     # Create a directory for the builds
     repository_base_dir = '/var/lib/{namespace}/{name}/repository/'.format(namespace=NAMESPACE, name=name)
-    with build_env.chroot() as call:
-        call(["mkdir", "-p", repository_base_dir], root=True)
-        call(["mkdir", "-p", identity_dir], root=True)
-        call(["chown", ":{build_group}".format(build_group=build_env.build_group),
-                repository_base_dir, identity_dir], root=True)
-        call(["chmod", "g+rwX", repository_base_dir, identity_dir], root=True)
-
-        # If no identity, create one
-        if identity is None and not os.path.exists(build_env.ext_filename(identity_filename)):
-            comment = u"djdd {}".format(name)
-            call(["ssh-keygen", "-t", "rsa", "-C", comment, "-N", "", "-q", "-f", identity_filename])#, capture_output=True)
-            print("Created SSH key:\n")
-            call(["cat", identity_filename + ".pub"])
-            print("\n")
-            raw_input("Add this key to the repository and press Enter to continue...")
-        else:
-            shutil.copyfile(identity, build_env.ext_filename(identity_filename))
-            os.chmod(build_env.ext_filename(identity_filename), 0o2770) # 770 == ug+rwx,o-rwx
-
-        # Checkout the source code
-        for repository in repositories:
-            name = urlparse.urlparse(repository).path.rsplit("/", 1)[-1]
-            repository_dir = os.path.join(repository_base_dir, name)
-            print("Cloning {} in build environment".format(name))
-            if os.path.exists(build_env.ext_filename(repository_dir)):
-                print("This repository has already been cloned.")
+    log_name = "add-software {}".format(name)
+    with trace.tracing(build_env.log_dir, log_name), streams.command_log(build_env.log_dir, log_name):
+        with build_env.chroot() as call:
+            call.batch([
+                ["mkdir", "-p", repository_base_dir],
+                ["mkdir", "-p", identity_dir],
+                ["chown", ":{build_group}".format(build_group=build_env.build_group),
+                    repository_base_dir, identity_dir],
+                ["chmod", "g+rwX", repository_base_dir, identity_dir],
+            ], root=True, check=True)
+
+            # If no identity, create one
+            if identity is None and not os.path.exists(build_env.ext_filename(identity_filename)):
+                comment = u"djdd {}".format(name)
+                call(["ssh-keygen", "-t", "rsa", "-C", comment, "-N", "", "-q", "-f", identity_filename])#, capture_output=True)
+                print("Created SSH key:\n")
+                call(["cat", identity_filename + ".pub"])
+                print("\n")
+                raw_input("Add this key to the repository and press Enter to continue...")
             else:
-                with build_env.sshagent(call, identity_filename) as ssh_call:
-                    # No point in being quiet, let the user see what's happening
-                    ssh_call(["git", "clone", repository, repository_dir, "--mirror"])  #, "--quiet"])
+                shutil.copyfile(identity, build_env.ext_filename(identity_filename))
+                os.chmod(build_env.ext_filename(identity_filename), 0o2770) # 770 == ug+rwx,o-rwx
+
+            # Checkout the source code, all clones share one ssh-agent
+            with build_env.sshagent(call, identity_filename) as ssh_call:
+                failed = clone_repositories(build_env, ssh_call, repository_base_dir, repositories, jobs)
+    if failed:
+        logger.error("Could not clone or fetch the following repositories:")
+        for repository in failed:
+            logger.error("   {}".format(repository))
+        sys.exit(7)
+
+
+def clone_repositories(build_env, ssh_call, repository_base_dir, repositories, jobs=None):
+    """ Clones the given repositories as mirrors into repository_base_dir,
+        fetching those that have already been cloned. Up to `jobs` repositories
+        are cloned at the same time.
+        Returns a list of the repositories that failed, a failure does not
+        stop the other repositories from being cloned.
+    """
+    from multiprocessing.pool import ThreadPool
+    from djdd import constants
+    from djdd import exceptions
+    from djdd import trace
+    from djdd.fetch import FetchCoordinator
+    jobs = jobs or constants.CLONE_JOBS
+    fetcher = FetchCoordinator(build_env, ssh_call)
+
+    def clone(repository):
+        name = urlparse.urlparse(repository).path.rsplit("/", 1)[-1]
+        repository_dir = os.path.join(repository_base_dir, name)
+        exists = os.path.exists(build_env.ext_filename(repository_dir))
+        action = "fetch" if exists else "clone"
+        progress(name, "{} started".format(action))
+        started = time.time()
+        try:
+            with trace.phase(name):
+                if exists:
+                    result = fetcher.fetch(repository_dir)
+                else:
+                    ssh_call(["git", "clone", repository, repository_dir, "--mirror"], capture_output=True,
+                             tail=constants.OUTPUT_TAIL_LINES)
+                    fetcher.mark_fetched(repository_dir, started)
+                    result = "cloned"
+        except subprocess.CalledProcessError as e:
+            progress(name, "{} failed".format(action), e.output)
+            return repository, False
+        except exceptions.CommandCancelled as e:
+            timed_out = isinstance(e, exceptions.CommandTimeout)
+            progress(name, "{} {}".format(action, "timed out" if timed_out else "was cancelled"),
+                     e.output if timed_out else None)
+            return repository, False
+        progress(name, "{} in {:.1f}s".format(result, time.time() - started))
+        return repository, True
+
+    pool = ThreadPool(min(jobs, len(repositories)) or 1)
+    try:
+        results = pool.map(clone, repositories)
+    finally:
+        pool.close()
+    return [repository for repository, ok in results if not ok]
+
+
+def progress(name, msg, output=None):
+    """ Print a line of progress for the given repository, in one write so that
+        concurrent clones don't interleave their lines.
+    """
+    lines = ["[{}] {}".format(name, msg)]
+    if output:
+        lines.extend("[{}]    {}".format(name, line) for line in output.splitlines())
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
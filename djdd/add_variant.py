@@ -1,28 +1,37 @@
-from .base import BuildEnvironment, logger
+import io
 
-def add_variant(dir, software_name, variant_name):
+
+def add_variant(dir, software_name, variant_name, ranges=None):
     """ Once schroot has been configured, a regular user can initialise the directory."""
-    build_env = BuildEnvironment(dir)
+    return add_variants(dir, software_name, [(variant_name, None)], ranges)[0]
 
-    variant_info = build_env.get_variant_info(software_name, variant_name)
-    if variant_info is None:
-        vid = build_env.get_next_variant_id()
-    else:
-        vid = variant_info['id']
 
-    # Create the required variant info dict, using a hardcoded algorithm for now,
-    # but use the software_name later.
-    variant_info = {
-            'id': vid,
-            'software': software_name,
-            'key': variant_name,
-            'name': variant_name,  # TODO: use a hook
-            'subdomain': variant_name,  # TODO: use a hook
-            'postgres_name': '{}_{}'.format(software_name, variant_name),  # TODO: use a hook
-            'elasticsearch_name': variant_name,  # TODO: use a hook
-            'redis_number': vid,  # TODO: use a hook
-            'gunicorn_port': 4000 + vid,  # TODO: use a hook
-        }
+def add_variants(dir, software_name, variants, ranges=None):
+    """ Adds many variants of a software at once, in a single transaction.
+        `variants` is a list of (key, name) pairs (name may be None), and
+        `ranges` optionally limits the numbers given out, eg.
+        {'redis_number': (0, 15), 'gunicorn_port': (4001, 4999)}.
+        Returns the variant info dicts.
+    """
+    # djdd imports this module, so what it needs is imported when it is called
+    from djdd.base import BuildEnvironment, logger
+    build_env = BuildEnvironment(dir)
+    variant_infos = build_env.allocate_variants(software_name, variants, ranges)
+    for variant_info in variant_infos:
+        logger.debug(u"Added variant {} for software {}".format(variant_info['key'], software_name))
+    return variant_infos
+
 
-    build_env.set_variant_info(software_name, variant_name, variant_info)
-    logger.debug(u"Added variant {} for software {}".format(variant_name, software_name))
+def read_variants_file(filename):
+    """ Reads a file of variants to add, one per line: the variant key,
+        optionally followed by its name, eg. "berlin Berlin (Germany)".
+        Blank lines and comments (starting with #) are ignored.
+    """
+    variants = []
+    with io.open(filename, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                parts = line.split(None, 1)
+                variants.append((parts[0], parts[1] if len(parts) > 1 else None))
+    return variants
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import fcntl
+import contextlib
+
+from djdd.base import BuildEnvironment, logger
+from djdd.prefetch import PackagePool
+from djdd import constants
+
+
+class AptCache(object):
+    """ The package pool, bind mounted as /var/cache/apt/archives into every
+        chroot (through the schroot profile), so that all build environments
+        share one apt archive cache. Packages are named by name, version and
+        architecture, so each is only kept once.
+
+        apt locks the archive cache while it runs, so apt runs using the
+        shared cache (from any chroot or overlay session) wait for each
+        other on the host, see lock().
+
+        Each build environment keeps its own statistics of how many packages
+        were found in the cache (hits) and how many had to be downloaded
+        (misses) in apt-cache-stats.json.
+    """
+    ARCHIVES_DIR = '/var/cache/apt/archives'
+    STATS_NAME = "apt-cache-stats.json"
+    LOCK_NAME = ".djdd-apt.lock"
+
+    def __init__(self, build_env):
+        self.build_env = build_env
+        self.dir = constants.DEB_POOL_DIR
+        self.stats_filename = os.path.join(build_env.dir, self.STATS_NAME)
+
+    def fstab_line(self):
+        return "{}\t{}\tnone\trw,bind\t0\t0".format(self.dir, self.ARCHIVES_DIR)
+
+    def enabled(self):
+        """ Checks if the schroot profile mounts the shared cache. """
+        try:
+            with open(os.path.join(self.build_env.schroot_profile_dir, 'fstab')) as f:
+                return any(line.split() == self.fstab_line().split() for line in f)
+        except IOError:
+            return False
+
+    def prepare(self):
+        PackagePool(self.dir).prepare(self.build_env.unix_group_name)
+
+    def list_packages(self):
+        """ Returns a dict of the size of every package in the cache, by filename. """
+        packages = {}
+        for name in os.listdir(self.dir):
+            if name.endswith(".deb"):
+                try:
+                    packages[name] = os.path.getsize(os.path.join(self.dir, name))
+                except OSError:
+                    pass
+        return packages
+
+    @contextlib.contextmanager
+    def lock(self):
+        """ Context manager for running apt with the shared cache. """
+        with open(os.path.join(self.dir, self.LOCK_NAME), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def stats(self):
+        """ Context manager providing this environment's statistics as a dict
+            ({'hits', 'misses', 'downloaded', 'installs'}), saved again on exit.
+        """
+        with open(self.stats_filename + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.stats_filename) as f:
+                    stats = json.load(f)
+            except IOError:
+                stats = {'hits': 0, 'misses': 0, 'downloaded': 0, 'installs': 0}
+            yield stats
+            with open(self.stats_filename + ".tmp", "w") as f:
+                json.dump(stats, f, indent=1, sort_keys=True)
+            os.rename(self.stats_filename + ".tmp", self.stats_filename)
+
+    def prune(self, max_size, keep_since=None, wait=False):
+        """ Deletes the least recently used packages until the cache is no
+            larger than max_size bytes. Packages used (or downloaded) since
+            `keep_since` are kept. Nothing is deleted while apt is using the
+            cache (see lock()), unless `wait` is given, which waits for it to
+            finish. Returns the names of deleted packages.
+        """
+        with open(os.path.join(self.dir, self.LOCK_NAME), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                logger.debug("Not pruning the shared apt cache, apt is using it")
+                return []
+            used = []
+            for name, size in self.list_packages().items():
+                filename = os.path.join(self.dir, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                # Access times may not be updated (eg. relatime), so use whichever is newer
+                used.append((max(stat.st_atime, stat.st_mtime), name, size))
+            total = sum(size for last_used, name, size in used)
+            pruned = []
+            for last_used, name, size in sorted(used):
+                if total <= max_size or (keep_since is not None and last_used >= keep_since):
+                    break
+                try:
+                    os.unlink(os.path.join(self.dir, name))
+                except OSError:
+                    continue
+                total -= size
+                pruned.append(name)
+            return pruned
+
+
+def apt_install(build_env, call, packages):
+    """ Installs the given debian packages with apt in the chroot. If the
+        shared apt cache is enabled, its statistics are updated and it is
+        pruned back to size afterwards.
+    """
+    cache = AptCache(build_env)
+    if not cache.enabled():
+        call.batch([['apt-get', 'install', '--assume-yes'] + list(packages)], root=True, check=True)
+        return
+
+    started = time.time()
+    with cache.lock():
+        # The packages apt would install, with or without a download
+        steps = call.batch([['apt-get', 'install', '--assume-yes', '--simulate'] + list(packages)],
+                           root=True, check=True, quiet=True, tail=None)
+        installs = len([line for line in steps[0].output.splitlines() if line.startswith("Inst ")])
+        before = cache.list_packages()
+        call.batch([['apt-get', 'install', '--assume-yes'] + list(packages)], root=True, check=True)
+        downloaded = dict((name, size) for name, size in cache.list_packages().items() if name not in before)
+
+    with cache.stats() as stats:
+        stats['installs'] += installs
+        stats['misses'] += len(downloaded)
+        stats['hits'] += max(installs - len(downloaded), 0)
+        stats['downloaded'] += sum(downloaded.values())
+    pruned = cache.prune(constants.APT_CACHE_MAX_SIZE, keep_since=started - constants.APT_CACHE_KEEP_RECENT)
+    if pruned:
+        logger.debug("Pruned {} packages from the shared apt cache".format(len(pruned)))
+
+
+def apt_cache_status(dir):
+    """ Returns a dict describing the shared apt cache and the statistics of
+        the given build environment.
+    """
+    cache = AptCache(BuildEnvironment(dir))
+    packages = cache.list_packages() if os.path.exists(cache.dir) else {}
+    status = {
+        'enabled': cache.enabled(),
+        'dir': cache.dir,
+        'packages': len(packages),
+        'size': sum(packages.values()),
+        'hits': 0, 'misses': 0, 'downloaded': 0, 'installs': 0,
+    }
+    if os.path.exists(cache.stats_filename):
+        with cache.stats() as stats:
+            status.update(stats)
+    return status
+
+
+def prune_apt_cache(dir, max_size=None):
+    """ Evicts the least recently used packages until the shared apt cache
+        is no larger than max_size bytes, keeping the ones used within the
+        last hour. Returns the names of evicted packages.
+    """
+    cache = AptCache(BuildEnvironment(dir))
+    if not os.path.exists(cache.dir):
+        return []
+    return cache.prune(constants.APT_CACHE_MAX_SIZE if max_size is None else max_size,
+                       keep_since=time.time() - constants.APT_CACHE_KEEP_RECENT, wait=True)
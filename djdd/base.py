@@ -1,26 +1,35 @@
 import os
 import re
+import time
+import uuid
+import pipes
 import random
+import hashlib
 import logging
 import urlparse
-import functools
 import contextlib
 import subprocess
-import psycopg2
 import collections
 
 from djdd import constants
 from djdd import exceptions
+from djdd import trace
+from djdd import streams
+from djdd.sessions import SessionPool, overlay_session
+from djdd.variantstore import open_variant_store, format_database_connection
+from djdd.sizes import parse_size, format_size
 
 # We're going call our users/groups/directories/etc by this name
 NAMESPACE = "djdd"
 
 logger = logging.getLogger(NAMESPACE)
-logging.basicConfig(level="DEBUG")
 
 urlparse.uses_netloc.append('postgres')
 
-DatabaseConnection = collections.namedtuple("DatabaseConnection", "user,host,port,password,database")
+DatabaseConnection = collections.namedtuple("DatabaseConnection", "user,host,port,password,database,scheme")
+
+# The result of one command run by a batch, duration is in seconds
+BatchStep = collections.namedtuple("BatchStep", "cmd,returncode,output,duration")
 
 
 ################################################################################
@@ -29,15 +38,26 @@ DatabaseConnection = collections.namedtuple("DatabaseConnection", "user,host,por
 
 
 def sudo(cmd, user=None, group=None):
-    """ call the given arguments with sudo. """
+    """ call the given arguments with sudo, returning the exit code. """
     args = ['sudo']
     if user:
         args.extend(['-u', user])
     if group:
         args.extend(['-g', group])
     args += cmd
-    print "SUDO call: {}".format(" ".join(args))
-    subprocess.call(args)
+    logger.debug("SUDO call: {}".format(" ".join(args)))
+    with trace.command('sudo', cmd) as record:
+        record['returncode'] = subprocess.call(args)
+    return record['returncode']
+
+
+def sha256_file(filename):
+    """ Returns the sha256 hex digest of the given file's content. """
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
 
 
 class BuildEnvironment(object):
@@ -63,6 +83,10 @@ class BuildEnvironment(object):
         self.root_dir = os.path.join(self.dir, "debootstrap_root")
         self.debootstrap_complete = os.path.join(self.dir, "debootstrap_complete")
         self.log_dir = os.path.join(self.dir, "logs")
+        self.session_dir = os.path.join(self.dir, "sessions")
+        self.package_dir = os.path.join(self.dir, "packages")
+        self.overlay_dir = os.path.join(self.dir, "overlays")
+        self.overlay_fstab = os.path.join(self.dir, "overlay.fstab")
 
         self.has_config_link = os.path.lexists(self.schroot_config_link)
         self.has_config = os.path.exists(self.schroot_config_link)
@@ -70,7 +94,11 @@ class BuildEnvironment(object):
         self.schroot_config_filename = None
         self.name = None
 
-        # Variant database
+        # Variant database, as given to the init command unless given here
+        self.database_setting = os.path.join(self.dir, "variant_database")
+        if variant_database is None and os.path.exists(self.database_setting):
+            with open(self.database_setting) as f:
+                variant_database = f.read().strip()
         self.variant_database = self.parse_database_uri(variant_database or constants.DEFAULT_DATABASE)
 
         # If we have a symlink, we can use it to get the filename for the config
@@ -97,34 +125,45 @@ class BuildEnvironment(object):
 
     def parse_database_uri(self, database):
         """ Parse and validate the database string.
+            "sqlite:///path/to/file" uses an SQLite file, "sqlite://" one
+            in the build directory.
         """
         connection_string = database or constants.DEFAULT_DATABASE
         try:
             uri = urlparse.urlparse(connection_string)
             db_name = uri.path.strip("/")
-            connection = DatabaseConnection(user=uri.username,
-                    host=uri.hostname, port=uri.port, password=uri.password, database=db_name)
+            if uri.scheme == "sqlite":
+                db_name = os.path.abspath(uri.path if uri.path.strip("/") else os.path.join(self.dir, "variants.sqlite3"))
+            connection = DatabaseConnection(user=uri.username, host=uri.hostname, port=uri.port,
+                    password=uri.password, database=db_name, scheme=uri.scheme)
         except ValueError, e:
             msg = "Could not parse database connection string \"{}\":\n{}".format(connection_string, e)
             raise exceptions.BuildEnvironmentError(msg, self)
-        if uri.scheme != "postgres":
-            msg = "Only postgres:// database connection strings are accepted, not \"{}\"".format(connection_string)
+        if uri.scheme not in ("postgres", "sqlite"):
+            msg = "Only postgres:// and sqlite:// database connection strings are accepted, not \"{}\"".format(connection_string)
             raise exceptions.BuildEnvironmentError(msg, self)
         if not db_name:
             msg = "No database name provided (as path) \"{}\"".format(connection_string)
             raise exceptions.BuildEnvironmentError(msg, self)
         return connection
 
+    @property
+    def variants(self):
+        """ The variant database (see djdd.variantstore.VariantStore). """
+        return open_variant_store(self.variant_database)
+
     @property
     def conn(self):
-        """ Returns the current database connection.
+        """ Returns a (postgres) database connection of this build environment's own.
             If none exists, one will be created on the first call.
+            Prefer self.variants, which shares pooled connections.
         """
         try:
             return self._conn
         except AttributeError:
             pass
 
+        import psycopg2
         db = self.variant_database
         try:
             self._conn = psycopg2.connect(database=db.database, host=db.host, port=db.port, user=db.user, password=db.password)
@@ -138,7 +177,10 @@ class BuildEnvironment(object):
         """
         logger.debug("Creating varient database")
         # If it is a local database, create it
-        if self.variant_database.host in ("localhost", None):
+        if self.variant_database.scheme == "sqlite":
+            if not os.path.exists(os.path.dirname(self.variant_database.database)):
+                os.makedirs(os.path.dirname(self.variant_database.database))
+        elif self.variant_database.host in ("localhost", None):
             # create the postgres database if not exists
             db_name = self.variant_database.database
             output = subprocess.check_output(['psql', '-l']).splitlines()
@@ -148,27 +190,8 @@ class BuildEnvironment(object):
                 # TODO If that doesn't work, tell the user what to run and exit
 
         # Create the tables we need, if needed
-        # 'id' is globally unique, so that eg port numbers are unique across
-        #      varants AND software titles.
-        # 'software' is only a name so far, avoid extra table with denormalised form
-        query = """
-        CREATE TABLE IF NOT EXISTS variant (
-             id integer PRIMARY KEY,
-             software character varying(50),
-             key character varying(50) NOT NULL,
-             name character varying(100) NOT NULL,
-             subdomain character varying(50) UNIQUE NOT NULL,
-             postgres_name character varying(50) UNIQUE NOT NULL,
-             elasticsearch_name character varying(50) UNIQUE NOT NULL,
-             redis_number integer UNIQUE NOT NULL,
-             gunicorn_port integer UNIQUE NOT NULL,
-             UNIQUE (software, key)
-        );
-        COMMIT;
-        """
         logger.debug("Creating database tables")
-        curs = self.conn.cursor()
-        curs.execute(query)
+        self.variants.create_tables()
 
         if not self.variant_database_exists():
             # TODO If that didn't work, tell the user what to run and exit
@@ -189,37 +212,13 @@ class BuildEnvironment(object):
                 'gunicorn_port': 4001,
             }]
         """
-        query = """
-                SELECT
-                    software, id, key, name, subdomain, postgres_name,
-                    elasticsearch_name, redis_number, gunicorn_port
-                FROM variant
-                ORDER BY key
-                """
-        curs = self.conn.cursor()
-        curs.execute(query)
-        results = curs.fetchall()
-        headers = ('software', 'id', 'key', 'name', 'subdomain', 'postgres_name', 'elasticsearch_name', 'redis_number', 'gunicorn_port')
-        for result in results:
-            yield dict(zip(headers, result))
+        return iter(self.variants.list_variant_infos())
 
     def variant_database_exists(self):
         """ Checks if we can connect to the db, the table exists, and we
             have access to it.
         """
-
-        query = """
-            SELECT EXISTS (
-               SELECT 1
-               FROM   information_schema.tables
-               WHERE  table_schema = 'public'
-               AND    table_name = 'variant'
-            );
-        """
-        curs = self.conn.cursor()
-        curs.execute(query)
-        result = curs.fetchone()[0]
-        return result
+        return self.variants.variant_table_exists()
 
     def get_variant_info(self, software, variant):
         """ Get the variant information from the variant database.
@@ -236,38 +235,47 @@ class BuildEnvironment(object):
                 'gunicorn_port': 4001,
             }
         """
-        query = """
-                SELECT
-                    software, id, key, name, subdomain, postgres_name,
-                    elasticsearch_name, redis_number, gunicorn_port
-                FROM variant
-                WHERE software = %s AND key = %s
-                """
-        curs = self.conn.cursor()
-        curs.execute(query, (software, variant,))
-        results = curs.fetchone()
-        headers = ('software', 'id', 'key', 'name', 'subdomain', 'postgres_name', 'elasticsearch_name', 'redis_number', 'gunicorn_port')
-        if results:
-            return dict(zip(headers, results))
+        return self.variants.get_variant_info(software, variant)
 
     def set_variant_info(self, software, variant, info):
         """ Sets variant information in the variant datbase.
             info is a dict as provided by self.get_variant_info().
         """
-        query = """INSERT INTO variant
-                    (software, id, key, name, subdomain, postgres_name,
-                     elasticsearch_name, redis_number, gunicorn_port)
-                VALUES
-                    (%s, %s, %s, %s, %s, %s,
-                     %s, %s, %s);
-                COMMIT;
-                """
-        vars =  (software, info["id"], variant, info["name"], info["subdomain"], info["postgres_name"],
-                 info["elasticsearch_name"], info["redis_number"], info["gunicorn_port"])
-        curs = self.conn.cursor()
-        curs.execute(query, vars)
-        # XXX Check that it worked
-        return True
+        return self.variants.set_variant_info(software, variant, info)
+
+    def create_artifact_table(self):
+        """ Create the index of built artifacts, if it doesn't exist.
+            Each artifact is identified by the build stage that produced it
+            and a hash of that stage's inputs.
+        """
+        self.variants.create_artifact_table()
+
+    def get_artifact(self, software, stage, input_hash):
+        """ Get an artifact from the artifact index.
+            Returns a dict eg.
+            {
+                'software': 'mysoftware',
+                'stage': 'env',
+                'input_hash': 'f9e8d7c6b5a4',
+                'path': '/var/lib/djdd/build/packages/mysoftware-env-f9e8d7c6b5a4.deb',
+                'size': 48213423,
+                'duration': 912.5,
+                'requires': [],
+            }
+        """
+        return self.variants.get_artifact(software, stage, input_hash)
+
+    def list_artifacts(self, software):
+        """ Get all artifacts of the given software from the artifact index,
+            as dicts like those from self.get_artifact().
+        """
+        return iter(self.variants.list_artifacts(software))
+
+    def set_artifact(self, software, stage, input_hash, path, size, duration, requires=()):
+        """ Records a built artifact in the artifact index, replacing any
+            earlier artifact for the same stage and inputs.
+        """
+        return self.variants.set_artifact(software, stage, input_hash, path, size, duration, requires)
 
     def get_next_variant_id(self):
         """ Returns an integer: the possible variant ID for the next variant.
@@ -275,15 +283,21 @@ class BuildEnvironment(object):
             your variant. This is only a possible variant ID; the eventual
             call to self.set_variant_info() might fail, so you would need to
             get a new variant ID and try again.
+            self.allocate_variants() doesn't have this problem.
 
             We could have a unique variant ID per software,
             but we won't.
         """
-        query = "SELECT MAX(id) from variant;"
-        curs = self.conn.cursor()
-        curs.execute(query)
-        vid = curs.fetchone()
-        return (vid[0] or 0) + 1
+        return self.variants.get_next_variant_id()
+
+    def allocate_variants(self, software, variants, ranges=None):
+        """ Adds variants to the variant database, atomically allocating
+            their id, redis number and gunicorn port.
+            `variants` is a list of (key, name) pairs, returns a list of
+            dicts as provided by self.get_variant_info().
+            See djdd.variantstore.VariantStore.allocate_variants().
+        """
+        return self.variants.allocate_variants(software, variants, ranges)
 
     def get_name_from_config(self):
         """ Uses the name in the schroot configuration file. """
@@ -296,6 +310,21 @@ class BuildEnvironment(object):
         if match:
             return match.group(1)
 
+    @property
+    def overlay_name(self):
+        """ The name of the schroot chroot for isolated (overlay) sessions. """
+        return "{}_overlay".format(self.name)
+
+    def has_overlay_config(self):
+        """ Checks if the installed configuration has the overlay chroot
+            (environments installed by older versions don't).
+        """
+        if not self.has_config:
+            return False
+        with open(self.schroot_config_filename) as f:
+            content = f.read()
+        return self.overlay_name in self.RE_CONFIG_NAME.findall(content)
+
     def check_configuration_linked(self):
         """ Checks that the configuration is linked to this directory before
             attempting to access it via schroot.
@@ -310,19 +339,50 @@ class BuildEnvironment(object):
             raise ValueError("Configuration does not match build directory.\n"
                     "Has the directory been moved? Rerun the install command as root.")
 
+    @property
+    def sessions(self):
+        """ The pool of warm schroot sessions for this build environment. """
+        try:
+            return self._sessions
+        except AttributeError:
+            self._sessions = SessionPool(self)
+            return self._sessions
+
     @contextlib.contextmanager
-    def chroot(self):
+    def chroot(self, isolated=False):
         """ Context manager for running (multiple) commands in a chroot.
             This takes care of subprocess calls and chroot session management.
+            Sessions are leased from the pool and left open for the next caller.
+
+            An isolated chroot is a new overlay session: changes to the root
+            (eg. installed debian packages) are only seen by this session and
+            are thrown away when it ends. /var/lib/djdd and /var/cache/djdd
+            are shared with the build environment, so builds still see
+            their repositories, packages and caches.
         """
         self.check_configuration_linked()
-        chroot_session = 'session:{}'.format(subprocess.check_output(['schroot', '--chroot', self.name, '--begin-session']).decode("ascii").strip())
-        cmd_schroot = ['schroot', '--chroot', chroot_session, '--run-session', '--directory', '/']
-        def call(cmd, shell=False, root=False, capture_output=False, env=None):
-            if capture_output:
-                subprocess_fn = functools.partial(subprocess.check_output, stderr=subprocess.STDOUT)
-            else:
-                subprocess_fn = subprocess.call
+        if isolated:
+            if not self.has_overlay_config():
+                raise exceptions.BuildEnvironmentError("This build environment has no overlay chroot for "
+                        "isolated builds, rerun the install command to add it.", self)
+            with overlay_session(self) as chroot_session:
+                yield self._session_call(chroot_session)
+        else:
+            with self.sessions.lease() as chroot_session:
+                yield self._session_call(chroot_session)
+
+    def _session_call(self, chroot_session):
+        """ Returns a function for running commands in the given schroot session. """
+        cmd_schroot = [constants.SCHROOT, '--chroot', chroot_session, '--run-session', '--directory', '/']
+        def call(cmd, shell=False, root=False, capture_output=False, env=None, tail=None, timeout=None):
+            """ Runs the command in the chroot, its output is streamed to the
+                console (and the command log, see djdd.streams).
+                Returns the exit code, or with capture_output the output
+                instead of printing it (raising CalledProcessError if the
+                command fails). With tail, only that many of the last lines
+                of output are returned. A command running for longer than
+                `timeout` seconds is killed, raising CommandTimeout.
+            """
             extra_args = []
             if root:
                 extra_args.extend(["--user", "root"])
@@ -334,14 +394,140 @@ class BuildEnvironment(object):
                 full_cmd = ' '.join(cmd_schroot + extra_args) + ' /bin/sh -c \'{}\''.format(escaped_cmd)
             else:
                 full_cmd = cmd_schroot + extra_args + cmd
-            return subprocess_fn(full_cmd, shell=shell, env=env)
-
-        try:
-            yield call
-        except:
-            raise
-        finally:
-            subprocess.call(['schroot', '--chroot', chroot_session, '--end-session', '--force'])
+            streams.write_line("+ {}\n".format(trace.format_cmd(cmd)), echo=False)
+            with trace.command('chroot', cmd) as record:
+                result = streams.run(full_cmd, shell=shell, env=env, echo=not capture_output, tail=tail,
+                                     timeout=timeout)
+                record.update(returncode=result.returncode, output_size=result.size)
+            if not capture_output:
+                return result.returncode
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, full_cmd, result.output)
+            return result.output
+
+        def parallel(cmds, root=False, env=None, jobs=None, timeout=None, quiet=True,
+                     tail=constants.OUTPUT_TAIL_LINES, labels=None):
+            """ Runs the given commands (lists or shell strings) at the same
+                time, up to `jobs` at once, each in its own schroot invocation
+                of this session but without a thread for each. Their output
+                is logged (prefixed with their labels, if given).
+                Returns a CommandOutput (see djdd.streams) for each command.
+                Raises CommandTimeout once all have finished if one of them
+                was killed for running longer than `timeout` seconds.
+            """
+            extra_args = []
+            if root:
+                extra_args.extend(["--user", "root"])
+            if env:
+                extra_args.append("-p")
+            extra_args.append("--")
+            full_cmds = []
+            for cmd in cmds:
+                streams.write_line("+ {}\n".format(trace.format_cmd(cmd)), echo=False)
+                if isinstance(cmd, basestring):
+                    cmd = ['/bin/sh', '-c', cmd]
+                full_cmds.append(cmd_schroot + extra_args + cmd)
+            try:
+                results = streams.run_many(full_cmds, env=env, jobs=jobs, timeout=timeout, echo=not quiet,
+                                           tail=tail, labels=labels)
+            except exceptions.CommandTimeout as e:
+                e.cmd = cmds[full_cmds.index(e.cmd)]
+                raise
+            for cmd, result in zip(cmds, results):
+                trace.record_command('chroot', cmd, result.returncode, result.size, result.started, result.duration)
+            return results
+
+        def batch(cmds, root=False, stop_on_error=True, quiet=False, env=None, check=False,
+                  tail=constants.OUTPUT_TAIL_LINES):
+            """ Runs the given commands (lists or shell strings) in order in a
+                single schroot invocation, returning a BatchStep for each
+                command that was run. With stop_on_error, no further commands
+                are run after the first one that fails. With check, a
+                ChrootCommandError is raised for the first failed step.
+                A ChrootCommandError is always raised if schroot fails before
+                all steps (up to a failed one with stop_on_error) were run.
+                The output of each step is logged, but only the last `tail`
+                lines are kept in its BatchStep (all of it if tail is None).
+            """
+            if not cmds:
+                return []
+            extra_args = []
+            if root:
+                extra_args.extend(["--user", "root"])
+            if env:
+                extra_args.append("-p")
+            extra_args.append("--")
+            marker = "DJDD-BATCH-{}".format(uuid.uuid4().hex)
+            script = [format_batch_step(i, cmd, marker, stop_on_error) for i, cmd in enumerate(cmds)]
+            with trace.command('batch', "batch of {} commands".format(len(cmds))) as record:
+                scope = streams.current_scope()
+                proc = scope.start(cmd_schroot + extra_args + ['/bin/sh', '-c', "\n".join(script)], env=env)
+                steps = []
+                lines = None
+                # Output outside of the steps, eg. schroot's errors
+                outside = collections.deque(maxlen=tail)
+                total_size = 0
+                try:
+                    for line in iter(proc.stdout.readline, ''):
+                        if line.startswith(marker):
+                            fields = line.split()
+                            if fields[1] == "start":
+                                streams.write_line("+ {}\n".format(trace.format_cmd(cmds[int(fields[2])])), echo=False)
+                                lines = collections.deque(maxlen=tail)
+                                pending = None
+                                size = 0
+                                started = time.time()
+                            else:
+                                # The end marker is always preceded by an extra newline
+                                output = "".join(lines)[:-1]
+                                steps.append(BatchStep(cmds[int(fields[2])], int(fields[3]), output, time.time() - started))
+                                trace.record_step(steps[-1].cmd, steps[-1].returncode, size - 1, steps[-1].duration)
+                                total_size += size - 1
+                                lines = None
+                            continue
+                        if lines is None:
+                            streams.write_line(line, echo=not quiet)
+                            outside.append(line)
+                            continue
+                        # Empty lines are written once the next line arrives, so
+                        # that the newline before the end marker can be left out
+                        if pending:
+                            streams.write_line(pending, echo=not quiet)
+                        pending = line if line == "\n" else None
+                        if pending is None:
+                            streams.write_line(line, echo=not quiet)
+                        lines.append(line)
+                        size += len(line)
+                except BaseException:
+                    streams.kill(proc)
+                    raise
+                finally:
+                    returncode = scope.finish(proc)
+                if scope.cancelled:
+                    raise exceptions.CommandCancelled(cmds[min(len(steps), len(cmds) - 1)], build_env=self)
+                # schroot itself failed, or the shell was killed mid-command
+                if lines is not None:
+                    if pending:
+                        streams.write_line(pending, echo=not quiet)
+                    steps.append(BatchStep(cmds[len(steps)], returncode or -1, "".join(lines), time.time() - started))
+                    trace.record_step(steps[-1].cmd, steps[-1].returncode, size, steps[-1].duration)
+                    total_size += size
+                record.update(returncode=returncode, output_size=total_size)
+                # schroot (or the shell) failed before running the remaining steps,
+                # without one of them having failed and stopped the batch
+                stopped = stop_on_error and steps and steps[-1].returncode != 0
+                if returncode != 0 and len(steps) < len(cmds) and not stopped:
+                    raise exceptions.ChrootCommandError(cmds[len(steps)], returncode, "".join(outside),
+                                                        build_env=self)
+            if check:
+                for step in steps:
+                    if step.returncode != 0:
+                        raise exceptions.ChrootCommandError(step.cmd, step.returncode, step.output, build_env=self)
+            return steps
+
+        call.parallel = parallel
+        call.batch = batch
+        return call
 
     def ext_filename(self, filename):
         return os.path.join(self.root_dir, filename.lstrip("/"))
@@ -362,15 +548,23 @@ class BuildEnvironment(object):
         new_env = {k: os.environ[k] for k in preserve_envs}
         new_env['SSH_AUTH_SOCK'] = SSH_AUTH_SOCK
         new_env['SSH_AGENT_PID'] = SSH_AGENT_PID
-        def ssh_call(cmd, shell=False, root=False, capture_output=False, env=None):
-            if env is not None:
-                _env = env.copy()
-                _env['SSH_AUTH_SOCK'] = SSH_AUTH_SOCK
-                _env['SSH_AGENT_PID'] = SSH_AGENT_PID
-            else:
-                _env = new_env
-
-            return call_fn(cmd, shell=shell, root=root, capture_output=capture_output, env=_env)
+        def agent_env(env):
+            if env is None:
+                return new_env
+            _env = env.copy()
+            _env['SSH_AUTH_SOCK'] = SSH_AUTH_SOCK
+            _env['SSH_AGENT_PID'] = SSH_AGENT_PID
+            return _env
+
+        def ssh_call(cmd, shell=False, root=False, capture_output=False, env=None, tail=None, timeout=None):
+            with trace.via('ssh'):
+                return call_fn(cmd, shell=shell, root=root, capture_output=capture_output, env=agent_env(env),
+                               tail=tail, timeout=timeout)
+
+        def parallel(cmds, env=None, **kwargs):
+            with trace.via('ssh'):
+                return call_fn.parallel(cmds, env=agent_env(env), **kwargs)
+        ssh_call.parallel = parallel
 
         ssh_call(['ssh-add', identity_file], capture_output=True, env=new_env)
         try:
@@ -383,16 +577,19 @@ class BuildEnvironment(object):
             os.chmod(self.ext_filename(identity_file), 0o2770) # 770 == ug+rwx,o-rwx
 
 
-def format_database_connection(db):
-    if db:
-        if db.user:
-            user = db.user + (":XXXXX" if db.password else "") + "@"
-        else:
-            user = ""
-        if db.port:
-            port = ":{}".format(db.port)
-        else:
-            port = ""
-        return "postgres://{user}{db.host}{port}/{db.database}".format(user=user, db=db, port=port)
-    else:
-        return "invalid/unconfigured"
+def format_batch_step(index, cmd, marker, stop_on_error):
+    """ Returns the shell script fragment for one step of a chroot batch.
+        Each step is wrapped in markers so that the output can be split up
+        again as it is read.
+    """
+    if not isinstance(cmd, basestring):
+        cmd = " ".join(pipes.quote(arg) for arg in cmd)
+    lines = [
+        "echo {} start {}".format(marker, index),
+        "( {}\n) </dev/null".format(cmd),
+        "rc=$?",
+        "printf '\\n{} end {} %d\\n' $rc".format(marker, index),
+    ]
+    if stop_on_error:
+        lines.append('[ $rc -eq 0 ] || exit $rc')
+    return "\n".join(lines)
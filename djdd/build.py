@@ -0,0 +1,877 @@
+# encoding: utf8
+import os
+import sys
+import time
+import fcntl
+import pipes
+import shutil
+import hashlib
+import contextlib
+import subprocess
+
+from djdd.base import BuildEnvironment
+from djdd.fetch import FetchCoordinator, list_repositories, read_ref, RE_COMMIT
+from djdd.scheduler import Stage, run_stages
+from djdd.wheels import Wheelhouse
+from djdd.aptcache import apt_install
+from djdd.debdeps import plan_debian_depends, check_plan
+from djdd.requirements import (requirements_hash, normalize_requirements, read_requirements,
+                               read_normalized_requirements, is_package_name)
+from djdd import trace
+from djdd import debfile
+from djdd import streams
+from djdd import constants
+from djdd import exceptions
+
+
+def build_site(dir, software, variant=None, version=None, settings=None,
+               venv_depends="venv-debian-depends.txt", src_depends="src-debian-depends.txt",
+               variant_database=None, jobs=None, isolated=False, report=None):
+    """ Builds the env, src and site packages for the given software, variant
+        and version. Packages that have already been built are not rebuilt.
+        Returns a dict with the filenames of the three packages.
+        The commands run are traced in the log directory (see djdd.trace),
+        where their output is logged too (see djdd.streams).
+        `report` is called as each stage starts and finishes, see
+        djdd.scheduler.run_stages() (by default progress is printed).
+
+        An isolated build runs in its own overlay chroot, so its debian
+        packages are installed without waiting for (or affecting) other builds.
+
+        If the packages of the version have all been built before, nothing
+        else is done. A branch or tag is only resolved without a fetch while
+        the mirrors are fresh (see Build.resolve_version()).
+    """
+    build_env = BuildEnvironment(dir, variant_database)
+    build_env.create_artifact_table()
+    build = Build(build_env, software, variant, version, settings, venv_depends, src_depends, isolated)
+
+    # If everything for this version has already been built, we're done
+    commit = build.resolve_version()
+    if commit is not None:
+        packages = build.cached_packages(commit)
+        if packages is not None:
+            return packages
+
+    # Isolated builds only need the debian packages of the base root not to
+    # change underneath them, other builds take the lock while installing them
+    # (see Build.base_root_lock())
+    name = " ".join(["build", software] + ([variant] if variant else []))
+    with trace.tracing(build_env.log_dir, name), streams.command_log(build_env.log_dir, name):
+        with apt_lock(build_env, shared=True) if isolated else no_lock():
+            with build_env.chroot(isolated=isolated) as call:
+                build.call = call
+                values = run_stages(build.stages(), jobs=jobs, report=report or report_stage)
+    return {
+        'env': values['env_package'],
+        'src': values['src_package'],
+        'site': values['site_package'],
+    }
+
+
+def build_sites(dir, software, variants=None, version=None, settings=None,
+                venv_depends="venv-debian-depends.txt", src_depends="src-debian-depends.txt",
+                variant_database=None, jobs=None, isolated=False, report=None):
+    """ Builds the site packages of several variants of the given software
+        (by default all of them) for one version, like build_site(). The
+        env and src packages (and the static files) are built once, then
+        the site packages are built up to `jobs` at the same time.
+        Returns a dict with the filenames of the env and src packages, and
+        a dict of the site package of each variant, eg.
+        {'env': ..., 'src': ..., 'sites': {'berlin': ..., 'paris': ...}}
+    """
+    build_env = BuildEnvironment(dir, variant_database)
+    build_env.create_artifact_table()
+    infos = dict((info['key'], info) for info in build_env.list_variant_infos() if info['software'] == software)
+    if variants is None:
+        variants = sorted(infos)
+    unknown = [variant for variant in variants if variant not in infos]
+    if unknown:
+        raise exceptions.BuildError("Unknown variants of {}: {}, add them with the variant command.".format(
+                                    software, ", ".join(unknown)), build_env)
+    if not variants:
+        raise exceptions.BuildError("{} has no variants, add them with the variant command.".format(software),
+                                    build_env)
+
+    builds = []
+    for variant in variants:
+        build = Build(build_env, software, variant, version, settings, venv_depends, src_depends, isolated)
+        build._variant_info = infos[variant]
+        builds.append(build)
+
+    commit = builds[0].resolve_version()
+    if commit is not None:
+        cached = [build.cached_packages(commit) for build in builds]
+        if all(packages is not None for packages in cached):
+            return {
+                'env': cached[0]['env'],
+                'src': cached[0]['src'],
+                'sites': dict((build.variant, packages['site']) for build, packages in zip(builds, cached)),
+            }
+
+    stages = variants_stages(builds)
+    name = "build {} {} variants".format(software, len(builds))
+    with trace.tracing(build_env.log_dir, name), streams.command_log(build_env.log_dir, name):
+        with apt_lock(build_env, shared=True) if isolated else no_lock():
+            with build_env.chroot(isolated=isolated) as call:
+                for build in builds:
+                    build.call = call
+                values = run_stages(stages, jobs=jobs, report=report or report_stage)
+    return {
+        'env': values['env_package'],
+        'src': values['src_package'],
+        'sites': dict((build.variant, values['site_package:' + build.variant]) for build in builds),
+    }
+
+
+def variants_stages(builds):
+    """ The stages building the given builds (of variants of one version):
+        the first build's stages build everything but its site package,
+        then there is a site package stage for each build.
+    """
+    stages = [stage for stage in builds[0].stages() if stage.name != 'site-package']
+    stages.extend(site_package_stage(build) for build in builds)
+    return stages
+
+
+def site_package_stage(build):
+    """ The site-package stage of the given build, named (and providing a
+        value named) after its variant, eg. "site-package:berlin", so that
+        the site packages of several variants are built by one run of stages.
+    """
+    output = "site_package:" + build.variant
+
+    def rename(result):
+        if result is not None:
+            return {output: result['site_package']}
+
+    return Stage("site-package:" + build.variant, lambda **kwargs: rename(build.site_package(**kwargs)),
+                 inputs=('static_dir', 'env_hash', 'commit'), outputs=(output,),
+                 done=lambda **kwargs: rename(build.site_package_done(**kwargs)))
+
+
+def plan_build(dir, software, variant=None, version=None, settings=None, variant_database=None,
+               venv_depends="venv-debian-depends.txt", src_depends="src-debian-depends.txt"):
+    """ Shows what a build would do, without opening a chroot.
+        Returns a list of (package kind, action, detail) tuples, where action
+        is "cached" (detail is the package filename), "build" (detail is
+        the package name) or "unknown" (detail explains why).
+        If the version has been checked out, the first tuple is for the
+        debian depends ("deb"), with action "ok", "install" or "conflict".
+    """
+    build_env = BuildEnvironment(dir, variant_database)
+    build_env.create_artifact_table()
+    return Build(build_env, software, variant, version, settings, venv_depends, src_depends).plan()
+
+
+def report_stage(name, status, duration):
+    if duration is None:
+        line = "[{}] {}".format(name, status)
+    else:
+        line = "[{}] {} in {:.1f}s".format(name, status, duration)
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def read_debian_depends(filename):
+    """ Returns the package names listed in a debian depends file, if it exists. """
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [name for line in f for name in line.split("#", 1)[0].split()]
+
+
+def apt_lock(build_env, shared=False):
+    """ Builds that install debian packages in the base root wait for each
+        other, and for isolated builds (which hold the lock shared, as an
+        overlay's base must not change while it is mounted).
+    """
+    return file_lock(os.path.join(build_env.dir, "apt.lock"), shared)
+
+
+def path_lock(build_env, path):
+    """ Builds that write the same tree of the base root (eg. a virtualenv
+        in /usr/lib) wait for each other, builds writing other trees don't.
+    """
+    lock_dir = os.path.join(build_env.dir, "locks")
+    try:
+        os.makedirs(lock_dir)
+    except OSError:
+        if not os.path.isdir(lock_dir):
+            raise
+    return file_lock(os.path.join(lock_dir, path.strip("/").replace("/", "_") + ".lock"))
+
+
+@contextlib.contextmanager
+def file_lock(filename, shared=False):
+    with open(filename, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def replace_path_cmd(directory, old, new):
+    """ A shell command that replaces the path `old` with `new` in the text
+        files in the given directory.
+    """
+    def escape(text, special):
+        return "".join("\\" + c if c in special else c for c in text)
+    program = "s#{}#{}#g".format(escape(old, "\\#.*[]^$"), escape(new, "\\#&"))
+    return "grep -rlIZ -F -e {old} {directory} | xargs -0 -r sed -i -e {program}".format(
+            old=pipes.quote(old), directory=pipes.quote(directory), program=pipes.quote(program))
+
+
+@contextlib.contextmanager
+def no_lock():
+    yield
+
+
+class Build(object):
+    """ The stages for building the packages of one version of a software.
+
+        Everything happens in the build environment under
+        /var/lib/djdd/{software}/, and the finished packages are copied to
+        the packages/ directory of the build environment.
+        The stages are run by djdd.scheduler.run_stages(), `call` must be set
+        to a function from BuildEnvironment.chroot() beforehand.
+        For an isolated build, that must be an isolated chroot.
+    """
+    def __init__(self, build_env, software, variant=None, version=None, settings=None,
+                 venv_depends="venv-debian-depends.txt", src_depends="src-debian-depends.txt",
+                 isolated=False):
+        self.build_env = build_env
+        self.software = software
+        self.variant = variant
+        self.version = version
+        self.settings = settings
+        self.venv_depends = venv_depends
+        self.src_depends = src_depends
+        self.isolated = isolated
+        self.software_dir = '/var/lib/{namespace}/{name}'.format(namespace=build_env.NAMESPACE, name=software)
+        self.wheelhouse = Wheelhouse(build_env)
+        self.call = None
+
+    def path(self, *parts):
+        return os.path.join(self.software_dir, *parts)
+
+    def base_root_lock(self):
+        """ Held while installing debian packages. Isolated builds hold it
+            shared for their whole run, as their overlay's base must not
+            change, and change their overlay only.
+        """
+        return no_lock() if self.isolated else apt_lock(self.build_env)
+
+    def tree_lock(self, path):
+        """ Held while writing a tree of the root outside of /var/lib/djdd
+            (eg. a virtualenv in /usr/lib), so that builds writing other trees
+            (or building wheels) don't wait.
+        """
+        return no_lock() if self.isolated else path_lock(self.build_env, path)
+
+    def stages(self):
+        return [
+            Stage('fetch', self.fetch, outputs=('repository_dir', 'commit')),
+            Stage('checkout', self.checkout, inputs=('repository_dir', 'commit'),
+                    outputs=('checkout_dir', 'env_hash'), done=self.checkout_done),
+            Stage('debian-depends', self.install_debian_depends, inputs=('checkout_dir',),
+                    outputs=('debian_depends',)),
+            Stage('env-package', self.env_package, inputs=('checkout_dir', 'env_hash', 'debian_depends'),
+                    outputs=('env_package',), done=self.env_package_done),
+            Stage('src-package', self.src_package, inputs=('checkout_dir', 'commit', 'env_hash'),
+                    outputs=('src_package',), done=self.src_package_done),
+            Stage('collectstatic', self.collectstatic,
+                    inputs=('env_package', 'src_package', 'env_hash', 'commit', 'debian_depends'),
+                    outputs=('static_dir',), done=self.collectstatic_done),
+            Stage('site-package', self.site_package, inputs=('static_dir', 'env_hash', 'commit'),
+                    outputs=('site_package',), done=self.site_package_done),
+        ]
+
+    ############################################################################
+    # Names and paths
+    ############################################################################
+
+    def short(self, commit):
+        return commit[:constants.HASH_LENGTH]
+
+    def env_package_name(self, env_hash):
+        return "{}-env-{}".format(self.software, env_hash)
+
+    def src_package_name(self, commit):
+        return "{}-src-{}".format(self.software, self.short(commit))
+
+    def site_package_name(self):
+        if self.variant:
+            return "{}-site-{}".format(self.software, self.variant)
+        return "{}-site".format(self.software)
+
+    def env_dir(self, env_hash):
+        return "/usr/lib/{}-env/{}".format(self.software, env_hash)
+
+    def src_dir(self, commit):
+        return "/usr/lib/{}-src/{}".format(self.software, self.short(commit))
+
+    def package_filename(self, name):
+        """ The filename of a finished package, on the host. """
+        return os.path.join(self.build_env.package_dir, "{}.deb".format(name))
+
+    def variant_info(self):
+        try:
+            return self._variant_info
+        except AttributeError:
+            pass
+        self._variant_info = None
+        if self.variant:
+            self._variant_info = self.build_env.get_variant_info(self.software, self.variant)
+        return self._variant_info
+
+    def site_input_hash(self, commit):
+        """ The site package depends on the version (which decides the env
+            and src packages), the settings and the variant's information.
+        """
+        def text(value):
+            return value.decode("utf-8") if isinstance(value, str) else u"{}".format(value)
+
+        info = self.variant_info() or {}
+        parts = [text(self.software), text(self.variant or ""), text(commit), text(self.settings or "")]
+        parts.extend(u"{}={}".format(text(k), text(v)) for k, v in sorted(info.items()))
+        return hashlib.sha1(u"\0".join(parts).encode("utf-8")).hexdigest()[:constants.HASH_LENGTH]
+
+    ############################################################################
+    # Artifact index
+    ############################################################################
+
+    def lookup_artifact(self, stage, input_hash):
+        """ Returns the indexed artifact if its package still exists, otherwise None. """
+        artifact = self.build_env.get_artifact(self.software, stage, input_hash)
+        if artifact is not None and os.path.exists(artifact['path']):
+            return artifact
+
+    def record_artifact(self, stage, input_hash, filename, started, requires=()):
+        self.build_env.set_artifact(self.software, stage, input_hash, filename,
+                                    os.path.getsize(filename), time.time() - started, requires)
+
+    def cached_packages(self, commit):
+        """ Returns the filenames of the packages for the given commit if
+            they have all been built before, otherwise None.
+        """
+        site = self.lookup_artifact('site', self.site_input_hash(commit))
+        if site is None:
+            return None
+        packages = {'site': site['path']}
+        for requirement in site['requires']:
+            stage, input_hash = requirement.split(":", 1)
+            artifact = self.lookup_artifact(stage, input_hash)
+            if artifact is None:
+                return None
+            packages[stage] = artifact['path']
+        return packages
+
+    def resolve_version(self):
+        """ Returns the commit of the requested version, read from the
+            mirrors on the host, or None if it can't be read without a fetch.
+            A commit hash is returned as it is. A branch or tag is only read
+            while all the mirrors are fresh, as fetch() won't fetch them
+            then, otherwise it may have moved. Without a version, HEAD is
+            always fetched first.
+        """
+        if not self.version:
+            return None
+        repositories = list_repositories(self.build_env, self.software)
+        if not RE_COMMIT.match(self.version):
+            fetcher = FetchCoordinator(self.build_env, self.call)
+            for repository_dir in repositories:
+                last = fetcher.last_fetched(repository_dir)
+                if last is None or time.time() - last >= fetcher.freshness:
+                    return None
+        for repository_dir in repositories:
+            commit = read_ref(self.build_env, repository_dir, self.version)
+            if commit:
+                return commit
+        return None
+
+    def plan(self):
+        """ Works out which packages would be built, from the artifact index
+            and what can be read from the host. See plan_build().
+        """
+        commit = None
+        for repository_dir in list_repositories(self.build_env, self.software):
+            commit = read_ref(self.build_env, repository_dir, self.version or "HEAD")
+            if commit:
+                break
+        if commit is None:
+            reason = "version {} not fetched yet".format(self.version or "HEAD")
+            return [('env', 'unknown', reason), ('src', 'unknown', reason), ('site', 'unknown', reason)]
+
+        plan = []
+        env_hash = None
+        checkout_dir = self.path('checkout', commit)
+        checked_out = os.path.exists(self.build_env.ext_filename(checkout_dir + ".complete"))
+        src = self.lookup_artifact('src', commit)
+        if src is not None:
+            env_hash = [r.split(":", 1)[1] for r in src['requires'] if r.startswith("env:")][0]
+        elif checked_out:
+            env_hash = self.get_env_hash(checkout_dir)
+
+        if checked_out:
+            packages = []
+            for filename in (self.venv_depends, self.src_depends):
+                packages.extend(read_debian_depends(self.build_env.ext_filename(os.path.join(checkout_dir, filename))))
+            depends = plan_debian_depends(self.build_env, packages)
+            if depends.conflicts:
+                plan.append(('deb', 'conflict', "; ".join(depends.conflicts)))
+            elif depends.install:
+                plan.append(('deb', 'install', " ".join(depends.install)))
+            else:
+                plan.append(('deb', 'ok', "{} packages already installed".format(len(depends.satisfied))))
+
+        if env_hash is None:
+            plan.append(('env', 'unknown', "requirements not known before checkout of {}".format(self.short(commit))))
+        else:
+            env = self.lookup_artifact('env', env_hash)
+            if env is not None:
+                plan.append(('env', 'cached', env['path']))
+            else:
+                plan.append(('env', 'build', self.env_package_name(env_hash)))
+        if src is not None:
+            plan.append(('src', 'cached', src['path']))
+        else:
+            plan.append(('src', 'build', self.src_package_name(commit)))
+        site = self.lookup_artifact('site', self.site_input_hash(commit))
+        if site is not None:
+            plan.append(('site', 'cached', site['path']))
+        else:
+            plan.append(('site', 'build', self.site_package_name()))
+        return plan
+
+    ############################################################################
+    # Stages
+    ############################################################################
+
+    def fetch(self):
+        """ Fetches the software's mirrors (if necessary) and finds the
+            repository with the requested version, or HEAD of the first one.
+        """
+        repositories = list_repositories(self.build_env, self.software)
+        if not repositories:
+            raise exceptions.BuildError("No repositories for software \"{}\", "
+                                        "add one with the src command.".format(self.software), self.build_env)
+        # Prepare directories the build user can write to
+        dirs = [self.path(name) for name in ('checkout', 'staging', 'packages', 'static')]
+        self.call.batch([
+            ["mkdir", "-p"] + dirs,
+            ["chown", ":{}".format(self.build_env.build_group)] + dirs,
+            ["chmod", "g+rwX"] + dirs,
+        ] + self.wheelhouse.prepare_cmds(), root=True, check=True, quiet=True)
+
+        # No need for an ssh-agent if we already have the version
+        fetcher = FetchCoordinator(self.build_env, self.call)
+        if not self.version or not any(fetcher.has_commit(r, self.version) for r in repositories):
+            identity_filename = self.path('ssh', 'id_rsa_custom')
+            if not os.path.exists(self.build_env.ext_filename(identity_filename)):
+                identity_filename = self.path('ssh', 'id_rsa')
+            with self.build_env.sshagent(self.call, identity_filename) as ssh_call:
+                FetchCoordinator(self.build_env, ssh_call).fetch_all(repositories, self.version)
+
+        version = self.version or "HEAD"
+        for repository_dir in repositories:
+            try:
+                commit = self.call(["git", "--git-dir", repository_dir, "rev-parse", "--verify", "-q",
+                                    version + "^{commit}"], capture_output=True).strip()
+            except subprocess.CalledProcessError:
+                continue
+            return {'repository_dir': repository_dir, 'commit': commit}
+        raise exceptions.BuildError("Version \"{}\" was not found in any repository".format(version), self.build_env)
+
+    def checkout_done(self, repository_dir, commit):
+        checkout_dir = self.path('checkout', commit)
+        if os.path.exists(self.build_env.ext_filename(checkout_dir + ".complete")):
+            return {'checkout_dir': checkout_dir, 'env_hash': self.get_env_hash(checkout_dir)}
+
+    def checkout(self, repository_dir, commit):
+        """ Exports the version into its own directory. """
+        checkout_dir = self.path('checkout', commit)
+        tmp_dir = checkout_dir + ".tmp"
+        self.call.batch([
+            ["rm", "-rf", tmp_dir, checkout_dir],
+            ["mkdir", "-p", tmp_dir],
+            "git --git-dir {} archive {} | tar -x -C {}".format(
+                pipes.quote(repository_dir), pipes.quote(commit), pipes.quote(tmp_dir)),
+            ["mv", tmp_dir, checkout_dir],
+            ["touch", checkout_dir + ".complete"],
+        ], root=True, check=True, quiet=True)
+        return {'checkout_dir': checkout_dir, 'env_hash': self.get_env_hash(checkout_dir)}
+
+    def get_env_hash(self, checkout_dir):
+        requirements = self.build_env.ext_filename(os.path.join(checkout_dir, "requirements.txt"))
+        if not os.path.exists(requirements):
+            raise exceptions.BuildError("No requirements.txt in this version", self.build_env)
+        return requirements_hash(requirements)
+
+    def install_debian_depends(self, checkout_dir):
+        """ Installs the debian packages needed for the virtualenv and source,
+            in one apt run. apt isn't run (and no lock is taken) if they are
+            all installed already, and conflicts are reported beforehand.
+        """
+        packages = []
+        for filename in (self.venv_depends, self.src_depends):
+            packages.extend(read_debian_depends(self.build_env.ext_filename(os.path.join(checkout_dir, filename))))
+        plan = plan_debian_depends(self.build_env, packages)
+        check_plan(plan, self.build_env)
+        if plan.install:
+            with self.base_root_lock():
+                # Another build may have installed them while we waited
+                if not self.isolated:
+                    plan = plan_debian_depends(self.build_env, packages)
+                    check_plan(plan, self.build_env)
+                if plan.install:
+                    apt_install(self.build_env, self.call, plan.install)
+        return {'debian_depends': packages}
+
+    def env_package_done(self, checkout_dir, env_hash, debian_depends):
+        artifact = self.lookup_artifact('env', env_hash)
+        if artifact is not None:
+            return {'env_package': artifact['path']}
+
+    def env_package(self, checkout_dir, env_hash, debian_depends):
+        """ Builds the virtualenv for the requirements in its final location and packages it.
+            If a virtualenv was built earlier for nearly the same requirements,
+            it is copied and only the differences are installed or uninstalled.
+        """
+        started = time.time()
+        env_dir = self.env_dir(env_hash)
+        share_dir = self.env_share_dir(env_hash)
+        requirements = os.path.join(checkout_dir, "requirements.txt")
+        pip = os.path.join(env_dir, "bin", "pip")
+        cmds = [["rm", "-rf", env_dir, share_dir]]
+        nearest = self.nearest_env(env_hash, requirements)
+        if nearest is None:
+            cmds.append(["virtualenv", env_dir])
+        else:
+            base_hash, removed = nearest
+            base_dir = self.env_dir(base_hash)
+            sys.stdout.write("[env-package] starting from {}\n".format(self.env_package_name(base_hash)))
+            cmds.extend([
+                ["cp", "-a", "--reflink=auto", base_dir, env_dir],
+                # Scripts (and the odd .pth file) contain the absolute path of the virtualenv
+                replace_path_cmd(env_dir, base_dir, env_dir),
+            ])
+            if removed:
+                cmds.append([pip, "uninstall", "--yes"] + removed)
+        # Wheels are built (or found) in the wheelhouse, and installed from there
+        # The canonical form is saved too, for finding the nearest env later on
+        normalized = self.path('staging', "{}.requirements".format(self.env_package_name(env_hash)))
+        with open(self.build_env.ext_filename(normalized), "w") as f:
+            f.write("".join(line + "\n" for line in normalize_requirements(self.build_env.ext_filename(requirements))))
+        cmds.extend([
+            [pip] + self.wheelhouse.pip_wheel_args() + ["-r", requirements],
+            [pip, "install"] + self.wheelhouse.pip_install_args() + ["-r", requirements],
+            ["mkdir", "-p", share_dir],
+            ["cp", requirements, os.path.join(share_dir, "requirements.txt")],
+            ["mv", normalized, os.path.join(share_dir, "requirements.normalized.txt")],
+        ])
+        with self.tree_lock(env_dir), self.wheelhouse.using():
+            self.call.batch(cmds, root=True, check=True)
+        self.update_wheelhouse(pip, started)
+        architecture = self.call(["dpkg", "--print-architecture"], capture_output=True).strip()
+        filename = self.package(self.env_package_name(env_hash), "1", architecture, [env_dir, share_dir],
+                                "Virtualenv for {}".format(self.software))
+        self.record_artifact('env', env_hash, filename, started)
+        return {'env_package': filename}
+
+    def update_wheelhouse(self, pip, started):
+        """ Indexes new wheels, marks those installed in the virtualenv as
+            used and evicts old wheels if the wheelhouse is too large.
+        """
+        freeze = self.call([pip, "freeze"], capture_output=True)
+        installed = [line.split("==", 1) for line in freeze.splitlines() if "==" in line]
+        with self.wheelhouse.index() as index:
+            self.wheelhouse.ingest(index)
+            self.wheelhouse.touch(index, installed)
+            self.wheelhouse.prune(index, constants.WHEELHOUSE_MAX_SIZE,
+                                  keep_since=started - constants.WHEELHOUSE_KEEP_RECENT)
+
+    def env_share_dir(self, env_hash):
+        return "/usr/share/{}-env/{}".format(self.software, env_hash)
+
+    def nearest_env(self, env_hash, requirements):
+        """ Finds the previously built virtualenv whose requirements differ
+            least from the given requirements file.
+            Returns (env hash, names of packages to uninstall), or None if no
+            virtualenv is close enough to be worth copying.
+        """
+        wanted = read_requirements(self.build_env.ext_filename(requirements))
+        share_base = self.build_env.ext_filename("/usr/share/{}-env".format(self.software))
+        try:
+            candidates = os.listdir(share_base)
+        except OSError:
+            return None
+
+        best = None
+        for candidate in sorted(candidates):
+            existing_filename = os.path.join(share_base, candidate, "requirements.normalized.txt")
+            # The requirements are saved after the virtualenv is complete
+            if candidate == env_hash or not os.path.exists(existing_filename):
+                continue
+            if not os.path.exists(self.build_env.ext_filename(os.path.join(self.env_dir(candidate), "bin", "pip"))):
+                continue
+            existing = read_normalized_requirements(existing_filename)
+            removed = [name for name in existing if name not in wanted]
+            changed = [name for name in wanted if existing.get(name) != wanted[name]]
+            # Requirements without a package name (eg. options or URLs) can't be undone
+            if not all(is_package_name(name) for name in removed):
+                continue
+            distance = len(removed) + len(changed)
+            if best is None or distance < best[0]:
+                best = (distance, candidate, sorted(removed))
+        if best is None or best[0] > constants.ENV_INCREMENTAL_MAX_CHANGES:
+            return None
+        return best[1], best[2]
+
+    def src_package_done(self, checkout_dir, commit, env_hash):
+        artifact = self.lookup_artifact('src', commit)
+        if artifact is not None:
+            return {'src_package': artifact['path']}
+
+    def src_package(self, checkout_dir, commit, env_hash):
+        """ Installs the source in its final location and packages it. """
+        started = time.time()
+        src_dir = self.src_dir(commit)
+        with self.tree_lock(src_dir):
+            self.call.batch([
+                ["rm", "-rf", src_dir],
+                ["mkdir", "-p", os.path.dirname(src_dir)],
+                ["cp", "-a", checkout_dir, src_dir],
+            ], root=True, check=True, quiet=True)
+        filename = self.package(self.src_package_name(commit), "1", "all", [src_dir],
+                                "Source code for {} version {}".format(self.software, commit))
+        # The env package is recorded too, so that a plan can find it from the version
+        self.record_artifact('src', commit, filename, started, requires=["env:" + env_hash])
+        return {'src_package': filename}
+
+    def static_dir(self, env_hash, commit):
+        return self.path('static', "{}-{}".format(self.short(commit), env_hash), self.settings or "default")
+
+    def collectstatic_done(self, env_package, src_package, env_hash, commit, debian_depends):
+        static_dir = self.static_dir(env_hash, commit)
+        if os.path.exists(self.build_env.ext_filename(static_dir + ".complete")):
+            return {'static_dir': static_dir}
+
+    def collectstatic(self, env_package, src_package, env_hash, commit, debian_depends):
+        """ Runs collectstatic with the built source and virtualenv.
+            The static files are collected into the directory given in the
+            STATIC_ROOT environment variable.
+        """
+        static_dir = self.static_dir(env_hash, commit)
+        env_dir = self.env_dir(env_hash)
+        src_dir = self.src_dir(commit)
+        # The packages may have been built by an earlier build in a tree that no longer
+        # exists, or (for an isolated build) in the overlay only, so this is looked at
+        # in the chroot
+        missing = [(path, package) for path, package in ((env_dir, env_package), (src_dir, src_package))
+                   if self.isolated or not os.path.exists(self.build_env.ext_filename(path))]
+        for path, package in missing:
+            with self.tree_lock(path):
+                self.call.batch(["[ -d {path} ] || dpkg-deb --extract {package} /".format(
+                                        path=pipes.quote(path), package=pipes.quote(self.chroot_package_filename(package)))],
+                                root=True, check=True)
+        settings = "DJANGO_SETTINGS_MODULE={} ".format(pipes.quote(self.settings)) if self.settings else ""
+        cmds = [
+            ["rm", "-rf", static_dir + ".tmp", static_dir],
+            ["mkdir", "-p", static_dir + ".tmp"],
+            "if [ -f {src}/manage.py ]; then\n"
+            "    cd {src} && {settings}STATIC_ROOT={static} {python} manage.py collectstatic --noinput\n"
+            "else\n"
+            "    echo No manage.py in {src}, no static files are collected\n"
+            "fi".format(src=pipes.quote(src_dir), settings=settings, static=pipes.quote(static_dir + ".tmp"),
+                        python=pipes.quote(os.path.join(env_dir, "bin", "python"))),
+            ["mv", static_dir + ".tmp", static_dir],
+            ["touch", static_dir + ".complete"],
+        ]
+        self.call.batch(cmds, root=True, check=True)
+        return {'static_dir': static_dir}
+
+    def site_package_done(self, static_dir, env_hash, commit):
+        artifact = self.lookup_artifact('site', self.site_input_hash(commit))
+        if artifact is not None:
+            return {'site_package': artifact['path']}
+
+    def site_package(self, static_dir, env_hash, commit):
+        """ Packages the site's configuration, static files and links to
+            the source and virtualenv. The package is written from the host.
+        """
+        started = time.time()
+        key = self.variant or "default"
+        env = {
+            'DJANGO_SETTINGS_MODULE': self.settings or "",
+            'VIRTUAL_ENV': self.env_dir(env_hash),
+            'PYTHONPATH': self.src_dir(commit),
+        }
+        if self.variant:
+            info = self.variant_info()
+            if info is None:
+                raise exceptions.BuildError("Unknown variant \"{}\", add it with the variant command.".format(
+                                            self.variant), self.build_env)
+            env.update({
+                'DATABASE': info['postgres_name'],
+                'ELASTICSEARCH_INDEX': info['elasticsearch_name'],
+                'REDIS_DB': info['redis_number'],
+                'GUNICORN_PORT': info['gunicorn_port'],
+                'SUBDOMAIN': info['subdomain'],
+            })
+        site_dir = "/usr/lib/{}-site/{}".format(self.software, key)
+        etc_dir = "/etc/{}-site/{}".format(self.software, key)
+        user = "{}-{}".format(self.software, key)
+        postinst = "\n".join([
+            "#!/bin/sh",
+            "set -e",
+            'if [ "$1" = configure ]; then',
+            "    getent group {user} >/dev/null || addgroup --system {user}",
+            "    getent passwd {user} >/dev/null || adduser --system --ingroup {user} --no-create-home {user}",
+            "    mkdir -p /var/lib/{software}-site/{key}/media /var/log/{software}-site/{key}",
+            "    chown -R {user}:{user} /var/lib/{software}-site/{key} /var/log/{software}-site/{key}",
+            "fi",
+            "",
+        ]).format(user=user, software=self.software, key=key)
+        files = {
+            os.path.join(etc_dir, "environment"): "".join("{}={}\n".format(k, v) for k, v in sorted(env.items())),
+        }
+        links = {
+            os.path.join(site_dir, "src"): self.src_dir(commit),
+            os.path.join(site_dir, "env"): self.env_dir(env_hash),
+            os.path.join(site_dir, "etc"): etc_dir,
+            os.path.join(site_dir, "media"): "/var/lib/{}-site/{}/media".format(self.software, key),
+            os.path.join(site_dir, "log"): "/var/log/{}-site/{}".format(self.software, key),
+        }
+        # The same inputs give the same package, see commit_time()
+        mtime = self.commit_time(commit)
+        version = "{}+{}.{}".format(time.strftime("%Y%m%d%H%M%S", time.gmtime(mtime)), self.short(commit),
+                                    self.site_input_hash(commit))
+        depends = [self.env_package_name(env_hash), self.src_package_name(commit)]
+        filename = self.write_package(self.site_package_name(), version, "all",
+                                      "Site for {} ({})".format(self.software, key),
+                                      depends=depends, files=files, links=links, scripts={'postinst': postinst},
+                                      copy={os.path.join(site_dir, "static"): static_dir},
+                                      basename="{}_{}".format(self.site_package_name(), self.site_input_hash(commit)),
+                                      mtime=mtime)
+        self.record_artifact('site', self.site_input_hash(commit), filename, started,
+                             requires=["env:" + env_hash, "src:" + commit])
+        return {'site_package': filename}
+
+    def commit_time(self, commit):
+        """ The time (in seconds) the site package is dated: SOURCE_DATE_EPOCH
+            if it is set, otherwise the commit's committer time. Later
+            commits get a later version.
+        """
+        if os.environ.get("SOURCE_DATE_EPOCH"):
+            return int(os.environ["SOURCE_DATE_EPOCH"])
+        for repository_dir in list_repositories(self.build_env, self.software):
+            try:
+                output = self.call(["git", "--git-dir", repository_dir, "show", "-s", "--format=%ct", commit],
+                                   capture_output=True)
+            except subprocess.CalledProcessError:
+                continue
+            return int(output.strip())
+        raise exceptions.BuildError("Commit \"{}\" was not found in any repository".format(commit), self.build_env)
+
+    ############################################################################
+    # Packaging
+    ############################################################################
+
+    def chroot_package_filename(self, filename):
+        """ Where the package with the given (host) filename was built in the chroot. """
+        return self.path('packages', os.path.basename(filename))
+
+    def package(self, name, version, architecture, paths, description, depends=(),
+                files=None, links=None, scripts=None, copy=None, basename=None):
+        """ Builds a debian package in the chroot and copies it to the
+            build environment's packages/ directory.
+            The package contains the given existing paths, new files
+            ({path: content}), symbolic links ({path: target}), maintainer
+            scripts ({name: content}) and copies of directories
+            ({path in package: existing path}).
+            The package file is called {basename}.deb, by default the name.
+            Returns the filename of the package on the host.
+        """
+        staging_dir = self.path('staging', name)
+        self.call.batch([
+            ["rm", "-rf", staging_dir],
+            ["mkdir", "-p", os.path.join(staging_dir, "DEBIAN")],
+            ["chown", "-R", str(os.getuid()), staging_dir],
+        ], root=True, check=True, quiet=True)
+
+        # Files are written from the host, the rest is done as root in the chroot
+        ext_staging_dir = self.build_env.ext_filename(staging_dir)
+        control = self.control_fields(name, version, architecture, description, depends)
+        with open(os.path.join(ext_staging_dir, "DEBIAN", "control"), "w") as f:
+            f.write("".join("{}: {}\n".format(k, v) for k, v in control if v))
+        for script_name, content in (scripts or {}).items():
+            script_filename = os.path.join(ext_staging_dir, "DEBIAN", script_name)
+            with open(script_filename, "w") as f:
+                f.write(content)
+            os.chmod(script_filename, 0o755)
+        conffiles = sorted(path for path in (files or {}) if path.startswith("/etc/"))
+        if conffiles:
+            with open(os.path.join(ext_staging_dir, "DEBIAN", "conffiles"), "w") as f:
+                f.write("".join(path + "\n" for path in conffiles))
+        for path, content in (files or {}).items():
+            filename = os.path.join(ext_staging_dir, path.lstrip("/"))
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, "w") as f:
+                f.write(content)
+        for path, target in (links or {}).items():
+            filename = os.path.join(ext_staging_dir, path.lstrip("/"))
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            os.symlink(target, filename)
+
+        cmds = []
+        for path in paths:
+            cmds.append(["mkdir", "-p", os.path.dirname(staging_dir + path)])
+            cmds.append(["cp", "-al", path, staging_dir + path])
+        for path, source in (copy or {}).items():
+            cmds.append(["mkdir", "-p", os.path.dirname(staging_dir + path)])
+            cmds.append(["cp", "-al", source, staging_dir + path])
+        basename = basename or name
+        chroot_filename = self.path('packages', "{}.deb".format(basename))
+        cmds.extend([
+            ["chown", "-R", "root:root", staging_dir],
+            ["dpkg-deb", "--build", staging_dir, chroot_filename],
+            ["rm", "-rf", staging_dir],
+        ])
+        self.call.batch(cmds, root=True, check=True, quiet=True)
+
+        filename = self.package_filename(basename)
+        if not os.path.exists(self.build_env.package_dir):
+            os.makedirs(self.build_env.package_dir)
+        shutil.copyfile(self.build_env.ext_filename(chroot_filename), filename + ".tmp")
+        os.rename(filename + ".tmp", filename)
+        return filename
+
+    def write_package(self, name, version, architecture, description, depends=(),
+                      files=None, links=None, scripts=None, copy=None, basename=None, mtime=0):
+        """ Like package(), but writes the package from the host with
+            djdd.debfile instead of running dpkg-deb in the chroot, for
+            packages that only copy files the host can read (eg. site
+            packages). The given mtime is used for everything in it.
+        """
+        filename = self.package_filename(basename or name)
+        if not os.path.exists(self.build_env.package_dir):
+            os.makedirs(self.build_env.package_dir)
+        copy = dict((path, self.build_env.ext_filename(source)) for path, source in (copy or {}).items())
+        debfile.write_deb(filename + ".tmp", self.control_fields(name, version, architecture, description, depends),
+                          files=files, links=links, scripts=scripts, copy=copy, mtime=mtime)
+        os.rename(filename + ".tmp", filename)
+        return filename
+
+    def control_fields(self, name, version, architecture, description, depends=()):
+        return [
+            ("Package", name),
+            ("Version", version),
+            ("Architecture", architecture),
+            ("Maintainer", constants.PACKAGE_MAINTAINER),
+            ("Depends", ", ".join(depends)),
+            ("Description", description),
+        ]
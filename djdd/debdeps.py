@@ -0,0 +1,139 @@
+import os
+import glob
+import logging
+import collections
+
+from djdd.debian import iter_control_file, parse_relations, provided_names, version_satisfies
+from djdd import exceptions
+
+logger = logging.getLogger("djdd")
+
+# What a build needs to do about its debian depends. 'install' are the apt
+# arguments for missing packages, 'satisfied' the requested packages that are
+# already installed, 'conflicts' explains anything that can't be installed.
+DependsPlan = collections.namedtuple("DependsPlan", "install,satisfied,conflicts")
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+APT_LISTS_DIR = '/var/lib/apt/lists'
+
+
+def parse_depend(token):
+    """ Parses a package from a depends file, as given to apt-get install,
+        eg. "libpq-dev", "libpq-dev=9.4.5-0+deb8u1" or "libpq-dev:amd64".
+        Returns (name, version), version is None if not given.
+    """
+    name, _, version = token.partition("=")
+    return name.split(":", 1)[0], version or None
+
+
+def read_installed(build_env):
+    """ Returns a dict of the packages installed in the chroot, by name,
+        read from dpkg's status database.
+    """
+    installed = {}
+    for package in iter_control_file(build_env.ext_filename(DPKG_STATUS)):
+        if package.get('Status', '').endswith(" installed"):
+            installed[package['Package']] = package
+    return installed
+
+
+def read_available(build_env, names):
+    """ Returns a dict of the paragraphs apt knows for the given packages
+        (from the lists of the last `apt-get update`), by name. Where there
+        are several versions, the highest is used, as apt would. A name
+        that only other packages provide (a virtual package) is given one
+        of those.
+        Also returns the lists that couldn't be read (eg. compressed with lz4).
+    """
+    available = {}
+    providers = {}
+    unread = []
+    for filename in sorted(glob.glob(build_env.ext_filename(os.path.join(APT_LISTS_DIR, '*_Packages*')))):
+        compression = filename.rsplit("_Packages", 1)[1]
+        if compression not in ("", ".gz", ".bz2"):
+            # Other files next to the lists (eg. .diff_Index) aren't lists
+            if compression in (".xz", ".lz4", ".lzma", ".zst"):
+                unread.append(filename)
+            continue
+        for package in iter_control_file(filename, names):
+            name = package['Package']
+            if name in names and (name not in available or
+                                  version_satisfies(package['Version'], '>>', available[name]['Version'])):
+                available[name] = package
+            for provided in provided_names(package.get('Provides')) & names:
+                providers.setdefault(provided, package)
+    for name, package in providers.items():
+        available.setdefault(name, package)
+    return available, unread
+
+
+def breaks(package, other):
+    """ Checks if `package` conflicts with or breaks (the installed or
+        available version of) `other`, returning the relation or None.
+    """
+    for field in ('Conflicts', 'Breaks'):
+        for alternatives in parse_relations(package.get(field)):
+            for name, operator, version in alternatives:
+                if name == other['Package'] and version_satisfies(other['Version'], operator, version):
+                    return "{} {} {}".format(package['Package'], field.lower(), other['Package'])
+
+
+def plan_debian_depends(build_env, depends):
+    """ Works out which of the given packages (as from a depends file) need
+        installing, from the chroot's dpkg and apt databases, without
+        running apt or taking any locks.
+    """
+    requested = {}
+    conflicts = []
+    for token in depends:
+        name, version = parse_depend(token)
+        if name in requested and requested[name] != version:
+            conflicts.append("{} is requested as both {} and {}".format(name, requested[name] or "any version", version or "any version"))
+        elif name not in requested or version:
+            requested[name] = version
+
+    installed = read_installed(build_env)
+    provided = set()
+    for package in installed.values():
+        provided.update(provided_names(package.get('Provides')))
+
+    def is_installed(name, version):
+        if name in installed:
+            return version is None or installed[name]['Version'] == version
+        return version is None and name in provided
+
+    missing = dict((name, version) for name, version in requested.items() if not is_installed(name, version))
+    satisfied = sorted(set(requested) - set(missing))
+    if not missing:
+        return DependsPlan([], satisfied, conflicts)
+
+    # Check what apt would install against what is installed, and each other
+    available, unread = read_available(build_env, set(missing))
+    candidates = []
+    for name, version in sorted(missing.items()):
+        if name not in available and unread:
+            logger.warning("{} isn't in the package lists djdd can read, leaving it to apt".format(name))
+        elif name not in available:
+            conflicts.append("{} is not available, has the package list been updated?".format(name))
+        elif version is not None and available[name]['Version'] != version:
+            # Other versions may be available too, apt will tell us if not
+            candidates.append(dict(available[name], Version=version))
+        else:
+            candidates.append(available[name])
+    for candidate in candidates:
+        others = [package for name, package in installed.items() if name != candidate['Package']]
+        others += [package for package in candidates if package is not candidate]
+        for other in others:
+            conflict = breaks(candidate, other) or breaks(other, candidate)
+            if conflict and conflict not in conflicts:
+                conflicts.append(conflict)
+
+    install = ["{}={}".format(name, version) if version else name for name, version in sorted(missing.items())]
+    return DependsPlan(install, satisfied, conflicts)
+
+
+def check_plan(plan, build_env):
+    """ Raises a BuildError describing the conflicts of a plan, if there are any. """
+    if plan.conflicts:
+        msg = "The debian depends can't be installed:\n    " + "\n    ".join(plan.conflicts)
+        raise exceptions.BuildError(msg, build_env)
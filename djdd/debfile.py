@@ -0,0 +1,157 @@
+import os
+import stat
+import gzip
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import StringIO
+import contextlib
+
+# Debian packages are ar archives of three members: debian-binary (the format
+# version), control.tar.gz (the control file, md5sums, conffiles and
+# maintainer scripts) and data.tar.gz (the files to install). They are
+# written here without dpkg-deb, so that packages of files the host can read
+# are built without a chroot. Entries are sorted, owned by root and have the
+# given mtime, so the same input always gives the same package.
+
+AR_MAGIC = "!<arch>\n"
+FORMAT_VERSION = "2.0\n"
+
+
+def write_deb(filename, control, files=None, links=None, scripts=None, copy=None, mtime=0):
+    """ Writes a debian package with the given control fields ([(name, value)],
+        Installed-Size is added), new files ({path: content}), symbolic links
+        ({path: target}), maintainer scripts ({name: content}) and copies of
+        files or directories on the host ({path in package: host path}).
+        As with debhelper, the new files in /etc/ are conffiles.
+    """
+    entries = data_entries(files or {}, links or {}, copy or {})
+    with tempfile.TemporaryFile() as data:
+        md5sums, size = write_tar_gz(data, entries, mtime)
+        conffiles = sorted(path for path in (files or {}) if path.startswith("/etc/"))
+        control_entries = {
+            "./control": ('file', control_text(control, size), 0o644),
+            "./md5sums": ('file', "".join("{}  {}\n".format(md5sums[path], path[2:])
+                                          for path in sorted(md5sums)), 0o644),
+        }
+        if conffiles:
+            control_entries["./conffiles"] = ('file', "".join(path + "\n" for path in conffiles), 0o644)
+        for name, content in (scripts or {}).items():
+            control_entries["./" + name] = ('file', content, 0o755)
+        control_tar = StringIO.StringIO()
+        write_tar_gz(control_tar, control_entries, mtime)
+
+        with open(filename, "wb") as f:
+            f.write(AR_MAGIC)
+            write_ar_member(f, "debian-binary", StringIO.StringIO(FORMAT_VERSION), len(FORMAT_VERSION), mtime)
+            write_ar_member(f, "control.tar.gz", control_tar, control_tar.tell(), mtime)
+            write_ar_member(f, "data.tar.gz", data, data.tell(), mtime)
+
+
+def control_text(control, installed_size):
+    fields = [(name, value) for name, value in control if value and name != "Installed-Size"]
+    # The description (which may span several lines) comes last
+    position = len([name for name, value in fields if name != "Description"])
+    fields.insert(position, ("Installed-Size", str((installed_size + 1023) // 1024)))
+    return "".join("{}: {}\n".format(name, value) for name, value in fields)
+
+
+def data_entries(files, links, copy):
+    """ Returns the entries of the package's data as {"./path": (kind, value, mode)},
+        where kind is 'dir', 'file' (value is the content), 'link' (the target)
+        or 'host' (the filename on the host), including all parent directories.
+    """
+    entries = {}
+    for path, content in files.items():
+        entries["." + path] = ('file', content, 0o644)
+    for path, target in links.items():
+        entries["." + path] = ('link', target, 0o777)
+    for path, source in copy.items():
+        source = source.rstrip("/")
+        entries["." + path] = host_entry(source)
+        if entries["." + path][0] != 'dir':
+            continue
+        for dirpath, dirnames, filenames in os.walk(source):
+            for name in dirnames + filenames:
+                filename = os.path.join(dirpath, name)
+                entries["." + path + filename[len(source):]] = host_entry(filename)
+    for path in list(entries):
+        while path != ".":
+            path = os.path.dirname(path)
+            entries.setdefault(path, ('dir', None, 0o755))
+    return entries
+
+
+def host_entry(filename):
+    """ The entry for a file on the host. Permissions are normalised. """
+    if os.path.islink(filename):
+        return ('link', os.readlink(filename), 0o777)
+    if os.path.isdir(filename):
+        return ('dir', None, 0o755)
+    executable = os.stat(filename).st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return ('host', filename, 0o755 if executable else 0o644)
+
+
+def write_tar_gz(fileobj, entries, mtime):
+    """ Writes the entries (see data_entries()) as a gzipped tar archive,
+        sorted by path. Returns the md5sums of the files ({"./path": md5})
+        and their total size.
+    """
+    md5sums = {}
+    size = 0
+    gz = gzip.GzipFile(filename="", mode="wb", fileobj=fileobj, mtime=mtime)
+    tar = tarfile.open(fileobj=gz, mode="w", format=tarfile.GNU_FORMAT)
+    for path in sorted(entries, key=lambda path: path.split("/")):
+        kind, value, mode = entries[path]
+        info = tarfile.TarInfo(path)
+        info.mode = mode
+        info.mtime = mtime
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        if kind == 'dir':
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        elif kind == 'link':
+            info.type = tarfile.SYMTYPE
+            info.linkname = value
+            tar.addfile(info)
+        else:
+            if kind == 'host':
+                f = open(value, "rb")
+            else:
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                f = StringIO.StringIO(value)
+            with contextlib.closing(f):
+                f.seek(0, os.SEEK_END)
+                info.size = f.tell()
+                f.seek(0)
+                reader = _HashingReader(f)
+                tar.addfile(info, reader)
+            md5sums[path] = reader.md5.hexdigest()
+            size += info.size
+    tar.close()
+    gz.close()
+    return md5sums, size
+
+
+def write_ar_member(f, name, data, size, mtime):
+    """ Writes a member of an ar archive, copying `size` bytes from the start of data. """
+    f.write("{:<16}{:<12}{:<6}{:<6}{:<8o}{:<10}`\n".format(name, mtime, 0, 0, 0o100644, size))
+    data.seek(0)
+    shutil.copyfileobj(data, f)
+    if size % 2:
+        f.write("\n")
+
+
+class _HashingReader(object):
+    """ Reads from a file, computing the md5 of what was read. """
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        return data
@@ -0,0 +1,217 @@
+import re
+import bz2
+import gzip
+import urllib2
+import StringIO
+
+RE_DIGITS = re.compile(r'[0-9]*')
+RE_NON_DIGITS = re.compile(r'[^0-9]*')
+RE_RELATION = re.compile(r'^\s*([a-z0-9][a-z0-9+.-]*)(?::[a-z0-9-]+)?\s*(?:\(\s*([<>=]+)\s*([^)\s]+)\s*\))?\s*(?:\[[^\]]*\])?\s*$')
+
+
+def parse_control(text):
+    """ Parses Debian control data (eg. a Packages index or dpkg's status
+        file) into a list of dicts, one per paragraph. Continuation lines
+        are joined to their field with newlines.
+    """
+    paragraphs = []
+    fields = {}
+    name = None
+    for line in text.splitlines():
+        if not line.strip():
+            if fields:
+                paragraphs.append(fields)
+            fields = {}
+            name = None
+        elif line[0] in " \t":
+            if name is not None:
+                fields[name] += "\n" + line.strip()
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            fields[name] = value.strip()
+    if fields:
+        paragraphs.append(fields)
+    return paragraphs
+
+
+def parse_relations(value):
+    """ Parses a relationship field (eg. Depends) into a list of
+        alternatives, each a list of (name, operator, version) tuples.
+        Operator and version are None if there is no version restriction.
+    """
+    relations = []
+    for group in (value or "").split(","):
+        if not group.strip():
+            continue
+        alternatives = []
+        for alternative in group.split("|"):
+            match = RE_RELATION.match(alternative)
+            if match:
+                alternatives.append(match.groups())
+        if alternatives:
+            relations.append(alternatives)
+    return relations
+
+
+def index_url(mirror, suite, arch, component="main"):
+    return "{}/dists/{}/{}/binary-{}/Packages.gz".format(mirror.rstrip("/"), suite, component, arch)
+
+
+def read_package_index(mirror, suite, arch, component="main"):
+    """ Downloads (or reads, for a file:// mirror) the Packages index and
+        returns a dict of the paragraphs by package name.
+    """
+    response = urllib2.urlopen(index_url(mirror, suite, arch, component))
+    try:
+        content = response.read()
+    finally:
+        response.close()
+    content = gzip.GzipFile(fileobj=StringIO.StringIO(content)).read()
+    return dict((package['Package'], package) for package in parse_control(content))
+
+
+def archive_filename(package):
+    """ The filename apt and debootstrap use for a downloaded package in
+        /var/cache/apt/archives, eg. "libc6_2.19-18_amd64.deb".
+    """
+    version = package['Version'].replace(":", "%3a")
+    return "{}_{}_{}.deb".format(package['Package'], version, package['Architecture'])
+
+
+def resolve_packages(index, names, required=True, recommends=True):
+    """ Returns the names of the given packages and everything they depend
+        on (following Pre-Depends, Depends and, like apt, Recommends), as
+        far as the index knows about them. With `required`, the packages a
+        debootstrap --variant=minbase installs are included.
+        Version restrictions are not checked, the index has one version
+        of each package.
+    """
+    provided = {}
+    for package in index.values():
+        for alternatives in parse_relations(package.get('Provides')):
+            for name, operator, version in alternatives:
+                provided.setdefault(name, package['Package'])
+
+    wanted = list(names)
+    if required:
+        wanted.extend(name for name, package in index.items()
+                      if package.get('Priority') == 'required' or package.get('Essential') == 'yes')
+        wanted.append('apt')
+
+    fields = ['Pre-Depends', 'Depends'] + (['Recommends'] if recommends else [])
+    resolved = set()
+    while wanted:
+        name = wanted.pop()
+        name = name if name in index else provided.get(name)
+        if name is None or name in resolved:
+            continue
+        resolved.add(name)
+        for field in fields:
+            for alternatives in parse_relations(index[name].get(field)):
+                # The first alternative that we know about
+                for alternative, operator, version in alternatives:
+                    if alternative in index or alternative in provided:
+                        wanted.append(alternative)
+                        break
+    return sorted(resolved)
+
+
+def iter_control_file(filename, names=None):
+    """ Yields the paragraphs of a Debian control file (like parse_control),
+        without reading the whole file into memory. If `names` is given, only
+        paragraphs for those packages (or packages providing them) are parsed.
+        Files ending in .gz or .bz2 (as apt may keep its lists) are decompressed.
+    """
+    with open_control_file(filename) as f:
+        lines = []
+        for line in f:
+            if line.strip():
+                lines.append(line)
+                continue
+            if lines and (names is None or _is_wanted(lines, names)):
+                for paragraph in parse_control("".join(lines)):
+                    yield paragraph
+            lines = []
+        if lines and (names is None or _is_wanted(lines, names)):
+            for paragraph in parse_control("".join(lines)):
+                yield paragraph
+
+
+def open_control_file(filename):
+    if filename.endswith(".gz"):
+        return gzip.GzipFile(filename)
+    if filename.endswith(".bz2"):
+        return bz2.BZ2File(filename)
+    return open(filename)
+
+
+def _is_wanted(lines, names):
+    """ Checks if the paragraph's package (or one it provides) is one of the names. """
+    if lines[0][len("Package:"):].strip() in names:
+        return True
+    for line in lines:
+        if line.startswith("Provides:"):
+            return bool(provided_names(line[len("Provides:"):]).intersection(names))
+    return False
+
+
+def provided_names(value):
+    """ Returns the names of the (virtual) packages in a Provides field. """
+    return set(name for alternatives in parse_relations(value) for name, operator, version in alternatives)
+
+
+def _order(char):
+    """ The sort order of a character in the non-digit parts of a version. """
+    if char == "~":
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def _compare_part(a, b):
+    """ Compares upstream versions or revisions, as dpkg does: alternately
+        a non-digit part (character by character) and a numeric part.
+    """
+    while a or b:
+        letters_a, letters_b = RE_NON_DIGITS.match(a).group(), RE_NON_DIGITS.match(b).group()
+        for k in range(max(len(letters_a), len(letters_b))):
+            order_a = _order(letters_a[k]) if k < len(letters_a) else 0
+            order_b = _order(letters_b[k]) if k < len(letters_b) else 0
+            if order_a != order_b:
+                return cmp(order_a, order_b)
+        a, b = a[len(letters_a):], b[len(letters_b):]
+
+        digits_a, digits_b = RE_DIGITS.match(a).group(), RE_DIGITS.match(b).group()
+        result = cmp(int(digits_a or 0), int(digits_b or 0))
+        if result:
+            return result
+        a, b = a[len(digits_a):], b[len(digits_b):]
+    return 0
+
+
+def split_version(version):
+    """ Splits a Debian version into (epoch, upstream version, revision). """
+    epoch, _, rest = version.rpartition(":") if ":" in version else ("0", "", version)
+    upstream, _, revision = rest.rpartition("-") if "-" in rest else (rest, "", "0")
+    return int(epoch or 0), upstream, revision
+
+
+def compare_versions(a, b):
+    """ Compares two Debian versions, returning -1, 0 or 1 (like cmp). """
+    epoch_a, upstream_a, revision_a = split_version(a)
+    epoch_b, upstream_b, revision_b = split_version(b)
+    return (cmp(epoch_a, epoch_b) or _compare_part(upstream_a, upstream_b)
+            or _compare_part(revision_a, revision_b))
+
+
+def version_satisfies(version, operator, required):
+    """ Checks a version against a relation, eg. ("2.19-18", ">=", "2.16"). """
+    if operator is None:
+        return True
+    result = compare_versions(version, required)
+    return {
+        '<<': result < 0, '<': result <= 0, '<=': result <= 0,
+        '=': result == 0,
+        '>>': result > 0, '>': result >= 0, '>=': result >= 0,
+    }[operator]
@@ -12,3 +12,50 @@ class VariantDBConnectionError(BuildEnvironmentError):
         self.connection = connection
         self.msg = "Could not connect to database \"{}\"".format(connection)
         self.build_env = build_env
+
+
+class VariantAllocationError(BuildEnvironmentError):
+    pass
+
+
+class ChrootCommandError(BuildEnvironmentError):
+    def __init__(self, cmd, returncode, output, build_env):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+        if not isinstance(cmd, basestring):
+            cmd = " ".join(cmd)
+        self.msg = "Command \"{}\" failed in the build environment with exit code {}".format(cmd, returncode)
+        self.build_env = build_env
+
+
+class CommandCancelled(BuildEnvironmentError):
+    def __init__(self, cmd, build_env=None):
+        self.cmd = cmd
+        if not isinstance(cmd, basestring):
+            cmd = " ".join(cmd)
+        self.msg = "Command \"{}\" was cancelled".format(cmd)
+        self.build_env = build_env
+
+
+class CommandTimeout(CommandCancelled):
+    def __init__(self, cmd, timeout, output, build_env=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.output = output
+        if not isinstance(cmd, basestring):
+            cmd = " ".join(cmd)
+        self.msg = "Command \"{}\" did not finish within {}s".format(cmd, timeout)
+        self.build_env = build_env
+
+
+class BuildError(BuildEnvironmentError):
+    pass
+
+
+class StageError(BuildError):
+    def __init__(self, stage, error, build_env=None):
+        self.stage = stage
+        self.error = error
+        self.msg = "Build stage \"{}\" failed: {}".format(stage, getattr(error, 'msg', None) or error)
+        self.build_env = build_env
@@ -0,0 +1,193 @@
+import os
+import re
+import time
+import glob
+import fcntl
+import pipes
+import contextlib
+import subprocess
+
+from djdd import constants
+
+RE_COMMIT = re.compile(r'^[0-9a-f]{40}$')
+
+
+class FetchCoordinator(object):
+    """ Avoids redundant `git fetch` runs on the mirrors in a build environment.
+
+        A fetch is skipped when the requested version (a commit hash) is
+        already in the mirror, or (when no version or a branch or tag is
+        requested) when the mirror was fetched within the freshness window. Concurrent fetches of the same mirror,
+        from threads or from parallel builds, are serialised with a lock file
+        and coalesced: if another fetch started while we were waiting for
+        the lock, its result is used instead of fetching again.
+    """
+    LOCK_NAME = "djdd-fetch.lock"
+    # The mtime of this file is the time the last successful fetch started
+    STAMP_NAME = "djdd-fetched"
+
+    def __init__(self, build_env, call, freshness=None):
+        self.build_env = build_env
+        self.call = call
+        self.freshness = constants.FETCH_FRESHNESS if freshness is None else freshness
+
+    def has_commit(self, repository_dir, version):
+        """ Checks if the mirror already has the given commit. Branches and
+            tags may have moved since the last fetch, so they never count.
+        """
+        if not RE_COMMIT.match(version or ""):
+            return False
+        cmd = "git --git-dir {} cat-file -e {} 2>/dev/null".format(
+                pipes.quote(repository_dir), pipes.quote(version + "^{commit}"))
+        return self.call(cmd, shell=True) == 0
+
+    def last_fetched(self, repository_dir):
+        """ Returns the time the last successful fetch of the mirror started, or None. """
+        try:
+            return os.path.getmtime(self.build_env.ext_filename(os.path.join(repository_dir, self.STAMP_NAME)))
+        except OSError:
+            return None
+
+    def mark_fetched(self, repository_dir, started):
+        """ Records a successful fetch (or clone) that started at the given time. """
+        stamp = self.build_env.ext_filename(os.path.join(repository_dir, self.STAMP_NAME))
+        with open(stamp, 'a'):
+            pass
+        os.utime(stamp, (started, started))
+
+    @contextlib.contextmanager
+    def lock(self, repository_dir):
+        with open(self.build_env.ext_filename(os.path.join(repository_dir, self.LOCK_NAME)), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def fetch(self, repository_dir, version=None):
+        """ Brings the mirror up to date, if necessary, returning how that was done:
+            "present" (the version was already there), "fresh" (fetched recently),
+            "coalesced" (another fetch finished while waiting) or "fetched".
+            Raises subprocess.CalledProcessError if git fails.
+        """
+        if version and self.has_commit(repository_dir, version):
+            return "present"
+
+        requested = time.time()
+        with self.lock(repository_dir):
+            last = self.last_fetched(repository_dir)
+            if last is not None and last >= requested:
+                return "coalesced"
+            # A fetch that started before we asked may have brought the version
+            if version and self.has_commit(repository_dir, version):
+                return "coalesced"
+            # A missing commit is always fetched, the rest can be a little out of date
+            if not RE_COMMIT.match(version or "") and last is not None and time.time() - last < self.freshness:
+                return "fresh"
+
+            started = time.time()
+            self.call(["git", "--git-dir", repository_dir, "fetch", "--prune"], capture_output=True,
+                      tail=constants.OUTPUT_TAIL_LINES, timeout=constants.FETCH_TIMEOUT)
+            self.mark_fetched(repository_dir, started)
+            return "fetched"
+
+    def fetch_all(self, repository_dirs, version=None, jobs=None):
+        """ Like fetch(), for several mirrors: those that need it are fetched
+            at the same time (up to `jobs` at once) in one session, with the
+            call's parallel(). Returns a dict of how each mirror was brought
+            up to date. Raises subprocess.CalledProcessError for the first
+            fetch that failed, once all of them have finished.
+        """
+        results = {}
+        if version:
+            for repository_dir in repository_dirs:
+                if self.has_commit(repository_dir, version):
+                    results[repository_dir] = "present"
+        remaining = sorted(set(repository_dirs) - set(results))
+
+        requested = time.time()
+        # The locks are taken in order, so that concurrent callers can't deadlock
+        with contextlib.nested(*[self.lock(repository_dir) for repository_dir in remaining]):
+            to_fetch = []
+            for repository_dir in remaining:
+                last = self.last_fetched(repository_dir)
+                if last is not None and last >= requested:
+                    results[repository_dir] = "coalesced"
+                elif version and self.has_commit(repository_dir, version):
+                    results[repository_dir] = "coalesced"
+                elif (not RE_COMMIT.match(version or "") and last is not None
+                        and time.time() - last < self.freshness):
+                    results[repository_dir] = "fresh"
+                else:
+                    to_fetch.append(repository_dir)
+            if not to_fetch:
+                return results
+
+            started = time.time()
+            cmds = [["git", "--git-dir", repository_dir, "fetch", "--prune"] for repository_dir in to_fetch]
+            labels = [os.path.basename(repository_dir) for repository_dir in to_fetch]
+            outputs = self.call.parallel(cmds, jobs=jobs or constants.CLONE_JOBS, timeout=constants.FETCH_TIMEOUT,
+                                         labels=labels)
+            for repository_dir, output in zip(to_fetch, outputs):
+                if output.returncode == 0:
+                    self.mark_fetched(repository_dir, started)
+                    results[repository_dir] = "fetched"
+            for cmd, output in zip(cmds, outputs):
+                if output.returncode != 0:
+                    raise subprocess.CalledProcessError(output.returncode, cmd, output.output)
+        return results
+
+
+def list_repositories(build_env, software):
+    """ Returns the (chroot) paths of all mirrors for the given software. """
+    repository_base_dir = '/var/lib/{namespace}/{name}/repository/'.format(namespace=build_env.NAMESPACE, name=software)
+    found = glob.glob(build_env.ext_filename(os.path.join(repository_base_dir, '*.git')))
+    return sorted(os.path.join(repository_base_dir, os.path.basename(path)) for path in found)
+
+
+def read_ref(build_env, repository_dir, ref="HEAD"):
+    """ Resolves a branch, tag or "HEAD" to a commit hash by reading the
+        mirror from the host, without running git. Full commit hashes are
+        returned as they are. Returns None if the ref is unknown, or is an
+        annotated tag that hasn't been packed.
+    """
+    if RE_COMMIT.match(ref):
+        return ref
+    git_dir = build_env.ext_filename(repository_dir)
+    if ref == "HEAD" or ref.startswith("refs/"):
+        candidates = [ref]
+    else:
+        candidates = ["refs/heads/" + ref, "refs/tags/" + ref]
+
+    packed = {}
+    try:
+        with open(os.path.join(git_dir, "packed-refs")) as f:
+            last = None
+            for line in f:
+                line = line.strip()
+                if line.startswith("^") and last:
+                    # The commit an annotated tag points to
+                    packed[last] = line[1:]
+                elif line and not line.startswith("#"):
+                    value, last = line.split(" ", 1)
+                    packed[last] = value
+    except IOError:
+        pass
+
+    for name in candidates:
+        # Follow symbolic refs (ie HEAD) a few levels at most
+        for i in range(5):
+            try:
+                with open(os.path.join(git_dir, name)) as f:
+                    value = f.read().strip()
+            except IOError:
+                value = packed.get(name)
+            if value is None:
+                break
+            if value.startswith("ref: "):
+                name = value[len("ref: "):]
+                continue
+            if name.startswith("refs/tags/") and name in packed:
+                value = packed[name]
+            return value if RE_COMMIT.match(value) else None
+    return None
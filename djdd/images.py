@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+from djdd.base import logger, sudo
+from djdd import constants
+
+
+class ImageCache(object):
+    """ Prepared debootstrap roots, stored as compressed tarballs on the host
+        so that build environments can be recreated without running
+        debootstrap and installing our dependencies again.
+
+        Images are keyed by everything that goes into preparing a root: the
+        debian suite, architecture and mirror, and the packages we install.
+        Next to each image, a small JSON file describes it.
+    """
+    # Change this when the way a root is prepared changes, to ignore old images
+    IMAGE_VERSION = 1
+    # Nothing in these should end up in an image
+    EXCLUDE = ['./proc/*', './sys/*', './dev/pts/*', './tmp/*', './var/cache/apt/archives/*.deb']
+
+    def __init__(self, debian_suite, debian_arch, debian_mirror=None, dir=None):
+        self.dir = dir or constants.IMAGE_CACHE_DIR
+        self.info = {
+            'version': self.IMAGE_VERSION,
+            'suite': debian_suite,
+            'arch': debian_arch,
+            'mirror': debian_mirror or '',
+            'dependencies': sorted(constants.DJDD_DEPENDENCIES),
+        }
+
+    @property
+    def key(self):
+        content = json.dumps(self.info, sort_keys=True)
+        return "{}-{}-{}".format(self.info['suite'], self.info['arch'], hashlib.sha1(content).hexdigest()[:constants.HASH_LENGTH])
+
+    @property
+    def filename(self):
+        return os.path.join(self.dir, self.key + ".tar.gz")
+
+    @property
+    def info_filename(self):
+        return os.path.join(self.dir, self.key + ".json")
+
+    def exists(self):
+        return os.path.exists(self.filename) and os.path.exists(self.info_filename)
+
+    def restore(self, root_dir):
+        """ Unpacks the image into the given root directory.
+            Returns False if there is no image (or it could not be unpacked).
+        """
+        if not self.exists():
+            return False
+        logger.info("Restoring build environment root from {}".format(self.filename))
+        if sudo(['tar', '-x', '-z', '-p', '--numeric-owner', '-f', self.filename, '-C', root_dir]) != 0:
+            logger.error("Could not unpack image {}, building from scratch".format(self.filename))
+            return False
+        return True
+
+    def store(self, root_dir):
+        """ Saves the given (prepared) root directory as the image. """
+        started = time.time()
+        sudo(['mkdir', '-p', self.dir])
+        tmp_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+        cmd = ['tar', '-c', '-z', '-p', '--numeric-owner', '-f', tmp_filename, '-C', root_dir]
+        cmd += ['--exclude={}'.format(pattern) for pattern in self.EXCLUDE]
+        if sudo(cmd + ['.']) != 0:
+            sudo(['rm', '-f', tmp_filename])
+            logger.error("Could not save image of the build environment root")
+            return False
+        # The info file is written last, so that half written images are never used
+        sudo(['mv', tmp_filename, self.filename])
+        info = dict(self.info, created=time.time(), size=os.path.getsize(self.filename),
+                    duration=time.time() - started)
+        with tempfile.NamedTemporaryFile() as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+            f.flush()
+            os.chmod(f.name, 0o644)
+            sudo(['cp', f.name, self.info_filename])
+        logger.info("Saved image of the build environment root as {}".format(self.filename))
+        return True
@@ -1,5 +1,6 @@
 # encoding: utf8
 import os
+import re
 import tempfile
 import errno
 import sys
@@ -7,24 +8,38 @@ import grp
 import subprocess
 
 from djdd.base import BuildEnvironment, logger, sudo
+from djdd.images import ImageCache
+from djdd.prefetch import prefetch_packages
+from djdd.aptcache import AptCache, apt_install
 from djdd import constants
+from djdd import trace
+from djdd import streams
+
+RE_SETUP_FSTAB = re.compile(r'^setup\.fstab=(.+)$', re.MULTILINE)
 
 
 # TODO: If something fails during init, break off
 
 
-def install_build_environment(dir, debian_suite, debian_arch, debian_mirror=None, tar=None, variant_database=None):
+def install_build_environment(dir, debian_suite, debian_arch, debian_mirror=None, tar=None, variant_database=None,
+                              image_cache=True, prefetch=True, jobs=None, shared_apt_cache=False):
     """ Creates a new build directory
         The following aspects require root privileges:
             * debootstrap
             * schroot config installation
+        With image_cache, the prepared root is restored from (or saved to)
+        the image cache instead of running debootstrap.
+        With prefetch, the packages to install are downloaded beforehand,
+        up to `jobs` at the same time.
+        With shared_apt_cache, all build environments use the package pool
+        as their apt archive cache.
     """
     build_env = BuildEnvironment(dir, variant_database)
 
     # Check that debootstrap and schroot is installed
     REQUIRED_PACKAGES = {
-        'debootstrap': '/usr/sbin/debootstrap',
-        'schroot': '/usr/bin/schroot',
+        'debootstrap': constants.DEBOOTSTRAP,
+        'schroot': constants.SCHROOT,
             }
     missing = [name for name, key_file in REQUIRED_PACKAGES.items()
                     if not os.path.exists(key_file)]
@@ -49,6 +64,8 @@ def install_build_environment(dir, debian_suite, debian_arch, debian_mirror=None
         os.makedirs(build_env.root_dir)
 
     # Install our chroot in global schroot config to allow normal users to chroot
+    # The overlay chroot shares the same root, but each of its sessions
+    # writes to its own throwaway layer (for isolated builds).
     # Whitespace will eventually be stripped from each line
     SCHROOT_CONFIG_TEMPLATE = """
         [{env.name}]
@@ -58,30 +75,76 @@ def install_build_environment(dir, debian_suite, debian_arch, debian_mirror=None
         groups={env.unix_group_name}
         root-groups={env.unix_group_name}
         profile=djdd
+
+        [{env.overlay_name}]
+        description=DjDD isolated build environment
+        type=directory
+        directory={env.root_dir}
+        union-type=overlay
+        union-overlay-directory={env.overlay_dir}
+        groups={env.unix_group_name}
+        root-groups={env.unix_group_name}
+        profile=djdd
+        setup.fstab={env.overlay_fstab}
     """
     # Install a profile directory if it doesn't exist
     if not os.path.exists(build_env.schroot_profile_dir):
         profile_skel = os.path.join(os.path.dirname(__file__), 'templates', 'schroot-profile')
         sudo(['cp', '-R', profile_skel, build_env.schroot_profile_dir], user='root', group=build_env.unix_group_name)
 
+    # Mount one apt archive cache into every chroot (this changes the profile)
+    if shared_apt_cache:
+        enable_shared_apt_cache(build_env)
+
+    # (Re)install the configuration if it is missing or predates the overlay chroot
+    if not build_env.has_config_link or not build_env.has_overlay_config():
+        if not os.path.lexists(build_env.overlay_dir):
+            os.makedirs(build_env.overlay_dir)
+        for shared_dir in ('/var/lib/{}'.format(build_env.NAMESPACE), '/var/cache/{}'.format(build_env.NAMESPACE)):
+            sudo(['mkdir', '-p', build_env.ext_filename(shared_dir)])
+        install_overlay_fstab(build_env)
+        install_root_file(SCHROOT_CONFIG_TEMPLATE.format(env=build_env), build_env.schroot_config_filename)
+
     # Put a symlink in the build directory so that future calls can find it
     if not build_env.has_config_link:
-        # Install the configuration
-        schroot_config = SCHROOT_CONFIG_TEMPLATE.format(env=build_env).strip()
-        with tempfile.NamedTemporaryFile() as f:
-            # NB schroot does not like whitespace
-            for line in schroot_config.splitlines():
-                f.write(line.lstrip()+"\n")
-            f.flush()
-            os.chmod(f.name, 0o664)
-            # Move into place (as root)
-            sudo(['cp', f.name, build_env.schroot_config_filename])
-
         os.symlink(build_env.schroot_config_filename, build_env.schroot_config_link)
 
     if not os.path.exists(build_env.debootstrap_complete):
+        name = "init {}".format(build_env.name)
+        with trace.tracing(build_env.log_dir, name), streams.command_log(build_env.log_dir, name):
+            bootstrap_root(build_env, debian_suite, debian_arch, debian_mirror, tar, image_cache, prefetch, jobs)
+
+        # Touch the marker file to signify that bootstrap was successfully completed
+        with open(build_env.debootstrap_complete, "w") as f:
+            pass
+
+    # Remember the variant database, so that other commands use it too
+    if variant_database is not None:
+        with open(build_env.database_setting, "w") as f:
+            f.write(variant_database + "\n")
+        os.chmod(build_env.database_setting, 0o660)
+
+    # Create variant database if necessary
+    build_env.create_variant_database()
+
+
+def bootstrap_root(build_env, debian_suite, debian_arch, debian_mirror, tar, image_cache, prefetch, jobs):
+    """ Creates the root of the build environment, with everything needed for building. """
+    images = ImageCache(debian_suite, debian_arch, debian_mirror) if image_cache else None
+    if images is not None and images.restore(build_env.root_dir):
+        logger.info("Build environment root restored from the image cache")
+    else:
+        # Download everything at once, debootstrap would fetch one package at a time
+        if prefetch and tar is None:
+            try:
+                prefetch_packages(build_env, debian_suite, debian_arch, debian_mirror,
+                                  constants.DJDD_DEPENDENCIES, jobs)
+            except IOError as e:
+                logger.warning("Could not prefetch packages, they will be downloaded "
+                               "during installation instead: {}".format(e))
+
         # Create the debootstrap
-        cmd_debootstrap = ['/usr/sbin/debootstrap', '--variant=minbase', '--arch', debian_arch]
+        cmd_debootstrap = [constants.DEBOOTSTRAP, '--variant=minbase', '--arch', debian_arch]
         if tar is not None:
             tar = os.path.abspath(tar)
             cmd_debootstrap.extend(["--unpack-tarball", tar])
@@ -92,26 +155,89 @@ def install_build_environment(dir, debian_suite, debian_arch, debian_mirror=None
 
         # Install our required packages for building (eg git, virtualenv, debhelper etc)
         with build_env.chroot() as call:
-            call('echo "exit 0" > /sbin/start-stop-daemon', shell=True, root=True)
-            call('echo "en_US ISO-8859-1\nen_US.UTF-8 UTF-8" > /etc/locale.gen', shell=True, root=True)
+            call.batch([
+                'echo "exit 0" > /sbin/start-stop-daemon',
+                'echo "en_US ISO-8859-1\nen_US.UTF-8 UTF-8" > /etc/locale.gen',
+            ], root=True, check=True)
             # Install anything we need
             if debian_mirror is not None:
                 call('echo "deb {} {} main" > /etc/apt/sources.list'.format(debian_mirror, debian_suite), shell=True)
-            call('apt-get update', shell=True, root=True)
-            call(['apt-get', 'install', '--assume-yes'] + constants.DJDD_DEPENDENCIES, root=True)
+            call.batch(['apt-get update'], root=True, check=True)
+            apt_install(build_env, call, constants.DJDD_DEPENDENCIES)
 
-            # Add user for building
-            call('addgroup {env.build_group}'.format(env=build_env), shell=True, root=True)
-            call('adduser --system --quiet --ingroup "{env.build_group}" '
-                 '--gecos "DjDD Build user" "{env.build_user}"'.format(env=build_env), shell=True, root=True)
-            call('adduser {env.build_user} {env.build_group}'.format(env=build_env), shell=True, root=True)
+            # Add user for building (these may already exist from an earlier attempt)
+            call.batch([
+                'addgroup {env.build_group}'.format(env=build_env),
+                'adduser --system --quiet --ingroup "{env.build_group}" '
+                '--gecos "DjDD Build user" "{env.build_user}"'.format(env=build_env),
+                'adduser {env.build_user} {env.build_group}'.format(env=build_env),
+            ], root=True, stop_on_error=False)
 
-        # Touch the marker file to signify that bootstrap was successfully completed
-        with open(build_env.debootstrap_complete, "w") as f:
-            pass
+        # Save the prepared root for the next environment like this one
+        if images is not None:
+            images.store(build_env.root_dir)
 
-    # Create variant database if necessary
-    build_env.create_variant_database()
+
+def install_overlay_fstab(build_env):
+    """ Overlay sessions mount what the profile mounts, plus the shared
+        directories from the base root.
+    """
+    OVERLAY_FSTAB_TEMPLATE = """
+        {root}/var/lib/{env.NAMESPACE}\t/var/lib/{env.NAMESPACE}\tnone\trw,bind\t0\t0
+        {root}/var/cache/{env.NAMESPACE}\t/var/cache/{env.NAMESPACE}\tnone\trw,bind\t0\t0
+    """
+    with open(os.path.join(build_env.schroot_profile_dir, 'fstab')) as f:
+        profile_fstab = f.read()
+    overlay_fstab = OVERLAY_FSTAB_TEMPLATE.format(env=build_env, root=build_env.root_dir)
+    install_root_file(profile_fstab + overlay_fstab, build_env.overlay_fstab)
+
+
+def enable_shared_apt_cache(build_env):
+    """ Adds the shared apt cache to the schroot profile's mounts.
+        Returns True if the profile was changed.
+    """
+    cache = AptCache(build_env)
+    cache.prepare()
+    if cache.enabled():
+        return False
+    with open(os.path.join(build_env.schroot_profile_dir, 'fstab')) as f:
+        profile_fstab = f.read()
+    install_root_file(profile_fstab.rstrip("\n") + "\n" + cache.fstab_line(),
+                      os.path.join(build_env.schroot_profile_dir, 'fstab'))
+    # Overlay sessions have an fstab of their own, per build environment
+    for filename in list_overlay_fstabs():
+        with open(filename) as f:
+            overlay_fstab = f.read()
+        if not any(line.split() == cache.fstab_line().split() for line in overlay_fstab.splitlines()):
+            install_root_file(overlay_fstab.rstrip("\n") + "\n" + cache.fstab_line(), filename)
+    logger.info("The shared apt cache in {} is now used by all build environments".format(cache.dir))
+    return True
+
+
+def list_overlay_fstabs():
+    """ Returns the overlay fstabs of all installed build environments, from their schroot configuration. """
+    filenames = []
+    if not os.path.exists(BuildEnvironment.SCHROOT_CONFIG_DIR):
+        return filenames
+    for name in sorted(os.listdir(BuildEnvironment.SCHROOT_CONFIG_DIR)):
+        if not name.startswith(BuildEnvironment.NAMESPACE + "_"):
+            continue
+        with open(os.path.join(BuildEnvironment.SCHROOT_CONFIG_DIR, name)) as f:
+            filenames.extend(RE_SETUP_FSTAB.findall(f.read()))
+    return [filename for filename in filenames if os.path.exists(filename)]
+
+
+def install_root_file(content, filename):
+    """ Writes a configuration file owned by root, stripping the whitespace
+        from each line (schroot does not like whitespace).
+    """
+    with tempfile.NamedTemporaryFile() as f:
+        for line in content.strip().splitlines():
+            f.write(line.lstrip()+"\n")
+        f.flush()
+        os.chmod(f.name, 0o664)
+        # Move into place (as root)
+        sudo(['cp', f.name, filename])
 
 
 def uninstall_build_environment(dir):
@@ -120,8 +246,9 @@ def uninstall_build_environment(dir):
     # TODO This currently needs to be run as root, change to sudo
     build_env = BuildEnvironment(dir)
 
-    # End all open sessions
-    all_sessions = subprocess.check_output(['schroot', '--list', '--all-sessions', '--quiet'])
+    # End our warm sessions, anything still open after that is in use
+    build_env.sessions.end_all()
+    all_sessions = subprocess.check_output([constants.SCHROOT, '--list', '--all-sessions', '--quiet'])
     our_prefix = "session:{}-".format(build_env.name)
     open_sessions = [s for s in all_sessions.splitlines() if s.startswith(our_prefix)]
     if open_sessions:
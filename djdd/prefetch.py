@@ -0,0 +1,110 @@
+import os
+import time
+import urllib2
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+from djdd.base import logger, sudo, sha256_file
+from djdd.debian import read_package_index, resolve_packages, archive_filename
+from djdd import constants
+
+
+class PackagePool(object):
+    """ A directory of downloaded .deb files on the host, shared by all
+        build environments. Files are named as in /var/cache/apt/archives,
+        so that they can be copied there for debootstrap and apt to use
+        instead of downloading them again.
+    """
+    def __init__(self, dir=None):
+        self.dir = dir or constants.DEB_POOL_DIR
+
+    def prepare(self, group):
+        """ Creates the pool, writable by the given group. """
+        if not os.path.exists(self.dir):
+            # apt also wants a partial/ directory, when used as its archive cache
+            sudo(['mkdir', '-p', os.path.join(self.dir, 'partial')])
+            sudo(['chown', ':{}'.format(group), self.dir])
+            sudo(['chmod', 'g+rwXs', self.dir])
+
+    def filename(self, package):
+        return os.path.join(self.dir, archive_filename(package))
+
+    def has(self, package):
+        """ Checks if the pool has the given package (a Packages paragraph), intact. """
+        filename = self.filename(package)
+        try:
+            if os.path.getsize(filename) != int(package['Size']):
+                return False
+        except OSError:
+            return False
+        return 'SHA256' not in package or sha256_file(filename) == package['SHA256']
+
+    def download(self, mirror, package):
+        """ Downloads a package into the pool, checking its size and hash.
+            Returns the number of bytes downloaded.
+        """
+        filename = self.filename(package)
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        sha = hashlib.sha256()
+        size = 0
+        response = urllib2.urlopen("{}/{}".format(mirror.rstrip("/"), package['Filename']))
+        try:
+            with open(tmp_filename, "wb") as f:
+                for chunk in iter(lambda: response.read(1 << 16), b""):
+                    sha.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+        finally:
+            response.close()
+        if size != int(package['Size']) or sha.hexdigest() != package.get('SHA256', sha.hexdigest()):
+            os.unlink(tmp_filename)
+            raise IOError("Downloaded {} does not match the package index".format(package['Filename']))
+        os.rename(tmp_filename, filename)
+        return size
+
+
+def prefetch_packages(build_env, debian_suite, debian_arch, debian_mirror=None, packages=(), jobs=None):
+    """ Downloads everything a new build environment will install (the
+        debootstrap base and the given packages) into the package pool, up
+        to `jobs` packages at the same time, and copies them to the root's
+        /var/cache/apt/archives, where debootstrap and apt will find them.
+        Returns the list of packages that could not be downloaded.
+    """
+    mirror = debian_mirror or constants.DEFAULT_DEBIAN_MIRROR
+    jobs = jobs or constants.PREFETCH_JOBS
+    pool = PackagePool()
+    pool.prepare(build_env.unix_group_name)
+
+    started = time.time()
+    index = read_package_index(mirror, debian_suite, debian_arch)
+    wanted = [index[name] for name in resolve_packages(index, packages)]
+    missing = [package for package in wanted if not pool.has(package)]
+    logger.info("Prefetching {} of {} packages from {}".format(len(missing), len(wanted), mirror))
+
+    def download(package):
+        try:
+            return package, pool.download(mirror, package), None
+        except IOError as e:
+            return package, 0, e
+
+    failed = []
+    downloaded = 0
+    thread_pool = ThreadPool(jobs)
+    try:
+        for package, size, error in thread_pool.imap_unordered(download, missing):
+            if error is not None:
+                logger.warning("Could not prefetch {}: {}".format(package['Package'], error))
+                failed.append(package['Package'])
+            downloaded += size
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+    logger.info("Prefetched {} bytes in {:.1f}s".format(downloaded, time.time() - started))
+
+    # debootstrap and apt use (and check) any packages already in the archive directory
+    archives_dir = build_env.ext_filename('/var/cache/apt/archives')
+    available = [pool.filename(package) for package in wanted if package['Package'] not in failed]
+    sudo(['mkdir', '-p', os.path.join(archives_dir, 'partial')])
+    if available:
+        sudo(['cp', '--reflink=auto', '--target-directory', archives_dir] + available)
+    return failed
@@ -0,0 +1,228 @@
+import os
+import re
+import shlex
+import hashlib
+import collections
+
+from djdd import constants
+from djdd import exceptions
+
+# A parsed requirement. 'key' is the canonical name, or for lines without a
+# name (eg. editable installs or URLs) the canonical line itself.
+Requirement = collections.namedtuple("Requirement", "key,line,constraint")
+
+RE_URL = re.compile(r'^\s*[A-Za-z0-9+.-]+://')
+RE_NAME = re.compile(r'^\s*([A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)\s*')
+RE_PACKAGE_NAME = re.compile(r'^[a-z0-9][a-z0-9.-]*$')
+RE_EXTRAS = re.compile(r'^\[([^\]]*)\]\s*')
+RE_SPECIFIER = re.compile(r'^\s*(===|==|!=|<=|>=|~=|<|>)\s*([^\s,;]+)\s*$')
+RE_MARKER_TOKEN = re.compile(r'''\s*("[^"]*"|'[^']*'|===|==|!=|<=|>=|~=|<|>|\(|\)|[A-Za-z0-9_.]+)''')
+RE_PRE_RELEASE = re.compile(r'[-_.]?(alpha|beta|preview|pre|a|b|c|rc)[-_.]?(?=\d|$)')
+RE_POST_RELEASE = re.compile(r'[-_.]?(post|rev|r)[-_.]?(?=\d|$)')
+RE_DEV_RELEASE = re.compile(r'[-_.]?dev[-_.]?(?=\d|$)')
+
+PRE_RELEASE_SPELLINGS = {'alpha': 'a', 'beta': 'b', 'c': 'rc', 'pre': 'rc', 'preview': 'rc'}
+
+# Options that change what gets installed, and are kept in the canonical form
+KEPT_OPTIONS = {
+    '-i': '--index-url', '--index-url': '--index-url',
+    '--extra-index-url': '--extra-index-url',
+    '-f': '--find-links', '--find-links': '--find-links',
+    '--no-binary': '--no-binary', '--only-binary': '--only-binary',
+    '--pre': '--pre', '--no-index': '--no-index',
+}
+
+
+def canonical_name(name):
+    """ The canonical form of a package name (as in PEP 503), eg. Django_Foo -> django-foo. """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def is_package_name(key):
+    """ Checks if a Requirement's key is a package name, rather than a line. """
+    return RE_PACKAGE_NAME.match(key) is not None
+
+
+def canonical_version(version):
+    """ Normalises the spelling of a version (following PEP 440), eg. "V1.0-RC01" -> "1.0rc1". """
+    version = version.strip().lower()
+    if version.startswith("v"):
+        version = version[1:]
+    version = RE_PRE_RELEASE.sub(lambda m: PRE_RELEASE_SPELLINGS.get(m.group(1), m.group(1)), version)
+    version = RE_POST_RELEASE.sub(".post", version)
+    version = RE_DEV_RELEASE.sub(".dev", version)
+    # Leading zeros in numbers are not significant
+    return re.sub(r'(?<![0-9])0+(?=[0-9])', '', version)
+
+
+def canonical_marker(marker):
+    """ Normalises whitespace and quoting in an environment marker. """
+    tokens = []
+    position = 0
+    marker = marker.strip()
+    while position < len(marker):
+        match = RE_MARKER_TOKEN.match(marker, position)
+        if match is None or match.end() == position:
+            raise ValueError("Invalid environment marker: {}".format(marker))
+        token = match.group(1)
+        if token[0] in "'\"":
+            token = '"{}"'.format(token[1:-1])
+        tokens.append(token)
+        position = match.end()
+    return " ".join(tokens).replace("( ", "(").replace(" )", ")")
+
+
+def canonical_requirement(line):
+    """ Returns (key, canonical line) for a requirement specifier line. """
+    # Per-requirement options (eg. --hash) don't change what is installed
+    line = re.split(r'\s--', line, 1)[0]
+    line, _, marker = line.partition(";")
+    marker = "; " + canonical_marker(marker) if marker.strip() else ""
+    match = RE_NAME.match(line)
+    if match is None or RE_URL.match(line):
+        # Probably a URL or path, there is no name to canonicalise
+        line = line.strip() + marker
+        return line, line
+    name = canonical_name(match.group(1))
+    rest = line[match.end():]
+
+    extras = ""
+    match = RE_EXTRAS.match(rest)
+    if match:
+        names = sorted(set(canonical_name(e.strip()) for e in match.group(1).split(",") if e.strip()))
+        extras = "[{}]".format(",".join(names)) if names else ""
+        rest = rest[match.end():]
+
+    if rest.lstrip().startswith("@"):
+        # A direct reference, eg. "name @ https://..."
+        return name, "{}{} @ {}{}".format(name, extras, rest.lstrip()[1:].strip(), marker)
+
+    specifiers = []
+    for specifier in rest.strip().strip("()").split(","):
+        if not specifier.strip():
+            continue
+        match = RE_SPECIFIER.match(specifier)
+        if match is None:
+            raise ValueError("Invalid version specifier \"{}\" for {}".format(specifier.strip(), name))
+        operator, version = match.groups()
+        specifiers.append((canonical_version(version), operator))
+    specifiers = ",".join(operator + version for version, operator in sorted(set(specifiers)))
+    return name, "{}{}{}{}".format(name, extras, specifiers, marker)
+
+
+def logical_lines(filename):
+    """ Yields the lines of a requirements file, joining continued lines
+        and removing comments.
+    """
+    with open(filename) as f:
+        pending = ""
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line.endswith("\\"):
+                pending += line[:-1]
+                continue
+            line = pending + line
+            pending = ""
+            # A comment starts at the beginning of a line or after whitespace
+            line = re.sub(r'(^|\s)#.*$', '', line).strip()
+            if line:
+                yield line
+        if pending.strip():
+            yield pending.strip()
+
+
+def split_option(line):
+    """ Splits an option line into (option, value), eg. "-r base.txt" or "--requirement=base.txt". """
+    if line.startswith("--") and "=" in line.split()[0]:
+        option, value = line.split("=", 1)
+        return option, value.strip()
+    parts = shlex.split(line)
+    option = parts[0]
+    # Short options may be stuck to their value, eg. "-rbase.txt"
+    if not option.startswith("--") and len(option) > 2:
+        return option[:2], option[2:]
+    return option, " ".join(parts[1:])
+
+
+def parse_requirements(filename, constraint=False, _seen=None):
+    """ Returns a list of Requirements (and kept options) from the given file,
+        following -r and -c includes relative to the including file.
+    """
+    filename = os.path.abspath(filename)
+    seen = _seen if _seen is not None else set()
+    if filename in seen:
+        raise exceptions.BuildError("Requirements file is included in itself: {}".format(filename), None)
+    seen.add(filename)
+    if not os.path.exists(filename):
+        raise exceptions.BuildError("Requirements file not found: {}".format(filename), None)
+
+    requirements = []
+    for line in logical_lines(filename):
+        try:
+            if not line.startswith("-"):
+                key, canonical = canonical_requirement(line)
+                requirements.append(Requirement(key, canonical, constraint))
+                continue
+            # Options that only affect how pip runs (eg. --trusted-host) are ignored
+            option, value = split_option(line)
+            if option in ('-r', '--requirement', '-c', '--constraint'):
+                included = os.path.join(os.path.dirname(filename), value)
+                is_constraint = constraint or option in ('-c', '--constraint')
+                requirements.extend(parse_requirements(included, is_constraint, seen))
+            elif option in ('-e', '--editable'):
+                line = "-e " + value.strip()
+                requirements.append(Requirement(line, line, constraint))
+            elif option in KEPT_OPTIONS:
+                line = " ".join([KEPT_OPTIONS[option], value]).strip()
+                requirements.append(Requirement(line, line, constraint))
+        except ValueError as e:
+            raise exceptions.BuildError("{} in {}".format(e, filename), None)
+    seen.discard(filename)
+    return requirements
+
+
+def normalize_requirements(filename):
+    """ Returns the canonical form of a requirements file as a list of lines:
+        options first, then requirements, then constraints (prefixed by
+        "-c "), each sorted and without duplicates.
+
+        Files that would install the same thing should have the same
+        canonical form (and so the same env package), however they are
+        spelled: includes are resolved, comments removed, and names, extras,
+        versions and environment markers canonicalised.
+    """
+    options, requirements, constraints = set(), set(), set()
+    for requirement in parse_requirements(filename):
+        if requirement.line.startswith("--"):
+            options.add(requirement.line)
+        elif requirement.constraint:
+            constraints.add("-c " + requirement.line)
+        else:
+            requirements.add(requirement.line)
+    return sorted(options) + sorted(requirements) + sorted(constraints)
+
+
+def requirements_hash(filename):
+    """ Returns a hash of the canonical form of a requirements file. """
+    content = "\n".join(normalize_requirements(filename))
+    return hashlib.sha1(content).hexdigest()[:constants.HASH_LENGTH]
+
+
+def read_requirements(filename):
+    """ Returns a dict of the requirements in a requirements file, canonical
+        line by key (see Requirement). Constraints are not included.
+    """
+    return dict((r.key, r.line) for r in parse_requirements(filename) if not r.constraint)
+
+
+def read_normalized_requirements(filename):
+    """ Like read_requirements(), for a file written from normalize_requirements(). """
+    requirements = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("-c "):
+                continue
+            key = line if line.startswith("-") else canonical_requirement(line)[0]
+            requirements[key] = line
+    return requirements
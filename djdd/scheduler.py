@@ -0,0 +1,140 @@
+import sys
+import time
+import Queue
+import threading
+
+from djdd import trace
+from djdd import streams
+from djdd import constants
+from djdd import exceptions
+
+
+class Stage(object):
+    """ A step of a build, run as part of a dependency graph.
+
+        `run` is called with the values named in `inputs` as keyword arguments
+        and returns a dict with a value for each name in `outputs`. A stage
+        runs as soon as all of its inputs are available.
+        `done` is optional, it is called like `run` and returns the outputs if
+        the results of this stage already exist, in which case `run` is skipped.
+    """
+    def __init__(self, name, run, inputs=(), outputs=(), done=None):
+        self.name = name
+        self.run = run
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.done = done
+
+    def __repr__(self):
+        return "Stage({!r})".format(self.name)
+
+
+def check_stages(stages, values=()):
+    """ Checks that every input is provided exactly once and that there are
+        no cycles. Raises a BuildError otherwise.
+    """
+    provided = set(values)
+    for stage in stages:
+        for name in stage.outputs:
+            if name in provided:
+                raise exceptions.BuildError("Value \"{}\" is provided more than once".format(name), None)
+            provided.add(name)
+    available = set(values)
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining if available.issuperset(stage.inputs)]
+        if not ready:
+            missing = sorted(set(name for stage in remaining for name in stage.inputs) - provided)
+            if missing:
+                msg = "No stage provides {}".format(", ".join(missing))
+            else:
+                msg = "Stages depend on each other: {}".format(", ".join(s.name for s in remaining))
+            raise exceptions.BuildError(msg, None)
+        for stage in ready:
+            remaining.remove(stage)
+            available.update(stage.outputs)
+
+
+def run_stages(stages, values=None, jobs=None, report=None):
+    """ Runs the given stages, up to `jobs` at the same time, as soon as their
+        inputs are available. Returns a dict with all the values provided.
+
+        `report` is called with (stage name, status, duration) as stages
+        start ("started") and finish ("finished", "skipped", "failed" or
+        "cancelled").
+        When a stage fails, no new stages are started, the commands of the
+        running stages are cancelled (see djdd.streams.Scope) and a
+        StageError is raised once those stages have finished.
+    """
+    values = dict(values or {})
+    jobs = jobs or constants.BUILD_JOBS
+    report = report or (lambda name, status, duration: None)
+    check_stages(stages, values)
+
+    finished = Queue.Queue()
+    pending = list(stages)
+    running = set()
+    failure = None
+    # Commands of each stage are traced as a phase of the caller's phase
+    parent_phase = trace.current_phase()
+    scope = streams.Scope(streams.current_scope())
+
+    def worker(stage, kwargs):
+        started = time.time()
+        try:
+            with trace.phase(stage.name, parent=parent_phase), streams.cancel_scope(scope):
+                result = stage.done(**kwargs) if stage.done else None
+                status = "skipped"
+                if result is None:
+                    result = stage.run(**kwargs)
+                    status = "finished"
+            missing = set(stage.outputs) - set(result or {})
+            if missing:
+                raise exceptions.BuildError("Stage did not provide {}".format(", ".join(sorted(missing))), None)
+        except Exception:
+            # Once another stage has failed, this one has (most likely) failed because of that
+            status = "cancelled" if scope.cancelled else "failed"
+            finished.put((stage, status, sys.exc_info()[1], time.time() - started))
+        else:
+            finished.put((stage, status, result, time.time() - started))
+
+    try:
+        while True:
+            if failure is None:
+                for stage in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    if all(name in values for name in stage.inputs):
+                        pending.remove(stage)
+                        running.add(stage)
+                        report(stage.name, "started", None)
+                        kwargs = dict((name, values[name]) for name in stage.inputs)
+                        thread = threading.Thread(target=worker, args=(stage, kwargs), name=stage.name)
+                        thread.daemon = True
+                        thread.start()
+            if not running:
+                break
+
+            # A timeout keeps the wait interruptible by KeyboardInterrupt
+            while True:
+                try:
+                    stage, status, result, duration = finished.get(True, 3600)
+                    break
+                except Queue.Empty:
+                    pass
+            running.remove(stage)
+            report(stage.name, status, duration)
+            if status in ("failed", "cancelled"):
+                if failure is None:
+                    failure = exceptions.StageError(stage.name, result)
+                    scope.cancel()
+            else:
+                values.update((name, result[name]) for name in stage.outputs)
+    except BaseException:
+        # eg. KeyboardInterrupt, the stages can't be left running
+        scope.cancel()
+        raise
+
+    if failure is not None:
+        raise failure
+    return values
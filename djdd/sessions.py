@@ -0,0 +1,233 @@
+import os
+import time
+import uuid
+import errno
+import fcntl
+import logging
+import contextlib
+import subprocess
+
+from djdd import trace
+from djdd import streams
+from djdd import constants
+
+logger = logging.getLogger("djdd")
+
+
+class SessionPool(object):
+    """ Keeps warm schroot sessions for a build environment, so that short
+        commands don't pay for a session setup and teardown every time.
+
+        Each pooled session has a record file in the build directory. A lease
+        holds an exclusive lock on that file, so sessions are never shared by
+        two callers at once (even across processes), and a crashed caller
+        releases its lease automatically. The mtime of the record is the time
+        the session was last released.
+    """
+    def __init__(self, build_env, max_idle=None, max_sessions=None):
+        self.build_env = build_env
+        self.dir = build_env.session_dir
+        self.max_idle = constants.SESSION_MAX_IDLE if max_idle is None else max_idle
+        self.max_sessions = constants.SESSION_POOL_SIZE if max_sessions is None else max_sessions
+
+    @property
+    def prefix(self):
+        """ All pooled session names start with this, schroot lists them as "session:<name>". """
+        return "{}-pool-".format(self.build_env.name)
+
+    def record_filename(self, session_name):
+        return os.path.join(self.dir, session_name)
+
+    def list_records(self):
+        """ Returns the names of all sessions recorded in the pool. """
+        try:
+            names = os.listdir(self.dir)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        return sorted(name for name in names if name.startswith(self.prefix))
+
+    def list_sessions(self):
+        """ Returns the names of all pool sessions that schroot knows about. """
+        output = subprocess.check_output([constants.SCHROOT, '--list', '--all-sessions', '--quiet'])
+        our_prefix = "session:" + self.prefix
+        return [s[len("session:"):] for s in output.splitlines() if s.startswith(our_prefix)]
+
+    @contextlib.contextmanager
+    def lease(self):
+        """ Context manager providing the name of an exclusively leased session
+            (eg. "session:djdd_abcde-pool-0123..."). The session stays open
+            for the next caller when the context is left, unless a command
+            run within the context (also in stages, see run_stages()) was
+            killed: those can leave processes behind (eg. ones run as root),
+            ending the session kills them.
+        """
+        scope = streams.Scope(streams.current_scope())
+        session_name, record, keep = self._acquire()
+        try:
+            with streams.cancel_scope(scope):
+                yield "session:{}".format(session_name)
+        finally:
+            if keep and not scope.killed:
+                self._release(session_name, record)
+            else:
+                self._end(session_name, record)
+
+    def _acquire(self):
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        self.reap_now_and_then()
+
+        records = self.list_records()
+        live = len(records)
+        for session_name in records:
+            record = self._try_lock(session_name)
+            if record is None:
+                continue
+            idle = time.time() - os.fstat(record.fileno()).st_mtime
+            if idle > self.max_idle:
+                self._end(session_name, record)
+                live -= 1
+            elif idle > constants.SESSION_HEALTH_CHECK_AFTER and not self._healthy(session_name):
+                logger.debug("Discarding unhealthy schroot session {}".format(session_name))
+                self._end(session_name, record)
+                live -= 1
+            else:
+                return session_name, record, True
+
+        # Nothing available, begin a new session. The record is locked before
+        # the session exists, so that reap() never sees it as leaked.
+        # If the pool is full, the session will be ended on release.
+        session_name = self.prefix + uuid.uuid4().hex
+        record = open(self.record_filename(session_name), 'a')
+        fcntl.flock(record, fcntl.LOCK_EX)
+        cmd = [constants.SCHROOT, '--chroot', self.build_env.name, '--begin-session', '--session-name', session_name]
+        try:
+            with trace.command('schroot', cmd) as trace_record:
+                subprocess.check_output(cmd)
+                trace_record['returncode'] = 0
+        except:
+            os.unlink(self.record_filename(session_name))
+            record.close()
+            raise
+        return session_name, record, live < self.max_sessions
+
+    def _release(self, session_name, record):
+        os.utime(self.record_filename(session_name), None)
+        fcntl.flock(record, fcntl.LOCK_UN)
+        record.close()
+
+    def _try_lock(self, session_name):
+        """ Returns the open (and locked) record file, or None if the session
+            is currently leased or has just been removed.
+        """
+        filename = self.record_filename(session_name)
+        try:
+            record = open(filename, 'a')
+        except IOError:
+            return None
+        try:
+            fcntl.flock(record, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            record.close()
+            return None
+        # Another caller may have ended this session while we waited
+        if not os.path.exists(filename):
+            record.close()
+            return None
+        return record
+
+    def _healthy(self, session_name):
+        cmd = [constants.SCHROOT, '--chroot', 'session:' + session_name, '--run-session', '--directory', '/', '--', 'true']
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(cmd, stdout=devnull, stderr=devnull) == 0
+
+    def _end(self, session_name, record):
+        end_session(session_name)
+        if record is not None:
+            try:
+                os.unlink(self.record_filename(session_name))
+            except OSError:
+                pass
+            record.close()
+
+    def reap(self, max_idle=None):
+        """ Ends idle sessions older than max_idle seconds, ends leaked sessions
+            (open in schroot but not recorded) and forgets records of sessions
+            that schroot no longer knows about.
+            Returns the names of the sessions that were ended.
+        """
+        if max_idle is None:
+            max_idle = self.max_idle
+        open_sessions = set(self.list_sessions())
+        ended = []
+        records = self.list_records()
+        for session_name in records:
+            record = self._try_lock(session_name)
+            if record is None:
+                continue
+            idle = time.time() - os.fstat(record.fileno()).st_mtime
+            if session_name not in open_sessions:
+                os.unlink(self.record_filename(session_name))
+                record.close()
+            elif idle >= max_idle:
+                self._end(session_name, record)
+                ended.append(session_name)
+            else:
+                fcntl.flock(record, fcntl.LOCK_UN)
+                record.close()
+
+        for session_name in open_sessions - set(records):
+            logger.debug("Ending leaked schroot session {}".format(session_name))
+            self._end(session_name, None)
+            ended.append(session_name)
+        return ended
+
+    def reap_now_and_then(self):
+        """ Calls reap() if it hasn't been called (by any process) within the
+            last SESSION_REAP_INTERVAL seconds, so that idle and leaked sessions
+            don't depend on someone running reap().
+        """
+        stamp = os.path.join(self.dir, "reaped")
+        try:
+            if time.time() - os.path.getmtime(stamp) < constants.SESSION_REAP_INTERVAL:
+                return
+        except OSError:
+            pass
+        with open(stamp, 'a'):
+            pass
+        os.utime(stamp, None)
+        try:
+            self.reap()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.debug("Could not reap schroot sessions: {}".format(e))
+
+    def end_all(self):
+        """ Ends every pooled session that isn't currently leased. """
+        return self.reap(max_idle=0)
+
+
+@contextlib.contextmanager
+def overlay_session(build_env):
+    """ Context manager providing the name of a new session of the build
+        environment's overlay chroot, which is ended (and its changes thrown
+        away) when the context is left. These are never pooled, as each
+        session has its own copy of the root.
+    """
+    session_name = "{}-overlay-{}".format(build_env.name, uuid.uuid4().hex)
+    cmd = [constants.SCHROOT, '--chroot', build_env.overlay_name, '--begin-session', '--session-name', session_name]
+    with trace.command('schroot', cmd) as record:
+        subprocess.check_output(cmd)
+        record['returncode'] = 0
+    try:
+        yield "session:{}".format(session_name)
+    finally:
+        end_session(session_name)
+
+
+def end_session(session_name):
+    cmd = [constants.SCHROOT, '--chroot', 'session:' + session_name, '--end-session', '--force']
+    with trace.command('schroot', cmd) as record:
+        record['returncode'] = subprocess.call(cmd)
+    return record['returncode']
@@ -0,0 +1,16 @@
+def parse_size(size):
+    """ Parses a size in bytes, with an optional K, M, G or T suffix (eg. "5G"). """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    """ Formats a size in bytes for people, eg. "1.5G". """
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            return "{:.1f}{}".format(size, unit) if unit else "{}".format(size)
+        size /= 1024.0
+    return "{:.1f}T".format(size)
@@ -1,7 +1,9 @@
 import os
 import collections
 from djdd.base import BuildEnvironment
+from djdd.fetch import FetchCoordinator, read_ref
 from djdd import exceptions
+from djdd import trace
 
 def get_build_states(build_env):
     """
@@ -53,21 +55,12 @@ def get_status(dir, variant_database=None):
     status['status'] = (build_states, build_state_msg)
 
     # 2. Softwares
-    # Get a list of respositories
+    # Get a list of respositories, read from the host (no chroot needed)
     if 'debootstrap' in build_states:
-        repositories = collections.defaultdict(list)
-        repository_base_dir = '/var/lib/{namespace}/*/repository'.format(namespace=build_env.NAMESPACE)
-        with build_env.chroot() as call:
-            software_dirs = call('ls -d {}'.format(repository_base_dir), shell=True, capture_output=True)
-            for software_dir in software_dirs.splitlines():
-                software = os.path.basename(os.path.dirname(software_dir))
-                repos = call('ls -d {}/*.git'.format(software_dir), shell=True, capture_output=True)
-                for repo in repos.splitlines():
-                    repository, ext = os.path.splitext(os.path.basename(repo))
-                    repositories[software].append(repository)
-
+        repositories = list_all_repositories(build_env)
         # 2a. SRCs
-        status['software'] = dict(repositories)
+        status['software'] = dict((software, [r['name'] for r in repos]) for software, repos in repositories.items())
+        status['repositories'] = repositories
 
     # 2b. Variants
     if 'variant-db' in build_states:
@@ -77,3 +70,80 @@ def get_status(dir, variant_database=None):
         status['variants'] = dict(variants)
 
     return status
+
+
+def get_profiles(dir, count=1, limit=10, name=None):
+    """ Summarizes the last `count` traces in the build directory, most recent
+        first, optionally only those whose name starts with `name` (eg.
+        "build mysoftware"). See djdd.trace.summarize_trace().
+    """
+    build_env = BuildEnvironment(dir)
+    profiles = []
+    for filename in reversed(trace.list_traces(build_env.log_dir)):
+        profile = trace.summarize_trace(trace.read_trace(filename), limit)
+        if name and not (profile['name'] or "").startswith(name):
+            continue
+        profile['filename'] = filename
+        profiles.append(profile)
+        if len(profiles) >= count:
+            break
+    return profiles
+
+
+def list_all_repositories(build_env):
+    """ Returns a dict of the repositories of each software, as lists of
+        dicts like those from get_repository_details().
+    """
+    base_dir = '/var/lib/{namespace}'.format(namespace=build_env.NAMESPACE)
+    repositories = {}
+    try:
+        names = sorted(os.listdir(build_env.ext_filename(base_dir)))
+    except OSError:
+        return repositories
+    for software in names:
+        repository_base_dir = os.path.join(base_dir, software, 'repository')
+        try:
+            repository_names = sorted(os.listdir(build_env.ext_filename(repository_base_dir)))
+        except OSError:
+            continue
+        repositories[software] = [get_repository_details(build_env, os.path.join(repository_base_dir, name))
+                                  for name in repository_names if name.endswith(".git")]
+    return repositories
+
+
+def get_repository_details(build_env, repository_dir):
+    """ Returns a dict describing a mirror, eg.
+        {
+            'name': 'repository',
+            'path': '/var/lib/djdd/mysoftware/repository/repository.git',
+            'head': '1a2b3c4d...',
+            'branch': 'master',
+            'last_fetched': 1445000000.0,
+            'size': 12345678,
+        }
+        'head', 'branch' and 'last_fetched' may be None.
+    """
+    git_dir = build_env.ext_filename(repository_dir)
+    branch = None
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            head = f.read().strip()
+        if head.startswith("ref: refs/heads/"):
+            branch = head[len("ref: refs/heads/"):]
+    except IOError:
+        pass
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(git_dir):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return {
+        'name': os.path.splitext(os.path.basename(repository_dir))[0],
+        'path': repository_dir,
+        'head': read_ref(build_env, repository_dir, "HEAD"),
+        'branch': branch,
+        'last_fetched': FetchCoordinator(build_env, None).last_fetched(repository_dir),
+        'size': size,
+    }
@@ -0,0 +1,364 @@
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import weakref
+import threading
+import contextlib
+import subprocess
+import collections
+
+from djdd import trace
+from djdd import constants
+from djdd import exceptions
+
+# The output of commands run in a chroot is streamed line by line: into the
+# command log of the current build (if any) and to the console as it
+# arrives. Only the last lines are kept in memory, unless a caller needs
+# all of the output (eg. to parse it).
+
+_log = None
+_log_lock = threading.Lock()
+_local = threading.local()
+
+CommandOutput = collections.namedtuple('CommandOutput', 'returncode output size started duration')
+
+
+class CommandLog(object):
+    """ A log file shared by all threads, rotated once it grows beyond
+        max_size (to filename.1, filename.2 etc., keeping `backups` of them).
+        Lines written while in a phase (see djdd.trace.phase()) are prefixed
+        with it, as parallel stages write to the same log.
+    """
+    def __init__(self, filename, max_size=None, backups=None):
+        self.filename = filename
+        self.max_size = constants.COMMAND_LOG_MAX_SIZE if max_size is None else max_size
+        self.backups = constants.COMMAND_LOG_BACKUPS if backups is None else backups
+        self.lock = threading.Lock()
+        self.file = open(filename, "a")
+        self.size = self.file.tell()
+
+    def write_line(self, line):
+        phase = trace.current_phase()
+        if phase is not None:
+            line = "[{}] {}".format(phase, line)
+        with self.lock:
+            if self.size and self.size + len(line) > self.max_size:
+                self.rotate()
+            self.file.write(line)
+            self.file.flush()
+            self.size += len(line)
+
+    def rotate(self):
+        self.file.close()
+        for number in range(self.backups - 1, 0, -1):
+            older = "{}.{}".format(self.filename, number)
+            if os.path.exists(older):
+                os.rename(older, "{}.{}".format(self.filename, number + 1))
+        if self.backups:
+            os.rename(self.filename, self.filename + ".1")
+        else:
+            os.unlink(self.filename)
+        self.file = open(self.filename, "a")
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+
+
+@contextlib.contextmanager
+def command_log(log_dir, name):
+    """ Writes the output of the commands run within this context to the
+        log of the given name in log_dir (eg. "build-mysoftware-berlin.log").
+        Within another such context, output goes to that log instead.
+    """
+    global _log
+    with _log_lock:
+        if _log is not None:
+            started = False
+        else:
+            if not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            _log = CommandLog(os.path.join(log_dir, "-".join(name.split()) + ".log"))
+            _log.write_line("==== {} {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), " ".join(sys.argv)))
+            started = True
+    try:
+        yield _log
+    finally:
+        if started:
+            with _log_lock:
+                _log.close()
+                _log = None
+
+
+def write_line(line, echo=True):
+    """ Writes a line of output to the command log and, with echo, to the console. """
+    log = _log
+    if log is not None:
+        log.write_line(line)
+    if echo:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+################################################################################
+# Running commands
+################################################################################
+
+
+class Scope(object):
+    """ The commands started within a scope (see cancel_scope()) can be
+        cancelled together, eg. those of the other stages when a stage of a
+        build fails. A cancelled command is killed with its child processes,
+        as far as we are allowed to. What is left (eg. commands run as root
+        in a chroot) ends with the schroot session, see SessionPool.lease().
+        Cancelling a scope also cancels the scopes created within it. Once a
+        command has been killed (cancelled or timed out), the scope and those
+        it was created within are marked as `killed`.
+    """
+    def __init__(self, parent=None):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.children = weakref.WeakSet()
+        self.parent = parent
+        self.cancelled = False
+        self.killed = False
+        if parent is not None:
+            with parent.lock:
+                parent.children.add(self)
+                self.cancelled = parent.cancelled
+
+    def start(self, cmd, shell=False, env=None):
+        """ Starts the command (reading its stdout and stderr from a pipe),
+            unless the scope has been cancelled.
+        """
+        with self.lock:
+            if self.cancelled:
+                raise exceptions.CommandCancelled(cmd)
+            proc = subprocess.Popen(cmd, shell=shell, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            proc.killed = None
+            self.processes.add(proc)
+        return proc
+
+    def finish(self, proc):
+        """ Waits for the (killed) process to exit and returns its exit code. """
+        if proc.killed is not None:
+            stop(proc)
+            scope = self
+            while scope is not None:
+                scope.killed = True
+                scope = scope.parent
+        proc.stdout.close()
+        returncode = proc.wait()
+        with self.lock:
+            self.processes.discard(proc)
+        return returncode
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            processes = list(self.processes)
+            children = list(self.children)
+        for proc in processes:
+            kill(proc)
+        for child in children:
+            child.cancel()
+
+
+_root_scope = Scope()
+
+
+def current_scope():
+    return getattr(_local, 'scope', None) or _root_scope
+
+
+@contextlib.contextmanager
+def cancel_scope(scope=None):
+    """ Commands started in this thread within this context belong to the
+        given scope, or a new one within the current scope. Provides the scope.
+    """
+    previous = getattr(_local, 'scope', None)
+    _local.scope = scope or Scope(current_scope())
+    try:
+        yield _local.scope
+    finally:
+        _local.scope = previous
+
+
+def descendants(pid):
+    """ Returns the pids of all (living) descendants of the process, read from /proc. """
+    children = collections.defaultdict(list)
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(name)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # The command name is in parentheses (and can contain anything), the parent pid follows the state
+        children[int(stat.rsplit(")", 1)[1].split()[1])].append(int(name))
+    found = []
+    remaining = [pid]
+    while remaining:
+        pids = children.get(remaining.pop(), [])
+        found.extend(pids)
+        remaining.extend(pids)
+    return found
+
+
+def kill(proc, sig=signal.SIGTERM):
+    """ Sends the signal to the process and its descendants, skipping those
+        we may not signal.
+    """
+    if proc.returncode is not None:
+        return
+    if proc.killed is None:
+        proc.killed = time.time()
+    for pid in [proc.pid] + descendants(proc.pid):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+
+def stop(proc):
+    """ Kills the process, and waits for it to exit. Processes still running
+        after the grace period are killed with SIGKILL.
+    """
+    kill(proc)
+    while proc.poll() is None:
+        if time.time() - proc.killed > constants.KILL_GRACE_PERIOD:
+            kill(proc, signal.SIGKILL)
+            proc.wait()
+            break
+        time.sleep(0.05)
+
+
+def run(cmd, shell=False, env=None, echo=True, tail=None, timeout=None):
+    """ Runs the command, streaming its output (stdout and stderr together).
+        Returns a CommandOutput with the last `tail` lines of output (all of
+        it if tail is None) and the size of the whole output.
+        See run_many() for timeouts and cancellation.
+    """
+    return run_many([cmd], shell, env, 1, timeout, echo, tail)[0]
+
+
+def run_many(cmds, shell=False, env=None, jobs=None, timeout=None, echo=True, tail=None, labels=None):
+    """ Runs the commands, up to `jobs` at the same time (by default all of
+        them), reading their output in this thread as it arrives. Lines are
+        written like by write_line(), prefixed with the command's label if
+        labels are given.
+        Returns a CommandOutput for each command, in order, once all of
+        them have finished. Raises CommandTimeout if a command was killed
+        for running longer than `timeout` seconds, or CommandCancelled (after
+        killing the commands still running) if the current scope is cancelled.
+    """
+    scope = current_scope()
+    waiting = collections.deque(enumerate(cmds))
+    jobs = jobs or len(waiting) or 1
+    running = {}
+    results = [None] * len(waiting)
+    timed_out = []
+    poller = select.poll()
+    try:
+        while waiting or running:
+            while waiting and len(running) < jobs:
+                index, cmd = waiting.popleft()
+                proc = scope.start(cmd, shell=shell, env=env)
+                running[proc.stdout.fileno()] = command = _RunningCommand(index, proc, tail)
+                if labels:
+                    command.prefix = "[{}] ".format(labels[index])
+                poller.register(proc.stdout, select.POLLIN)
+
+            ended = []
+            for fd, event in poll(poller, next_wakeup(running.values(), timeout)):
+                data = os.read(fd, 65536)
+                if data:
+                    running[fd].feed(data, echo)
+                else:
+                    ended.append(fd)
+
+            now = time.time()
+            for fd, command in running.items():
+                if fd in ended:
+                    continue
+                if command.proc.killed is not None:
+                    if now - command.proc.killed > constants.KILL_GRACE_PERIOD:
+                        kill(command.proc, signal.SIGKILL)
+                        # Only processes we may not kill still have the output open
+                        if command.proc.poll() is not None:
+                            ended.append(fd)
+                elif timeout is not None and now - command.started > timeout:
+                    write_line("{}[killed after {}s]\n".format(command.prefix, timeout), echo)
+                    timed_out.append(command.index)
+                    kill(command.proc)
+            for fd in ended:
+                command = running.pop(fd)
+                poller.unregister(fd)
+                command.feed(None, echo)
+                returncode = scope.finish(command.proc)
+                results[command.index] = CommandOutput(returncode, "".join(command.lines), command.size,
+                                                       command.started, time.time() - command.started)
+            if scope.cancelled:
+                unfinished = sorted(command.index for command in running.values()) or [index]
+                raise exceptions.CommandCancelled(cmds[unfinished[0]])
+    except BaseException:
+        for command in running.values():
+            kill(command.proc)
+        for command in running.values():
+            scope.finish(command.proc)
+        raise
+    if timed_out:
+        index = min(timed_out)
+        raise exceptions.CommandTimeout(cmds[index], timeout, results[index].output)
+    return results
+
+
+class _RunningCommand(object):
+    def __init__(self, index, proc, tail):
+        self.index = index
+        self.proc = proc
+        self.started = time.time()
+        self.lines = collections.deque(maxlen=tail)
+        self.size = 0
+        self.partial = ""
+        self.prefix = ""
+
+    def feed(self, data, echo):
+        """ Handles output that has been read, or the end of it (None). """
+        if data is None:
+            lines, self.partial = [self.partial] if self.partial else [], ""
+        else:
+            lines = (self.partial + data).split("\n")
+            self.partial = lines.pop()
+            lines = [line + "\n" for line in lines]
+        for line in lines:
+            write_line(self.prefix + line, echo)
+            self.lines.append(line)
+            self.size += len(line)
+
+
+def next_wakeup(commands, timeout):
+    """ Milliseconds until a running command times out or should be killed
+        with SIGKILL. Commands can be cancelled by other threads at any time,
+        so this is at most a second.
+    """
+    deadlines = [time.time() + 1]
+    for command in commands:
+        if command.proc.killed is not None:
+            deadlines.append(command.proc.killed + constants.KILL_GRACE_PERIOD)
+        elif timeout is not None:
+            deadlines.append(command.started + timeout)
+    return int(max(min(deadlines) - time.time(), 0) * 1000) + 1
+
+
+def poll(poller, wakeup):
+    while True:
+        try:
+            return poller.poll(wakeup)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
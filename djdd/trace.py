@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import glob
+import pipes
+import resource
+import itertools
+import threading
+import contextlib
+import subprocess
+import collections
+
+# Traces are written to the build environment's log directory, one file per
+# traced command (eg. a build), with one JSON object per line:
+#   {"event": "start", "name": "build mysoftware berlin", "time": ..., "pid": ..., "argv": [...]}
+#   {"event": "command", "kind": "chroot", "cmd": "git --git-dir ... fetch --prune",
+#    "phase": "fetch", "returncode": 0, "time": ..., "wall": 1.2, "cpu": 0.3,
+#    "output_size": 1234, "thread": "fetch"}
+#   {"event": "end", "time": ..., "wall": 95.1}
+# kind is "sudo", "chroot" (a call), "ssh" (a call with the ssh-agent),
+# "batch" (a chroot batch), "step" (a command of a batch) or "schroot"
+# (beginning or ending a session).
+TRACE_PATTERN = "trace-*.jsonl"
+
+_trace = None
+_trace_lock = threading.Lock()
+_trace_numbers = itertools.count(1)
+_local = threading.local()
+
+
+class Trace(object):
+    """ A trace file, written to by all threads. """
+    def __init__(self, filename, name):
+        self.filename = filename
+        self.name = name
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.file = open(filename, "a")
+        self.write({'event': 'start', 'name': name, 'time': self.started, 'pid': os.getpid(), 'argv': sys.argv})
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.write({'event': 'end', 'time': time.time(), 'wall': time.time() - self.started})
+        self.file.close()
+
+
+@contextlib.contextmanager
+def tracing(log_dir, name):
+    """ Records the commands run within this context into a new trace file
+        in log_dir. Within another traced context, the commands are
+        recorded in that trace instead.
+    """
+    global _trace
+    with _trace_lock:
+        if _trace is not None:
+            started = False
+        else:
+            if not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            filename = os.path.join(log_dir, "trace-{}-{}.{}-{}.jsonl".format(
+                    time.strftime("%Y%m%d-%H%M%S"), os.getpid(), next(_trace_numbers), "-".join(name.split())))
+            _trace = Trace(filename, name)
+            started = True
+    try:
+        yield _trace
+    finally:
+        if started:
+            with _trace_lock:
+                _trace.close()
+                _trace = None
+
+
+def current_phase():
+    return getattr(_local, 'phase', None)
+
+
+@contextlib.contextmanager
+def phase(name, parent=None):
+    """ Commands run in this thread within this context belong to the given
+        phase (eg. a build stage). Phases can be nested, eg. "berlin/fetch".
+        A new thread can continue the phase of the thread that started it
+        by passing that as parent.
+    """
+    previous = getattr(_local, 'phase', None)
+    parent = parent or previous
+    _local.phase = name if parent is None else "{}/{}".format(parent, name)
+    try:
+        yield
+    finally:
+        _local.phase = previous
+
+
+@contextlib.contextmanager
+def via(kind):
+    """ Commands run in this thread within this context are recorded as the
+        given kind (eg. "ssh" for calls made with an ssh-agent).
+    """
+    previous = getattr(_local, 'kind', None)
+    _local.kind = kind
+    try:
+        yield
+    finally:
+        _local.kind = previous
+
+
+def format_cmd(cmd):
+    if isinstance(cmd, basestring):
+        return cmd
+    return " ".join(pipes.quote(arg) for arg in cmd)
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextlib.contextmanager
+def command(kind, cmd):
+    """ Records the external command run within this context. The caller
+        can set 'returncode' and 'output_size' in the dict provided, a
+        CalledProcessError sets them too.
+        CPU time is that of all child processes that finished in the meantime,
+        so it includes other commands that were running at the same time.
+    """
+    record = {'returncode': None, 'output_size': None}
+    if _trace is None:
+        yield record
+        return
+    started, started_cpu = time.time(), children_cpu()
+    try:
+        yield record
+    except subprocess.CalledProcessError as e:
+        record['returncode'] = e.returncode
+        if e.output is not None:
+            record['output_size'] = len(e.output)
+        raise
+    finally:
+        record.update({
+            'event': 'command',
+            'kind': getattr(_local, 'kind', None) or kind,
+            'cmd': format_cmd(cmd),
+            'phase': getattr(_local, 'phase', None),
+            'thread': threading.current_thread().name,
+            'time': started,
+            'wall': time.time() - started,
+            'cpu': children_cpu() - started_cpu,
+        })
+        trace = _trace
+        if trace is not None:
+            trace.write(record)
+
+
+def record_step(cmd, returncode, output_size, duration):
+    """ Records a command that was run (and timed) as part of a batch. """
+    record_command('step', cmd, returncode, output_size, time.time() - duration, duration)
+
+
+def record_command(kind, cmd, returncode, output_size, started, wall):
+    """ Records a command that was run (and timed) by the caller, eg. one of
+        several commands run at the same time.
+    """
+    trace = _trace
+    if trace is not None:
+        trace.write({
+            'event': 'command',
+            'kind': kind if kind == 'step' else getattr(_local, 'kind', None) or kind,
+            'cmd': format_cmd(cmd),
+            'phase': getattr(_local, 'phase', None),
+            'thread': threading.current_thread().name,
+            'returncode': returncode,
+            'output_size': output_size,
+            'time': started,
+            'wall': wall,
+            'cpu': None,
+        })
+
+
+################################################################################
+# Reading traces
+################################################################################
+
+
+def list_traces(log_dir):
+    """ Returns the trace files in log_dir, oldest first. """
+    return sorted(glob.glob(os.path.join(log_dir, TRACE_PATTERN)), key=os.path.getmtime)
+
+
+def read_trace(filename):
+    """ Returns the records of a trace file, skipping a partly written last line. """
+    records = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def program_name(cmd):
+    """ The program a (shell) command runs, eg. "git" for
+        "cd /src && GIT_DIR=x git fetch", for grouping commands.
+    """
+    words = cmd.split()
+    while words:
+        word = words.pop(0)
+        if word == "cd" and words:
+            words.pop(0)
+        elif word in ("&&", ";", "(", "exec", "sudo") or ("=" in word and not word.startswith("-")):
+            continue
+        else:
+            return os.path.basename(word)
+    return ""
+
+
+def summarize_trace(records, limit=10):
+    """ Summarizes a trace, returning a dict like
+        {
+            'name': 'build mysoftware berlin',
+            'started': 1445000000.0,
+            'wall': 95.1,                # None if it is still running (or crashed)
+            'commands': 42,
+            'phases': [('env-package', 60.2, 12), ...],     # (phase, wall, commands)
+            'programs': [('pip', 55.0, 3), ...],            # (program, wall, commands)
+            'slowest': [record, ...],
+        }
+        Batches are counted by their steps, the time a batch took on top of
+        its steps (schroot and the shell) is counted as "schroot".
+    """
+    summary = {'name': None, 'started': None, 'wall': None, 'commands': 0}
+    phases = collections.defaultdict(lambda: [0.0, 0])
+    programs = collections.defaultdict(lambda: [0.0, 0])
+    commands = []
+    # The time of the steps of the current batch of each thread
+    steps = collections.defaultdict(float)
+    for record in records:
+        event = record.get('event')
+        if event == 'start':
+            summary['name'], summary['started'] = record['name'], record['time']
+        elif event == 'end':
+            summary['wall'] = record['wall']
+        elif event == 'command':
+            if record['kind'] == 'batch':
+                # Steps are recorded before their batch, by the same thread
+                overhead = max(record['wall'] - steps.pop(record['thread'], 0.0), 0.0)
+                programs["schroot"][0] += overhead
+                phases[record['phase'] or ""][0] += overhead
+                continue
+            if record['kind'] == 'step':
+                steps[record['thread']] += record['wall']
+            commands.append(record)
+            program = "schroot" if record['kind'] == 'schroot' else program_name(record['cmd'])
+            for totals, key in ((phases, record['phase'] or ""), (programs, program)):
+                totals[key][0] += record['wall']
+                totals[key][1] += 1
+
+    by_time = lambda item: -item[1]
+    summary['commands'] = len(commands)
+    summary['phases'] = sorted(((k, v[0], v[1]) for k, v in phases.items()), key=by_time)
+    summary['programs'] = sorted(((k, v[0], v[1]) for k, v in programs.items()), key=by_time)
+    summary['slowest'] = sorted(commands, key=lambda record: -record['wall'])[:limit]
+    return summary
@@ -0,0 +1,434 @@
+import abc
+import threading
+import contextlib
+
+from djdd import constants
+from djdd import exceptions
+
+VARIANT_FIELDS = ('software', 'id', 'key', 'name', 'subdomain', 'postgres_name',
+                  'elasticsearch_name', 'redis_number', 'gunicorn_port')
+ARTIFACT_FIELDS = ('software', 'stage', 'input_hash', 'path', 'size', 'duration', 'requires')
+
+
+_connection_factory = None
+
+
+def variant_connection_factory():
+    """ Returns a (postgres) connection class that remembers which statements
+        have been prepared on it. psycopg2 is only imported when this is first
+        called, most commands never connect to a database.
+    """
+    global _connection_factory
+    if _connection_factory is None:
+        import psycopg2.extensions
+
+        class VariantConnection(psycopg2.extensions.connection):
+            def __init__(self, *args, **kwargs):
+                super(VariantConnection, self).__init__(*args, **kwargs)
+                self.prepared = set()
+
+        _connection_factory = VariantConnection
+    return _connection_factory
+
+
+class VariantStore(object):
+    """ The variant database (variants and the artifact index).
+
+        This is the part common to all backends, which provide transaction()
+        and execute(). Use open_variant_store() to get the store for a
+        database, stores are shared by everything in this process that
+        uses the same database. Every operation runs in a transaction,
+        which is rolled back if anything goes wrong.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    # Statements used by the backends, by name (with "?" placeholders)
+    STATEMENTS = {
+        'get_variant_info': """
+                SELECT {}
+                FROM variant
+                WHERE software = ? AND key = ?
+                """.format(", ".join(VARIANT_FIELDS)),
+        'list_variant_infos': """
+                SELECT {}
+                FROM variant
+                ORDER BY key
+                """.format(", ".join(VARIANT_FIELDS)),
+        'set_variant_info': """
+                INSERT INTO variant ({})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """.format(", ".join(VARIANT_FIELDS)),
+        'get_next_variant_id': "SELECT MAX(id) FROM variant",
+        'get_artifact': """
+                SELECT {}
+                FROM artifact
+                WHERE software = ? AND stage = ? AND input_hash = ?
+                """.format(", ".join(ARTIFACT_FIELDS)),
+        'list_artifacts': """
+                SELECT {}
+                FROM artifact
+                WHERE software = ?
+                ORDER BY created
+                """.format(", ".join(ARTIFACT_FIELDS)),
+        'delete_artifact': """
+                DELETE FROM artifact
+                WHERE software = ? AND stage = ? AND input_hash = ?
+                """,
+        'insert_artifact': """
+                INSERT INTO artifact ({})
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """.format(", ".join(ARTIFACT_FIELDS)),
+    }
+
+    def __init__(self, connection):
+        """ `connection` is a DatabaseConnection, as from BuildEnvironment.parse_database_uri(). """
+        self.db = connection
+
+    def connection_error(self):
+        return exceptions.VariantDBConnectionError(format_database_connection(self.db), build_env=None)
+
+    @abc.abstractmethod
+    def transaction(self, exclusive=False):
+        """ Context manager providing a cursor in a new transaction, which is
+            committed when the context is left, or rolled back on an exception.
+            Exclusive transactions wait for each other before starting.
+        """
+
+    @abc.abstractmethod
+    def execute(self, curs, name, args=()):
+        """ Executes one of the STATEMENTS. """
+
+    ############################################################################
+    # Tables
+    ############################################################################
+
+    def create_tables(self):
+        """ Creates the tables we need, if they don't exist. """
+        # 'id' is globally unique, so that eg port numbers are unique across
+        #      varants AND software titles.
+        # 'software' is only a name so far, avoid extra table with denormalised form
+        # Each artifact is identified by the build stage that produced it
+        # and a hash of that stage's inputs. 'requires' lists other artifacts
+        # this one needs, as space separated "stage:input_hash" pairs.
+        query = """
+        CREATE TABLE IF NOT EXISTS variant (
+             id integer PRIMARY KEY,
+             software character varying(50),
+             key character varying(50) NOT NULL,
+             name character varying(100) NOT NULL,
+             subdomain character varying(50) UNIQUE NOT NULL,
+             postgres_name character varying(50) UNIQUE NOT NULL,
+             elasticsearch_name character varying(50) UNIQUE NOT NULL,
+             redis_number integer UNIQUE NOT NULL,
+             gunicorn_port integer UNIQUE NOT NULL,
+             UNIQUE (software, key)
+        );
+        """
+        with self.transaction() as curs:
+            curs.execute(query)
+        self.create_artifact_table()
+
+    def create_artifact_table(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS artifact (
+             software character varying(50) NOT NULL,
+             stage character varying(50) NOT NULL,
+             input_hash character varying(64) NOT NULL,
+             path text NOT NULL,
+             size bigint NOT NULL,
+             duration double precision NOT NULL,
+             requires text NOT NULL DEFAULT '',
+             created timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+             PRIMARY KEY (software, stage, input_hash)
+        );
+        """
+        with self.transaction() as curs:
+            curs.execute(query)
+
+    @abc.abstractmethod
+    def variant_table_exists(self):
+        """ Checks if the variant table exists (and we have access to it). """
+
+    ############################################################################
+    # Variants
+    ############################################################################
+
+    def get_variant_info(self, software, variant):
+        with self.transaction() as curs:
+            self.execute(curs, 'get_variant_info', (software, variant))
+            result = curs.fetchone()
+        if result:
+            return dict(zip(VARIANT_FIELDS, result))
+
+    def list_variant_infos(self):
+        with self.transaction() as curs:
+            self.execute(curs, 'list_variant_infos')
+            results = curs.fetchall()
+        return [dict(zip(VARIANT_FIELDS, result)) for result in results]
+
+    def set_variant_info(self, software, variant, info):
+        vars = (software, info["id"], variant, info["name"], info["subdomain"], info["postgres_name"],
+                info["elasticsearch_name"], info["redis_number"], info["gunicorn_port"])
+        with self.transaction() as curs:
+            self.execute(curs, 'set_variant_info', vars)
+        return True
+
+    def get_next_variant_id(self):
+        with self.transaction() as curs:
+            self.execute(curs, 'get_next_variant_id')
+            vid = curs.fetchone()
+        return (vid[0] or 0) + 1
+
+    def allocate_variants(self, software, variants, ranges=None):
+        """ Adds the given variants of a software, allocating their id, redis
+            number and gunicorn port, all in one transaction.
+            `variants` is a list of (key, name) pairs and `ranges` a dict of
+            (first, last) by field name, defaulting to constants.VARIANT_RANGES.
+            Each variant gets the lowest free number in each range, so numbers
+            freed by deleted variants are reused. Variants that already exist
+            are left as they are.
+            Returns the variant info dicts, in the order given.
+            Raises a VariantAllocationError if a range is full or a name is taken.
+        """
+        ranges = dict(constants.VARIANT_RANGES, **(ranges or {}))
+        # Concurrent allocations wait for each other
+        with self.transaction(exclusive=True) as curs:
+            self.execute(curs, 'list_variant_infos')
+            existing = [dict(zip(VARIANT_FIELDS, result)) for result in curs.fetchall()]
+            taken = dict((field, set(info[field] for info in existing)) for field in VARIANT_FIELDS)
+            by_key = dict(((info['software'], info['key']), info) for info in existing)
+            free = dict((field, free_numbers(first, last, taken[field])) for field, (first, last) in ranges.items())
+
+            infos = []
+            for key, name in variants:
+                if (software, key) in by_key:
+                    infos.append(by_key[(software, key)])
+                    continue
+                info = {
+                    'software': software,
+                    'key': key,
+                    'name': name or key,  # TODO: use a hook
+                    'subdomain': key,  # TODO: use a hook
+                    'postgres_name': '{}_{}'.format(software, key),  # TODO: use a hook
+                    'elasticsearch_name': key,  # TODO: use a hook
+                }
+                for field in ('subdomain', 'postgres_name', 'elasticsearch_name'):
+                    if info[field] in taken[field]:
+                        raise exceptions.VariantAllocationError("The {} \"{}\" of variant {} is already "
+                                "used by another variant".format(field, info[field], key), None)
+                    taken[field].add(info[field])
+                for field, (first, last) in sorted(ranges.items()):
+                    try:
+                        info[field] = next(free[field])
+                    except StopIteration:
+                        raise exceptions.VariantAllocationError("No free {} left for variant {} (the range "
+                                "is {}-{})".format(field, key, first, last), None)
+                self.execute(curs, 'set_variant_info', tuple(info[field] for field in VARIANT_FIELDS))
+                by_key[(software, key)] = info
+                infos.append(info)
+        return infos
+
+    ############################################################################
+    # Artifacts
+    ############################################################################
+
+    def get_artifact(self, software, stage, input_hash):
+        with self.transaction() as curs:
+            self.execute(curs, 'get_artifact', (software, stage, input_hash))
+            result = curs.fetchone()
+        if result:
+            artifact = dict(zip(ARTIFACT_FIELDS, result))
+            artifact['requires'] = artifact['requires'].split()
+            return artifact
+
+    def list_artifacts(self, software):
+        with self.transaction() as curs:
+            self.execute(curs, 'list_artifacts', (software,))
+            results = curs.fetchall()
+        artifacts = []
+        for result in results:
+            artifact = dict(zip(ARTIFACT_FIELDS, result))
+            artifact['requires'] = artifact['requires'].split()
+            artifacts.append(artifact)
+        return artifacts
+
+    def set_artifact(self, software, stage, input_hash, path, size, duration, requires=()):
+        with self.transaction() as curs:
+            self.execute(curs, 'delete_artifact', (software, stage, input_hash))
+            self.execute(curs, 'insert_artifact', (software, stage, input_hash, path, size, duration,
+                                                   " ".join(requires)))
+        return True
+
+
+class PostgresVariantStore(VariantStore):
+    """ A variant store in a PostgreSQL database.
+
+        Connections are pooled, so parallel build stages don't each connect
+        again. Transactions wait for a connection once all of the pool's are
+        in use. Statements are prepared once per connection and then
+        executed by name.
+    """
+    def __init__(self, connection):
+        super(PostgresVariantStore, self).__init__(connection)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._connections = threading.BoundedSemaphore(constants.VARIANT_DB_POOL_SIZE)
+
+    @property
+    def pool(self):
+        import psycopg2
+        import psycopg2.pool
+        with self._pool_lock:
+            if self._pool is None:
+                db = self.db
+                try:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(0, constants.VARIANT_DB_POOL_SIZE,
+                            database=db.database, host=db.host, port=db.port, user=db.user,
+                            password=db.password, connection_factory=variant_connection_factory())
+                except psycopg2.OperationalError:
+                    raise self.connection_error()
+            return self._pool
+
+    @contextlib.contextmanager
+    def transaction(self, exclusive=False):
+        import psycopg2
+        pool = self.pool
+        # The pool raises an error instead of waiting when it has no connections left
+        with self._connections:
+            try:
+                conn = pool.getconn()
+            except psycopg2.OperationalError:
+                raise self.connection_error()
+            try:
+                with conn.cursor() as curs:
+                    if exclusive:
+                        # Blocks other writers (and exclusive transactions), not readers
+                        curs.execute("LOCK TABLE variant IN SHARE ROW EXCLUSIVE MODE")
+                    yield curs
+                conn.commit()
+            except:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                # Broken connections are not given back
+                pool.putconn(conn, close=bool(conn.closed))
+
+    def execute(self, curs, name, args=()):
+        """ Executes a prepared statement, preparing it first if necessary. """
+        if name not in curs.connection.prepared:
+            parts = self.STATEMENTS[name].split("?")
+            query = parts[0] + "".join("${}{}".format(i, part) for i, part in enumerate(parts[1:], 1))
+            curs.execute("PREPARE {} AS {}".format(name, query))
+            curs.connection.prepared.add(name)
+        if args:
+            curs.execute("EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(args))), args)
+        else:
+            curs.execute("EXECUTE {}".format(name))
+
+    def variant_table_exists(self):
+        query = """
+            SELECT EXISTS (
+               SELECT 1
+               FROM   information_schema.tables
+               WHERE  table_schema = 'public'
+               AND    table_name = 'variant'
+            );
+        """
+        with self.transaction() as curs:
+            curs.execute(query)
+            return curs.fetchone()[0]
+
+
+class SqliteVariantStore(VariantStore):
+    """ A variant store in an SQLite file (by default in the build directory),
+        for build machines that don't need a shared database server.
+
+        Each thread has its own connection. sqlite caches its prepared
+        statements per connection, so they are only compiled once.
+    """
+    def __init__(self, connection):
+        super(SqliteVariantStore, self).__init__(connection)
+        self.filename = connection.database
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            try:
+                # Transactions are started explicitly, see transaction()
+                conn = sqlite3.connect(self.filename, timeout=constants.SQLITE_TIMEOUT, isolation_level=None)
+            except sqlite3.OperationalError:
+                raise self.connection_error()
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self, exclusive=False):
+        conn = self.conn
+        curs = conn.cursor()
+        # An immediate transaction takes the write lock before reading
+        curs.execute("BEGIN IMMEDIATE" if exclusive else "BEGIN")
+        try:
+            yield curs
+        except:
+            curs.execute("ROLLBACK")
+            raise
+        else:
+            curs.execute("COMMIT")
+        finally:
+            curs.close()
+
+    def execute(self, curs, name, args=()):
+        curs.execute(self.STATEMENTS[name], args)
+
+    def variant_table_exists(self):
+        with self.transaction() as curs:
+            curs.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'variant'")
+            return curs.fetchone() is not None
+
+
+BACKENDS = {
+    'postgres': PostgresVariantStore,
+    'sqlite': SqliteVariantStore,
+}
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_variant_store(connection):
+    """ Returns the variant store for the given DatabaseConnection, shared
+        within this process.
+    """
+    with _stores_lock:
+        store = _stores.get(connection)
+        if store is None:
+            store = _stores[connection] = BACKENDS[connection.scheme](connection)
+        return store
+
+
+def free_numbers(first, last, taken):
+    """ Yields the numbers from first to last (inclusive) that aren't taken, in order. """
+    for number in xrange(first, last + 1):
+        if number not in taken:
+            yield number
+
+
+def format_database_connection(db):
+    if db:
+        if db.user:
+            user = db.user + (":XXXXX" if db.password else "") + "@"
+        else:
+            user = ""
+        if db.port:
+            port = ":{}".format(db.port)
+        else:
+            port = ""
+        if db.scheme == "sqlite":
+            return "sqlite://{}".format(db.database)
+        return "postgres://{user}{db.host}{port}/{db.database}".format(user=user, db=db, port=port)
+    else:
+        return "invalid/unconfigured"
@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import time
+import fcntl
+import contextlib
+
+from djdd.base import BuildEnvironment, logger, sha256_file
+from djdd import constants
+
+
+class Wheelhouse(object):
+    """ A cache of built wheels inside the build environment, shared by the
+        virtualenv builds of all software.
+
+        pip uses the wheel files directly (with --find-links). Next to them,
+        an index records the sha256, size and last use of every wheel, which
+        is used to notice replaced wheels and to evict the least recently
+        used ones when the wheelhouse grows too large. Builds hold a shared
+        lock while they build and install wheels (see using()), and wheels
+        are only evicted while no build holds it.
+    """
+    INDEX_NAME = "index.json"
+    LOCK_NAME = ".lock"
+    USE_LOCK_NAME = ".in-use"
+
+    def __init__(self, build_env):
+        self.build_env = build_env
+        self.dir = constants.WHEELHOUSE_DIR
+        self.ext_dir = build_env.ext_filename(self.dir)
+
+    def prepare_cmds(self):
+        """ Commands (run as root in the chroot) that create the wheelhouse
+            so that build environment users can maintain it.
+        """
+        return [
+            ["mkdir", "-p", self.dir],
+            ["chown", ":{}".format(self.build_env.build_group), self.dir],
+            ["chmod", "g+rwXs", self.dir],
+        ]
+
+    def pip_install_args(self):
+        """ Arguments for pip to install only from the wheelhouse. """
+        return ["--no-index", "--find-links", self.dir]
+
+    def pip_wheel_args(self):
+        """ Arguments for pip to build missing wheels into the wheelhouse. """
+        return ["wheel", "--wheel-dir", self.dir, "--find-links", self.dir]
+
+    @contextlib.contextmanager
+    def using(self):
+        """ Context manager for building wheels into, or installing them from,
+            the wheelhouse: none are evicted until it is left.
+        """
+        with open(os.path.join(self.ext_dir, self.USE_LOCK_NAME), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def index(self):
+        """ Context manager providing the index (a dict of wheel filename to
+            {'sha256', 'size', 'last_used'}), saved again on exit.
+        """
+        with open(os.path.join(self.ext_dir, self.LOCK_NAME), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index_filename = os.path.join(self.ext_dir, self.INDEX_NAME)
+            try:
+                with open(index_filename) as f:
+                    index = json.load(f)
+            except IOError:
+                index = {}
+            yield index
+            with open(index_filename + ".tmp", "w") as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.rename(index_filename + ".tmp", index_filename)
+
+    def ingest(self, index):
+        """ Adds new wheel files to the index and forgets deleted ones. """
+        filenames = set(name for name in os.listdir(self.ext_dir) if name.endswith(".whl"))
+        for name in set(index) - filenames:
+            del index[name]
+        now = time.time()
+        for name in filenames:
+            filename = os.path.join(self.ext_dir, name)
+            size = os.path.getsize(filename)
+            entry = index.get(name)
+            if entry is not None and entry['size'] == size:
+                continue
+            index[name] = {'sha256': sha256_file(filename), 'size': size, 'last_used': now}
+
+    def touch(self, index, packages):
+        """ Marks the wheels of the given (name, version) pairs as used now. """
+        wanted = set((canonical_wheel_name(name), version) for name, version in packages)
+        now = time.time()
+        for name, entry in index.items():
+            if parse_wheel_filename(name) in wanted:
+                entry['last_used'] = now
+
+    def prune(self, index, max_size, keep_since=None, wait=False):
+        """ Deletes the least recently used wheels until the wheelhouse is no
+            larger than max_size bytes. Wheels used since `keep_since` are
+            kept. Nothing is deleted while a build is using the wheelhouse,
+            unless `wait` is given, which waits for the builds to leave it.
+            Returns the names of deleted wheels.
+        """
+        total = sum(entry['size'] for entry in index.values())
+        if total <= max_size:
+            return []
+        with open(os.path.join(self.ext_dir, self.USE_LOCK_NAME), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                logger.debug("Not pruning the wheelhouse, a build is using it")
+                return []
+            pruned = []
+            for name, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+                if total <= max_size or (keep_since is not None and entry['last_used'] >= keep_since):
+                    break
+                try:
+                    os.unlink(os.path.join(self.ext_dir, name))
+                except OSError:
+                    pass
+                total -= entry['size']
+                del index[name]
+                pruned.append(name)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return pruned
+
+
+def canonical_wheel_name(name):
+    """ Wheel filenames escape a package's name with underscores. """
+    return re.sub(r"[-_.]+", "_", name).lower()
+
+
+def parse_wheel_filename(name):
+    """ Returns (canonical name, version) from a wheel filename. """
+    parts = name.split("-")
+    return canonical_wheel_name(parts[0]), parts[1]
+
+
+def list_wheels(dir):
+    """ Returns a list of dicts describing the wheels in the wheelhouse,
+        most recently used first.
+    """
+    wheelhouse = Wheelhouse(BuildEnvironment(dir))
+    if not os.path.exists(wheelhouse.ext_dir):
+        return []
+    with wheelhouse.index() as index:
+        wheelhouse.ingest(index)
+        wheels = [dict(entry, name=name) for name, entry in index.items()]
+    return sorted(wheels, key=lambda wheel: wheel['last_used'], reverse=True)
+
+
+def prewarm_wheels(dir, requirements):
+    """ Builds wheels for everything in the given requirements file (on the
+        host), so that later virtualenv builds don't need to.
+    """
+    build_env = BuildEnvironment(dir)
+    wheelhouse = Wheelhouse(build_env)
+    chroot_requirements = "/tmp/djdd-prewarm-{}.txt".format(os.getpid())
+    with build_env.chroot() as call:
+        call.batch(wheelhouse.prepare_cmds(), root=True, check=True, quiet=True)
+        with open(requirements) as src, open(build_env.ext_filename(chroot_requirements), "w") as dst:
+            dst.write(src.read())
+        try:
+            with wheelhouse.using():
+                call.batch([["pip"] + wheelhouse.pip_wheel_args() + ["-r", chroot_requirements]], root=True,
+                           check=True)
+        finally:
+            os.unlink(build_env.ext_filename(chroot_requirements))
+    with wheelhouse.index() as index:
+        wheelhouse.ingest(index)
+
+
+def prune_wheels(dir, max_size=None):
+    """ Evicts the least recently used wheels until the wheelhouse is no
+        larger than max_size bytes. Returns the names of evicted wheels.
+    """
+    wheelhouse = Wheelhouse(BuildEnvironment(dir))
+    if max_size is None:
+        max_size = constants.WHEELHOUSE_MAX_SIZE
+    if not os.path.exists(wheelhouse.ext_dir):
+        return []
+    with wheelhouse.index() as index:
+        wheelhouse.ingest(index)
+        pruned = wheelhouse.prune(index, max_size, wait=True)
+    logger.debug("Pruned {} wheels from the wheelhouse".format(len(pruned)))
+    return pruned